@@ -0,0 +1,4 @@
+# Define the __all__ variable
+__all__ = ["run_benchmarks", "synthetic_data"]
+
+# the submodules are not imported here, run_benchmarks is run as a script (python -m benchmarks.run_benchmarks)
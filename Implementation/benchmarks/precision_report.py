@@ -0,0 +1,191 @@
+"""
+
+Accuracy report of the float32 compute mode (config.compute_dtype, see analyses/precision.py) against the float64 path:
+the CSDs (post stimulus and baseline per condition, and the coherence derived from them) and the TFR contrasts of a subject are
+computed from a float64 and a float32 epoch cache of the same epochs fif file, the errors of float32 relative to float64 and
+the time of both modes are written to a json file.
+
+Usage (from the Implementation folder):
+    python -m benchmarks.precision_report --epochs SUBS_DIR/sample_subject/sub001-epo.fif --output precision_report.json
+    python -m benchmarks.precision_report --n-trials 20       (synthetic subject, see synthetic_data.py)
+
+The fif file holds the trials in single precision, so both caches hold the same trials and the errors are the errors of the transforms.
+
+"""
+import os, sys, json, time, argparse, tempfile
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules of the pipeline import both the src package and its subpackages
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from beartype import beartype
+
+
+def _errors(test, reference) -> dict:
+    # errors of test relative to the largest magnitude (max) and to the norm (l2) of reference
+    import numpy as np
+
+    test, reference = np.asarray(test), np.asarray(reference)
+
+    return {"max_rel_error": float(np.abs(test - reference).max() / np.abs(reference).max()),
+            "rel_l2_error": float(np.linalg.norm(test - reference) / np.linalg.norm(reference))}
+
+
+def _coherence(csd) -> "np.ndarray":
+    # magnitude squared coherence of all channel pairs per frequency, from the cross spectra (as in add_to_report)
+    import numpy as np
+
+    data = np.stack([csd.get_data(index=i) for i in range(len(csd.frequencies))])
+    auto_spectra = np.real(np.diagonal(data, axis1=1, axis2=2))
+
+    return np.abs(data) ** 2 / (auto_spectra[:, :, np.newaxis] * auto_spectra[:, np.newaxis, :])
+
+
+@beartype
+def compute_mode(epochs_file: str, compute_dtype: str, work_dir: str, freq_bands: list[tuple[int, int]], post_stim_time: tuple[float, float],
+                 baseline_time: tuple[float, float], freqs) -> dict:
+    """
+    Recieves:
+    * epochs_file: path to the epochs fif file of the subject.
+    * compute_dtype: 'float64' or 'float32', the precision of the epoch cache and of the transforms.
+    * work_dir: folder the epoch cache and the TFRs of the mode are written to.
+    * freq_bands, post_stim_time, baseline_time: parameters of the CSDs (see compute_csd.compute_csd_condition).
+    * freqs: frequencies of the TFR contrasts.
+
+    Function:
+    * Writes the epoch cache of the epochs in compute_dtype and computes from it the CSDs of every condition and the TFR contrast
+      of every pair of consecutive conditions, as the pipeline stages do (without the stage cache).
+
+    Returns:
+    * results: dictionary with 'csds' (condition -> (csd, baseline csd of the condition)), 'tfrs' (contrast -> AverageTFR) and 'seconds'.
+
+    """
+    import mne
+    from src import epoch_cache
+    from analyses import compute_csd, tfr_psd_analyses
+
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+
+    epoch_cache.write_epoch_cache(mne.read_epochs(epochs_file, preload=False), dtype=compute_dtype)
+    epochs = epoch_cache.EpochCache()
+    conditions = list(epochs.event_id.keys())
+
+    start = time.perf_counter()
+
+    csds = {}
+    for condition in conditions:
+        (csd, _), baseline_part = compute_csd.compute_csd_condition(epochs, condition, freq_bands, post_stim_time, baseline_time, save=False,
+                                                                    compute_dtype=compute_dtype)
+        csds[condition] = (csd, baseline_part)
+
+    csd_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+
+    condition_sums = tfr_psd_analyses.compute_condition_sums(epochs)
+    tfr_coefs_cache = tfr_psd_analyses.create_tfr_coefs_cache(condition_sums, freqs, conditions, compute_dtype=compute_dtype)
+
+    tfrs = {}
+    for condition_1, condition_2 in zip(conditions[:-1], conditions[1:]):
+        # the names of the contrasts are file names of the saved TFRs (conditions may be tags, e.g. 'food/short/rep1')
+        con1, con2 = (condition_1.replace("/", "_"), [condition_1]), (condition_2.replace("/", "_"), [condition_2])
+        tfrs[f"{con1[0]}-{con2[0]}"] = tfr_psd_analyses.compute_tfr_contrast(None, freqs, con1, con2, condition_sums=condition_sums, 
+                                                                             tfr_coefs_cache=tfr_coefs_cache)
+
+    tfr_seconds = time.perf_counter() - start
+
+    return {"csds": csds, "tfrs": tfrs, "seconds": {"csd": csd_seconds, "tfr": tfr_seconds}}
+
+
+@beartype
+def precision_report(epochs_file: str | None = None, n_trials_per_condition: int = 20, work_dir: str | None = None,
+                     output: str = "precision_report.json") -> dict:
+    """
+    Recieves:
+    * epochs_file: path to the epochs fif file of the subject (e.g. the sample subject), a synthetic subject if None.
+    * n_trials_per_condition: number of trials of each condition of the synthetic subject.
+    * work_dir: folder for the caches and outputs, a temporary folder (deleted at the end) if None.
+    * output: path of the json report.
+
+    Function:
+    * Computes the CSDs and TFR contrasts of the subject in float64 and in float32 (see compute_mode) and reports the errors of
+      float32 relative to float64 per condition and contrast: the cross spectra, the coherence (absolute error, coherence is in [0, 1])
+      and the TFR power, with the worst error over all of them and the time of both modes.
+
+    Returns:
+    * report: the dictionary written to output.
+
+    """
+    import numpy as np
+    import matplotlib
+    matplotlib.use("Agg")
+    import mne
+    from src import config, pipeline
+    from benchmarks import synthetic_data
+    from mat_to_epochs_conversion import convert_main_funcs
+
+    mne.set_log_level("ERROR")
+
+    output = os.path.abspath(output)
+    freq_bands, post_stim_time, baseline_time, freqs = config.freq_bands, config.post_stim_time, config.baseline_time, pipeline.tfr_freqs
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = tmp_dir if work_dir is None else os.path.abspath(work_dir)
+
+        if epochs_file is None:
+            folder = os.path.join(work_dir, "synthetic")
+            info = synthetic_data.create_synthetic_subject(folder, n_trials_per_condition, seed=0)
+            epochs, _ = convert_main_funcs.convert_mat_h5_to_epochs(os.path.join(folder, "datafinalLow.mat"), info)
+            epochs_file = os.path.join(folder, config.epochs_path)
+            epochs.save(epochs_file, overwrite=True)
+            del epochs
+
+        epochs_file = os.path.abspath(epochs_file)
+
+        cwd = os.getcwd()
+
+        modes = {compute_dtype: compute_mode(epochs_file, compute_dtype, os.path.join(work_dir, compute_dtype), freq_bands, post_stim_time,
+                                             baseline_time, freqs)
+                 for compute_dtype in ("float64", "float32")}
+
+        # leave the work folder before it is deleted
+        os.chdir(cwd)
+
+    reference, test = modes["float64"], modes["float32"]
+
+    report = {"epochs_file": epochs_file, "numpy": np.__version__, "mne": mne.__version__, "seconds": {mode: modes[mode]["seconds"] for mode in modes},
+              "csd": {}, "coherence": {}, "tfr": {}}
+
+    for condition, (csd, baseline_part) in reference["csds"].items():
+        test_csd, test_baseline_part = test["csds"][condition]
+        report["csd"][condition] = {"post_stim": _errors(test_csd._data, csd._data), "baseline": _errors(test_baseline_part._data, baseline_part._data)}
+        report["coherence"][condition] = {"max_abs_error": float(np.abs(_coherence(test_csd) - _coherence(csd)).max())}
+
+    for contrast, tfr in reference["tfrs"].items():
+        report["tfr"][contrast] = _errors(test["tfrs"][contrast].data, tfr.data)
+
+    report["worst"] = {"csd_max_rel_error": max(max(errors["post_stim"]["max_rel_error"], errors["baseline"]["max_rel_error"]) for errors in report["csd"].values()),
+                       "coherence_max_abs_error": max(errors["max_abs_error"] for errors in report["coherence"].values()),
+                       "tfr_max_rel_error": max((errors["max_rel_error"] for errors in report["tfr"].values()), default=0.0)}
+
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+
+    print(json.dumps({"worst": report["worst"], "seconds": report["seconds"]}, indent=1))
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy of the float32 compute mode against the float64 path")
+    parser.add_argument("--epochs", default=None, help="epochs fif file of the subject (a synthetic subject by default)")
+    parser.add_argument("--n-trials", type=int, default=20, help="number of trials per condition of the synthetic subject")
+    parser.add_argument("--work-dir", default=None, help="folder for the caches and outputs (a temporary folder by default)")
+    parser.add_argument("--output", default="precision_report.json", help="path of the json report")
+    args = parser.parse_args()
+
+    precision_report(args.epochs, n_trials_per_condition=args.n_trials, work_dir=args.work_dir, output=args.output)
@@ -0,0 +1,171 @@
+"""
+
+Benchmark suite of the pipeline stages on synthetic subjects (see synthetic_data.py): every stage is timed and memory-profiled
+at several dataset sizes, the results are written to a json file.
+
+Usage (from the Implementation folder):
+    python -m benchmarks.run_benchmarks --sizes 5 10 20 --output benchmark_results.json
+
+Every dataset size runs in a fresh process, so the peak memory of one size doesn't hide the peak memory of the next.
+The stage cache is disabled, every stage is computed.
+
+"""
+import os, sys, json, argparse, platform, tempfile
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules of the pipeline import both the src package and its subpackages
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from beartype import beartype
+
+
+@beartype
+def benchmark_size(n_trials_per_condition: int, n_oddball: int, work_dir: str, seed: int = 0) -> dict:
+    """
+    Recieves:
+    * n_trials_per_condition: number of trials of each condition of the synthetic subject.
+    * n_oddball: number of oddball trials.
+    * work_dir: folder the synthetic subject and the outputs of the stages are written to.
+    * seed: seed of the synthetic trials.
+
+    Function:
+    * Creates a synthetic subject and runs the stages of the pipeline on it in order, measuring each stage (see profiling.Profiler):
+      mat -> dict, dict -> epochs, mat (HDF5) -> epochs, write_epoch_cache, condition sums, combine_epochs, compute_csd (every condition from the epoch cache and the baseline),
+      compute_tfr_contrast (all config.tfr_contrasts), compute_psd and the report.
+
+    Returns:
+    * size_results: dictionary with the dataset size and the measurements per stage.
+
+    """
+    import numpy as np
+    import matplotlib
+    matplotlib.use("Agg")
+    import mne
+    from src import config, add_to_report
+    from mat_to_epochs_conversion import convert_main_funcs
+    from mat_to_epochs_conversion.combine_epochs import combine_epochs
+    from analyses import compute_csd, tfr_psd_analyses
+    from benchmarks import synthetic_data
+    from src import pipeline, profiling, epoch_cache
+
+    mne.set_log_level("ERROR")
+
+    subject_num = f"synthetic_{n_trials_per_condition}"
+    folder = os.path.join(work_dir, subject_num)
+
+    info = synthetic_data.create_synthetic_subject(folder, n_trials_per_condition, n_oddball, seed=seed)
+    mat_file = os.path.join(folder, "datafinalLow.mat")
+
+    os.chdir(folder)
+
+    # the stages are measured by the profiler of the pipeline (see profiling.py), with tracemalloc and without cProfile
+    profiler = profiling.Profiler(subject_num, trace_memory=True, cprofile_stages=[])
+
+    with profiler.stage("mat_to_dict"):
+        sub_dict = convert_main_funcs.convert_mat_to_dict(mat_file)
+
+    with profiler.stage("dict_to_epochs"):
+        epochs, _ = convert_main_funcs.convert_dict_to_epochs(sub_dict, info)
+    del sub_dict
+
+    with profiler.stage("mat_h5_to_epochs"):
+        epochs, evoked = convert_main_funcs.convert_mat_h5_to_epochs(mat_file, info)
+
+    with profiler.stage("write_epoch_cache"):
+        epoch_cache.write_epoch_cache(epochs)
+
+    with profiler.stage("compute_condition_sums"):
+        condition_sums = tfr_psd_analyses.compute_condition_sums(epochs)
+
+    with profiler.stage("combine_epochs"):
+        epochs_combined = combine_epochs(epochs, config.event_ids, config.new_event_ids)
+
+    # the csd stages of the pipeline: every condition from the mapped epoch cache, the baseline from the baseline csds of the conditions
+    with profiler.stage("compute_csd"):
+        epochs_cache = epoch_cache.EpochCache(combined=True)
+        baseline_parts, counts = {}, {}
+        for condition, code in epochs_cache.event_id.items():
+            _, baseline_parts[condition] = compute_csd.compute_csd_condition(epochs_cache, condition, config.freq_bands, config.post_stim_time,
+                                                                             config.baseline_time)
+            counts[condition] = int(np.sum(epochs_cache.events[:, 2] == code))
+        compute_csd.compute_baseline_csd(baseline_parts, counts, config.freq_bands)
+
+    freqs = pipeline.tfr_freqs
+
+    with profiler.stage("compute_tfr_contrast"):
+        tfr_coefs_cache = tfr_psd_analyses.create_tfr_coefs_cache(condition_sums, freqs)
+        for con1, con2 in config.tfr_contrasts:
+            tfr_psd_analyses.compute_tfr_contrast(None, freqs, con1, con2, condition_sums=condition_sums, tfr_coefs_cache=tfr_coefs_cache)
+
+    with profiler.stage("compute_psd"):
+        tfr_psd_analyses.compute_psd(evoked, config.freq_bands[0][0], config.freq_bands[-1][-1], config.baseline_time[0], config.post_stim_time[1],
+                                     'meg')
+
+    with profiler.stage("add_to_report"):
+        add_to_report.update_report(subject_num, incremental=False)
+
+    profiler.save()
+
+    stages = {measurements.pop("stage"): measurements for measurements in profiler.stages}
+
+    size_results = {"n_trials_per_condition": n_trials_per_condition, "n_oddball": n_oddball, "n_epochs": len(epochs),
+                    "data_bytes": int(np.prod(epochs.get_data(copy=False).shape)) * 8, "stages": stages}
+
+    return size_results
+
+
+@beartype
+def run_benchmarks(sizes: list[int], n_oddball: int = 20, work_dir: str | None = None, output: str = "benchmark_results.json") -> dict:
+    """
+    Recieves:
+    * sizes: list of the numbers of trials per condition to benchmark.
+    * n_oddball: number of oddball trials of every synthetic subject.
+    * work_dir: folder for the synthetic subjects, a temporary folder (deleted at the end) if None.
+    * output: path of the json results file.
+
+    Function:
+    * Benchmarks every size in a fresh process (see benchmark_size) and writes the results with a description of the environment.
+
+    Returns:
+    * results: the dictionary written to output.
+
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    import numpy as np
+    import mne
+
+    output = os.path.abspath(output)
+
+    results = {"environment": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+                               "numpy": np.__version__, "mne": mne.__version__},
+               "sizes": []}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = tmp_dir if work_dir is None else work_dir
+
+        for n_trials_per_condition in sizes:
+            print(f"Benchmarking {n_trials_per_condition} trials per condition")
+
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                results["sizes"].append(executor.submit(benchmark_size, n_trials_per_condition, n_oddball, work_dir).result())
+
+            # results of finished sizes are kept if a larger size fails
+            with open(output, "w") as f:
+                json.dump(results, f, indent=1)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic subjects")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 10, 20], help="numbers of trials per condition")
+    parser.add_argument("--n-oddball", type=int, default=20, help="number of oddball trials")
+    parser.add_argument("--work-dir", default=None, help="folder for the synthetic subjects (a temporary folder by default)")
+    parser.add_argument("--output", default="benchmark_results.json", help="path of the json results file")
+    args = parser.parse_args()
+
+    run_benchmarks(args.sizes, n_oddball=args.n_oddball, work_dir=args.work_dir, output=args.output)
@@ -0,0 +1,162 @@
+"""
+
+Synthetic MEG dataset in the shapes of the real data: a v. 7.3 mat file with a 'datafinalLow' struct (trial, trialinfo, label,
+fsample) as saved by FieldTrip, and a BTi-like mne.Info with 246 magnetometers on a helmet, so the whole pipeline can run
+(and be benchmarked) without the data of the lab.
+
+The trials are white noise plus an alpha oscillation and an evoked response that depends on the condition.
+
+"""
+import os
+import numpy as np
+import h5py
+import mne
+from beartype import beartype
+from src import config
+
+sfreq = 1017.25 # sampling frequency of the 4D-Neuroimaging recordings
+
+helmet_radius = 0.12 # m
+
+
+@beartype
+def create_bti_like_info(n_channels: int = config.channels_number, sfreq: float = sfreq) -> mne.Info:
+    """
+    Recieves:
+    * n_channels: number of magnetometers.
+    * sfreq: sampling frequency.
+
+    Function:
+    * Creates an info of magnetometers named as the BTi channels (A1, A2, ...), spread evenly on the upper half of a sphere
+      (a Fibonacci lattice) with their normals pointing outwards, as after dropping the bad and reference channels from the raw recording.
+
+    Returns:
+    * info: mne.Info instance with sensor locations.
+
+    """
+    from mne.io.constants import FIFF
+
+    info = mne.create_info([f"A{i+1}" for i in range(n_channels)], sfreq, 'mag')
+
+    # Fibonacci lattice on the upper hemisphere, the sensors of a helmet
+    i = np.arange(n_channels) + 0.5
+    z = 1 - i / n_channels
+    phi = np.pi * (1 + 5 ** 0.5) * i
+    normals = np.c_[np.sqrt(1 - z ** 2) * np.cos(phi), np.sqrt(1 - z ** 2) * np.sin(phi), z]
+
+    with info._unlock():
+        for ch, normal in zip(info['chs'], normals):
+            # the coil coordinate frame: ex, ey orthogonal to the normal ez
+            ex = np.cross([0, 0, 1], normal) if abs(normal[2]) < 1 else np.array([1., 0, 0])
+            ex /= np.linalg.norm(ex)
+            ey = np.cross(normal, ex)
+
+            ch['loc'][:3] = helmet_radius * normal
+            ch['loc'][3:12] = np.r_[ex, ey, normal]
+            ch['coil_type'] = FIFF.FIFFV_COIL_MAGNES_MAG
+
+        info['dev_head_t'] = mne.transforms.Transform('meg', 'head')
+
+    return info
+
+
+def _create_trial(rng: np.random.Generator, code: int, times: np.ndarray, n_channels: int) -> np.ndarray:
+    # one trial (time points, channels) in the layout matlab saves it: noise, alpha and a condition dependent evoked response
+    noise = rng.standard_normal((len(times), n_channels))
+
+    alpha = np.sin(2 * np.pi * 10 * times + rng.uniform(0, 2 * np.pi))[:, None] * rng.uniform(0.5, 1.5)
+
+    # latency and amplitude of the evoked response depend on the condition
+    latency = 0.1 + (code % 100) / 1000
+    evoked = (1 + code / 200) * np.exp(-((times - latency) / 0.03) ** 2)[:, None]
+
+    topography = np.cos(np.linspace(0, np.pi, n_channels))[None, :]
+
+    return 1e-13 * (noise + alpha + evoked * topography)
+
+
+@beartype
+def write_datafinallow(file_name: str|os.PathLike, n_trials_per_condition: int = 30, n_oddball: int = 20,
+                       n_channels: int = config.channels_number, n_times: int = config.time_points, sfreq: float = sfreq, seed: int = 0) -> np.ndarray:
+    """
+    Recieves:
+    * file_name: path of the mat file to write.
+    * n_trials_per_condition: number of trials of each of the conditions in config.event_ids.
+    * n_oddball: number of oddball trials (config.oddball_id).
+    * n_channels, n_times, sfreq: shape and sampling frequency of the trials.
+    * seed: seed of the random trials.
+
+    Function:
+    * Writes a v. 7.3 mat file (HDF5 with the matlab header) with the epoched data in a 'datafinalLow' struct as FieldTrip saves it:
+      trial is a cell array of (time points, channels) trials, trialinfo holds the condition codes in its first column,
+      label is a cell array of the channel names and fsample the sampling frequency. Trials are written one at a time.
+
+    Returns:
+    * events_code: ndarray of the condition code of every trial in the file (in the order of the trials).
+
+    """
+
+    rng = np.random.default_rng(seed)
+
+    events_code = np.array([code for code in config.event_ids.values() for _ in range(n_trials_per_condition)] + n_oddball * [config.oddball_id])
+    rng.shuffle(events_code)
+
+    times = config.baseline_time[0] + np.arange(n_times) / sfreq
+
+    def add_matlab_class(dataset, matlab_class):
+        dataset.attrs['MATLAB_class'] = np.bytes_(matlab_class)
+        return dataset
+
+    # matlab v. 7.3 files have a 512 bytes user block for the header
+    with h5py.File(file_name, 'w', userblock_size=512) as f:
+        struct = f.create_group('datafinalLow')
+        add_matlab_class(struct, 'struct')
+        refs = f.create_group('#refs#')
+
+        trial = add_matlab_class(struct.create_dataset('trial', (len(events_code), 1), dtype=h5py.ref_dtype), 'cell')
+        for i, code in enumerate(events_code):
+            trial[i, 0] = add_matlab_class(refs.create_dataset(f"trial_{i}", data=_create_trial(rng, code, times, n_channels)), 'double').ref
+
+        # trialinfo is saved transposed (columns, trials), the second column is the trial number
+        trialinfo = np.array([events_code, np.arange(1, len(events_code) + 1)], dtype=np.int32)
+        add_matlab_class(struct.create_dataset('trialinfo', data=trialinfo), 'int32')
+
+        label = add_matlab_class(struct.create_dataset('label', (n_channels, 1), dtype=h5py.ref_dtype), 'cell')
+        for i in range(n_channels):
+            name = np.array([ord(char) for char in f"A{i+1}"], dtype=np.uint16)[:, None]
+            label[i, 0] = add_matlab_class(refs.create_dataset(f"label_{i}", data=name), 'char').ref
+
+        add_matlab_class(struct.create_dataset('fsample', data=np.array([[sfreq]])), 'double')
+
+    with open(file_name, 'r+b') as f:
+        f.write(b'MATLAB 7.3 MAT-file, Platform: GLNXA64, Created by: synthetic_data.py'.ljust(116) + b'\x00' * 8 + b'\x00\x02IM')
+
+    return events_code
+
+
+@beartype
+def create_synthetic_subject(folder: str|os.PathLike, n_trials_per_condition: int = 30, n_oddball: int = 20, seed: int = 0) -> mne.Info:
+    """
+    Recieves:
+    * folder: the subject folder to create.
+    * n_trials_per_condition: number of trials of each of the conditions in config.event_ids.
+    * n_oddball: number of oddball trials.
+    * seed: seed of the random trials.
+
+    Function:
+    * Creates a subject folder with the mat file of the epoched data (datafinalLow.mat) and the sensor info (synthetic-info.fif)
+      that replaces the info read from the raw BTi recording (see create_info.extract_raw_info).
+
+    Returns:
+    * info: the BTi-like mne.Info of the subject.
+
+    """
+
+    os.makedirs(folder, exist_ok=True)
+
+    write_datafinallow(os.path.join(folder, "datafinalLow.mat"), n_trials_per_condition, n_oddball, seed=seed)
+
+    info = create_bti_like_info()
+    mne.io.write_info(os.path.join(folder, "synthetic-info.fif"), info)
+
+    return info
@@ -1,6 +1,8 @@
-# Define the __all__ variable
-__all__ = ["config", "add_to_report"]
+# The submodules are imported on first access (src.add_to_report loads mne and matplotlib), "from src import config" stays fast
+import lazy_loader as lazy
 
-# Import the submodules
-from . import config
-from . import add_to_report
\ No newline at end of file
+__getattr__, __dir__, __all__ = lazy.attach(
+    __name__,
+    submodules=["config", "add_to_report", "epoch_cache", "pipeline", "prefetch", "profiling", "resources", "scheduler", "shared_arrays",
+                "stage_cache", "topomap_engine"],
+)
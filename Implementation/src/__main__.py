@@ -6,6 +6,15 @@ Analyse epochs_combined data using CSD, TFR, GFP, PSD and topo plots.
 
 Subjects foldes must contain only one mat file that contains the epoched data and one raw MEG bti recording.
 
+Usage:
+    python -m src [--subjects SUBJECT ...] [--targets STAGE ...] [--dry-run] [--n-workers N] [--group | --group-only] [--stats]
+
+--subjects selects subject folders by name, --targets runs only the given stages (or kinds of stages, e.g. compute_csd or 
+add_to_report/psd) and the stages they depend on, --dry-run prints the stages that would run for every subject (see pipeline.py).
+--group computes the grand averages and standard errors over the subjects after the run (see analyses/group_average.py),
+--group-only computes them from the saved outputs of the subjects without running their stages.
+--stats runs the cluster permutation tests of the TFR contrasts over the subjects (see analyses/cluster_statistics.py).
+
 """
 """importations of libraries"""
 
@@ -14,7 +23,7 @@ if __name__ == "__main__":
     print("Start of script run")
 
     try:
-        import mne, glob, warnings, traceback, sys, os
+        import glob, traceback, sys, os, argparse
         
         package_path = "c:/Projects/Data_Science_Project/Implementation"
         if os.path.exists(package_path):
@@ -24,18 +33,22 @@ if __name__ == "__main__":
             raise FileNotFoundError(f"The path {package_path} doesn't exist")
 
 
-        import numpy as np
-        from mne.time_frequency import csd_morlet, read_spectrum, read_csd, read_tfrs
-        from pymatreader import read_mat
-        from src import config
-        from mat_to_epochs_conversion import convert_main_funcs, combine_epochs, create_info # using * didn't work for some reason
-        from analyses import compute_csd, tfr_psd_analyses
-        import add_to_report
-        from tests import output_tests, input_validation_tests
+        from src import config, scheduler
     
     except Exception as e:
         print("problem with modules importation in __main__.py", e)
 
+    parser = argparse.ArgumentParser(description="Run the pipeline stages on the subject folders")
+    parser.add_argument("--subjects", nargs="+", default=None, help="names of the subject folders to process (all subject folders by default)")
+    parser.add_argument("--targets", nargs="+", default=None, 
+                        help="stages to run with the stages they depend on, a stage (e.g. compute_csd/food_1) or a kind of stages (e.g. compute_csd)")
+    parser.add_argument("--dry-run", action="store_true", help="print the stages that would run without running them")
+    parser.add_argument("--n-workers", type=int, default=None, help="number of subjects processed in parallel (n_workers in config.py by default)")
+    parser.add_argument("--group", action="store_true", help="compute the group averages over the subjects after the run")
+    parser.add_argument("--group-only", action="store_true", help="compute the group averages from the saved outputs without running the subjects")
+    parser.add_argument("--stats", action="store_true", help="run the cluster permutation tests of the TFR contrasts over the subjects")
+    args = parser.parse_args()
+
     try:
 
         if not os.path.exists(config.subs_directory):
@@ -43,84 +56,36 @@ if __name__ == "__main__":
 
         directory_pattern = config.subject_directory_pattern # directory pattern for itterating over subject folders
 
+        # all subjects folders, every subject is processed by a worker process of the scheduler
+        folders = [folder for folder in glob.iglob(directory_pattern)]
 
-        
-        # itterate over all subjects folders
-        for folder in glob.iglob(directory_pattern): 
-
-
-            if os.path.exists(folder): # the subject folder that contains the mat file with epoched data and the raw MEG recordings per subject
-
-                try:  
-                    
-                    # extract subject number from the name of the folder:
-                    subject_num = folder.split("SUBS_DIR\\", 1)[1]
-
-
-                    os.chdir(folder)
-
-                    raw_info = create_info.extract_raw_info(folder)
-                    output_tests.test_raw_info(raw_info)
-
-                    
-                    # recieves a file path to the mat file, glob.glob returns a list of all paths found with the pattern.
-                    # [0] for returning the first and only element in the list.
-                    epochs, evoked = convert_main_funcs.convert_mat_to_epochs(glob.glob(config.mat_file_path_pattern)[0], mne_info=raw_info) 
-                    
-                    # combine epochs by new conditions (new_event_ids):
-                    epochs_combined = combine_epochs(epochs, config.event_ids, config.new_event_ids)
-                    output_tests.test_epochs_combined(epochs_combined)
-
-                    # extract conditions for csd cmputation per condition:
-                    conditions =  list(epochs_combined.event_id.keys())
-
-                    # Suppress warning about wavelet length.
-
-                    for condition in conditions:
-
-                        # csd calculation post stimulus over the desired frequency range per condition, save and add to report
-                        csd, csd_mean = compute_csd.compute_csd(epochs_combined, config.freq_bands, config.post_stim_time, condition=condition) 
-                        output_tests.test_csd(csd)
-                        output_tests.test_csd(csd_mean)
-
-                    # csd calculation of baseline over the desired frequency range, save and add to report. (calculates csd baseline for the last 
-                    # condition in loop, we assume that all conditions have same baseline activity)
-                    csd_baseline, csd_baseline_mean = compute_csd.compute_csd(epochs, config.freq_bands, config.baseline_time)
-                    output_tests.test_csd(csd_baseline)
-                    output_tests.test_csd(csd_baseline_mean)
-                    
-                    # compute tfrs for desired contrast of conditions, over the frequencies in freqs and save:
-                    freqs = np.arange(8, 24, 2)
-                    
-                    tfr_pres = tfr_psd_analyses.compute_tfr_contrast(epochs=epochs, freqs=freqs, con1=('pres_1', config.pres_1), 
-                    con2=('pres_2', config.pres_2))
-                    output_tests.test_tfr(tfr_pres, freqs)
+        if args.subjects is not None:
+            missing = set(args.subjects) - {os.path.basename(os.path.normpath(folder)) for folder in folders}
+            if missing:
+                raise FileNotFoundError(f"No subject folders named {', '.join(sorted(missing))} in {config.subs_directory}")
 
+            folders = [folder for folder in folders if os.path.basename(os.path.normpath(folder)) in args.subjects]
 
-                    tfr_food = tfr_psd_analyses.compute_tfr_contrast(epochs=epochs,  freqs=freqs, con1=('food',config.food), 
-                    con2=('nonfood',config.nonfood))
-                    output_tests.test_tfr(tfr_food, freqs)
+        n_workers = config.n_workers if args.n_workers is None else args.n_workers
 
-                    # compute psd (power spectral density) over the desired frequencies, times and channels:
-                    psd =  tfr_psd_analyses.compute_psd(evoked_instance=evoked, fmin=config.freq_bands[0][0], fmax=config.freq_bands[-1][-1], tmin=config.baseline_time[0], tmax=config.post_stim_time[1], picks='meg')
-                    output_tests.test_psd(psd)
+        if not args.group_only:
+            # a dry run prints the stages of the subjects in order
+            run_summary = scheduler.run_subjects(folders, n_workers=1 if args.dry_run else n_workers, targets=args.targets, dry_run=args.dry_run)
 
-                    report = mne.Report(title=f"report for {subject_num}")
-                    
-                    # add plots of the above computations to a report of the subject:
-                    add_to_report.add_to_report(report, subject_num)
+            scheduler.print_run_summary(run_summary)
 
-                    # save the report with added plots to h5 (if the report needs to be changed later) and to html (for report viewing):
-                    report.save(config.h5_report_path, overwrite=True)
-                    report.save(config.html_report_path, overwrite=True)
+        if (args.group or args.group_only) and not args.dry_run:
+            from analyses import group_average
 
-                except Exception as e:
-                    print("An error occured:", e)
-                    traceback.print_exc()
+            # the subjects are streamed one at a time, see group_average.compute_group_averages
+            group_summary = group_average.compute_group_averages(sorted(folders))
+            print(f"Group averages of {len(group_summary)} outputs written to {config.group_directory}")
 
+        if args.stats and not args.dry_run:
+            from analyses import cluster_statistics
 
-            else:
-                raise FileNotFoundError(f"The path {folder} doesn't exist")
+            cluster_summary = cluster_statistics.compute_cluster_statistics(sorted(folders))
+            print(f"Cluster tests of {len(cluster_summary)} TFR contrasts written to {config.group_directory}")
 
     except Exception as e:
         print("An error occured:", e)
@@ -1,79 +1,343 @@
+import os, sys
 import mne
-from mne.time_frequency import read_csd, read_spectrum, read_tfrs
+from mne.time_frequency import read_spectrum, read_tfrs
 import glob
-from src import config
+from src import config, profiling, resources, stage_cache, topomap_engine, epoch_cache
 import numpy as np
-import matplotlib.pyplot as plt
+from functools import lru_cache
 from beartype import beartype
 
+# same resolution limits as mne.Report.add_figure
+max_img_width = 850 # pixels
+max_img_res = 100 # dots per inch
+
+
+def _read(reader: str, file: str):
+    # every version of a file (its modification time and size) is read once per rendering process and shared by all figures 
+    # plotted from it (e.g. all topo-plots of a contrast), a file changed since it was read (incremental updates) is read again
+    stat = os.stat(file)
+    return _read_version(reader, file, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=8)
+def _read_version(reader: str, file: str, mtime_ns: int, size: int):
+    if reader == 'spectrum':
+        return read_spectrum(file)
+    if reader == 'csd':
+        # the full csds of mne or the pair-subset csds (see analyses/pair_csd.py), both plot with mode 'csd' and 'coh'
+        from analyses.pair_csd import read_csd
+        return read_csd(file)
+    if reader == 'evoked':
+        return mne.read_evokeds(file)[0]
+    if reader == 'tfr':
+        return read_tfrs(file)
+    raise ValueError(f"unknown reader {reader}")
+
+
+def _plot_figure(figure_spec: dict):
+    # create the matplotlib figure of figure_spec
+    inst = _read(figure_spec['reader'], figure_spec['file'])
+
+    if figure_spec['plot'] == 'topomap':
+        # values are precomputed (see topomap_engine.compute_topomap_tensor), only the interpolation of the layout of inst is needed
+        return topomap_engine.plot_topomap(topomap_engine.get_topomap_interpolator(inst.info), **figure_spec['kwargs'])
+
+    fig = getattr(inst, figure_spec['plot'])(show=False, **figure_spec['kwargs'])
+
+    # csd plots return a list with a single figure
+    if isinstance(fig, list):
+        fig = fig[0]
+
+    return fig
+
+
+def _init_render_worker(cprofile_stage: str | None = None):
+    # render without a display in the worker processes, profile the rendering if the stage is profiled (see profiling.py)
+    import matplotlib
+    matplotlib.use('Agg')
+
+    if cprofile_stage is not None:
+        profiling.enable_worker_cprofile(cprofile_stage)
+
+
+def render_figure(figure_spec: dict) -> bytes:
+    """
+    Recieves:
+    * figure_spec: dictionary of a figure (see create_figure_specs).
+
+    Function:
+    * Plots the figure and renders it to PNG, in the resolution mne.Report.add_figure would use.
+
+    Returns:
+    * png: bytes of the PNG image.
+
+    """
+    from io import BytesIO
+    import matplotlib.pyplot as plt
+
+    with profiling.worker_cprofile():
+        fig = _plot_figure(figure_spec)
+
+        dpi = min(fig.get_dpi(), max_img_width / fig.get_size_inches()[0], max_img_res)
+
+        png = BytesIO()
+        fig.savefig(png, format='png', dpi=dpi, facecolor='white')
+        plt.close('all')
+
+    return png.getvalue()
+
+
 @beartype
-def add_to_report(report: mne.Report, subject_num: str):
+def create_figure_specs(subject_num: str, sections: list[str] | None = None) -> list[dict]:
+    """
+    Recieves:
+    * subject_num: the name of the subject folder, used for the report sections.
+    * sections: list of keys of config.get_report_sections (e.g. 'psd', 'csd'), only the figures of these sections are listed
+      and only their files are read (None for all sections).
+
+    Function:
+    * Lists every figure of the report of the subject, in the order of the report, from the analyses results saved in the current directory.
+      A figure spec is a picklable dictionary: the reader and file of the plotted instance, the plot method and its keyword arguments,
+      the title and the section of the figure in the report.
+
+    Returns:
+    * figure_specs: list of figure specs.
+
+    """
+
+    # keys of the listed sections
+    selected = list(config.get_report_sections(subject_num=subject_num).keys()) if sections is None else sections
 
+    sections = config.get_report_sections(subject_num=subject_num)
 
-    epochs_combined = mne.read_epochs(glob.glob("*combined_epo.fif")[0])
-    
-    evoked  = mne.read_evokeds(glob.glob("*evo.fif")[0])[0]
-    
-    #plot power spectral density (computed for evoked - average of all conditions): 
-    psd = read_spectrum(config.psd_path)
+    figure_specs = []
 
-    report.add_figure(psd.plot(show=False), title=config.get_report_titles()['psd'], section=config.get_report_sections(subject_num=subject_num)['psd'], replace=True)
+    def add_spec(reader, file, plot, report_title, report_section, **kwargs):
+        if report_section not in [sections[key] for key in selected]:
+            return
+
+        figure_specs.append({'reader': reader, 'file': os.path.abspath(file), 'plot': plot, 'kwargs': kwargs, 
+                             'title': report_title, 'section': report_section})
+
+    #plot power spectral density (computed for evoked - average of all conditions):
+    add_spec('spectrum', config.psd_path, 'plot', config.get_report_titles()['psd'], sections['psd'])
 
     #plot csds (computed for epochs_combined[condition]):
-    for condition in list(epochs_combined.event_id.keys())+ ['baseline']:    
-        csd = read_csd(config.get_csd_path(condition))
+    if 'csd' in selected or 'coherence' in selected:
+        # only the conditions are needed, the trials aren't read (from the epoch cache if it was written, see epoch_cache.py)
+        if os.path.exists(epoch_cache.get_cache_files()[-1]):
+            conditions = list(epoch_cache.EpochCache(combined=True).event_id.keys())
+        else:
+            conditions = list(mne.read_epochs(glob.glob("*combined_epo.fif")[0], preload=False).event_id.keys())
+    else:
+        conditions = []
 
-        csd_mean = read_csd(config.get_csd_mean_path(condition))
+    for condition in conditions + ['baseline']:
+        titles = config.get_report_titles(condition=condition)
 
         # for csd per frequency
-        report.add_figure(csd.plot(show=False), title= config.get_report_titles(condition=condition)['csd'], section=config.get_report_sections(subject_num=subject_num)['csd'], replace=True)
+        add_spec('csd', config.get_csd_path(condition), 'plot', titles['csd'], sections['csd'])
 
         # for csd mean over frequency bands
-        report.add_figure(csd_mean.plot(show=False), title= config.get_report_titles(condition=condition)['csd_mean'], section=config.get_report_sections(subject_num=subject_num)['csd'], replace=True)
+        add_spec('csd', config.get_csd_mean_path(condition), 'plot', titles['csd_mean'], sections['csd'])
 
         # in coherence mode
-        report.add_figure(csd_mean.plot(mode='coh', show=False), title= config.get_report_titles(condition=condition)['coherence'], section=config.get_report_sections(subject_num=subject_num)['coherence'], replace=True)
-
-        plt.close('all')
+        add_spec('csd', config.get_csd_mean_path(condition), 'plot', titles['coherence'], sections['coherence'], mode='coh')
 
     #plot global field power for evoked instance (for all conditions):
-    report.add_figure(evoked.plot_image(titles=f"Global Field Power for a single subject", show=False),title=config.get_report_titles()['gfp'], 
-    section=config.get_report_sections(subject_num=subject_num)['gfp'], replace=True)
-    plt.close('all')
+    if 'gfp' in selected:
+        add_spec('evoked', glob.glob("*evo.fif")[0], 'plot_image', config.get_report_titles()['gfp'], sections['gfp'],
+                 titles=f"Global Field Power for a single subject")
 
    #plot tfr contrast computed per contrast (evoked[condition_1] - evoked[condition_2]):
-    for file in glob.glob("*tfr*.h5"):
-        
-        tfr_contrast = read_tfrs(file)
-        contrast = file.split('evoked_tfr_')[1].split('.h5')[0] # get the name of the contrast for the specific tfr computed
+    # the evoked contrasts of config.tfr_contrasts that were computed, the induced power and ITC contrasts (see analyses/induced_power.py) 
+    # have other time points and aren't in the report
+    tfr_files = {f"{con1[0]}-{con2[0]}": config.get_tfr_contrast_path(con1, con2) for con1, con2 in config.tfr_contrasts}
+    tfr_files = {contrast: file for contrast, file in tfr_files.items() if os.path.exists(file)} \
+        if 'tfr_contrast' in selected or 'tfr_contrast_topoplots' in selected else {}
 
-        # plot the tfr contrast for all frequencies in the tfr computation
-        report.add_figure(tfr_contrast.plot(combine='mean', baseline=config.baseline_time, title=f"Contrast ({contrast})", show=False),
-        title= config.get_report_titles(contrast=contrast)['tfr_contrast'], section=config.get_report_sections(subject_num=subject_num)['tfr_contrast'], replace=True)
-        plt.close('all')
+    if not tfr_files:
+        return figure_specs
 
-        freqs = tfr_contrast.freqs #extract the frequencies the tfr was computed for
+    if 'tfr_contrast_topoplots' in selected:
+        tfr_contrasts = [read_tfrs(file) for file in tfr_files.values()]
 
-        freq_bands = np.arange(freqs[0], freqs[-1]+1, 4) # create an np.ndarry of the frequency ranges we'd like to see the topo-plot for
+        freq_bands = topomap_engine.get_topomap_bands(tfr_contrasts[0].freqs) # the frequency ranges we'd like to see the topo-plot for
 
-        
-        #plot topo-plots of tfr specific contrast per time range and frequency band:
-        for time_range in config.time_frames:
+        # values of all topo-plots of all contrasts: (contrasts, time frames, frequency bands, channels)
+        topomap_tensor = topomap_engine.compute_topomap_tensor(tfr_contrasts, config.time_frames, freq_bands, baseline=config.baseline_time)
+
+    else:
+        freq_bands = [] # no topo-plots are listed, the TFRs aren't read
+
+    for c, (contrast, file) in enumerate(tfr_files.items()):
 
-            for i,freq in enumerate(freq_bands):
-                
-                # if reached to last frequency in numpy array -> no more fmin-fmax pairs to go over 
-                if i == len(freq_bands)-1:
-                    break
+        # plot the tfr contrast for all frequencies in the tfr computation
+        add_spec('tfr', file, 'plot', config.get_report_titles(contrast=contrast)['tfr_contrast'], sections['tfr_contrast'],
+                 combine='mean', baseline=config.baseline_time, title=f"Contrast ({contrast})")
 
-                fmin, fmax = freq, freq_bands[i+1] # the frequency range to plot topo-plot
+        #plot topo-plots of tfr specific contrast per time range and frequency band:
+        for k, (tmin, tmax) in enumerate(config.time_frames):
 
-                tmin, tmax = time_range[0], time_range[1] # the time range for tipo-plot plotting
+            for b, (fmin, fmax) in enumerate(freq_bands):
 
                 print(f"Creating a topoplot for the parameters: contrat - {contrast}, frequency range - {fmin}-{fmax}, \n time range - {tmin}-{tmax}")
 
-                #plotting topo plot
-                report.add_figure(tfr_contrast.plot_topomap(size=8, mode='mean', fmin=fmin, fmax=fmax, tmin=tmin, tmax=tmax, baseline=config.baseline_time, show=False), 
-                title=config.get_report_titles(contrast=contrast, fmin=fmin, fmax=fmax, tmin=tmin, tmax=tmax)['tfr_contrast_topoplots'], section=config.get_report_sections(subject_num=subject_num)['tfr_contrast_topoplots'], replace=True)
-                plt.close('all')
+                add_spec('tfr', file, 'topomap',
+                         config.get_report_titles(contrast=contrast, fmin=fmin, fmax=fmax, tmin=tmin, tmax=tmax)['tfr_contrast_topoplots'],
+                         sections['tfr_contrast_topoplots'], values=topomap_tensor[c, k, b], size=8)
+
+    return figure_specs
+
+
+@beartype
+def render_figures(figure_specs: list[dict], n_jobs: int | None = config.report_n_jobs) -> list[bytes]:
+    """
+    Recieves:
+    * figure_specs: list of figure specs (see create_figure_specs).
+    * n_jobs: int, number of rendering processes (1 renders in the current process), None (or -1) for the workers of the stage
+      in the resource plan (see resources.py).
+
+    Function:
+    * Renders the figures to PNG in a pool of processes on the Agg backend. Consecutive figures of the same file are sent
+      to the same process in chunks, so each file is mostly read once per process.
+
+    Returns:
+    * pngs: list of PNG bytes in the order of figure_specs.
+
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    n_jobs = resources.get_n_jobs(n_jobs)
+
+    if n_jobs < 1:
+        raise ValueError(f"n_jobs must be a positive integer, got {n_jobs}")
+
+    if n_jobs == 1 or len(figure_specs) <= 1:
+        return [render_figure(figure_spec) for figure_spec in figure_specs]
+
+    n_jobs = min(n_jobs, len(figure_specs))
+    chunksize = max(1, len(figure_specs) // (4 * n_jobs))
+
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_render_worker, initargs=(profiling.get_active_cprofile_stage(),)) as executor:
+        pngs = list(executor.map(render_figure, figure_specs, chunksize=chunksize))
+
+    return pngs
+
+
+@beartype
+def add_figures(report: mne.Report, figure_specs: list[dict], n_jobs: int | None = config.report_n_jobs):
+    """
+    Recieves:
+    * report: mne.Report instance to add the figures to.
+    * figure_specs: list of figure specs (see create_figure_specs).
+    * n_jobs: int, number of processes rendering the figures (see render_figures).
+
+    Function:
+    * Renders the figures in parallel and adds them to the report in order by the current process, 
+      a figure with the title and section of an existing figure replaces it.
+
+    """
+    import tempfile
+
+    pngs = render_figures(figure_specs, n_jobs=n_jobs)
+
+    with tempfile.TemporaryDirectory() as png_dir:
+
+        for i, (figure_spec, png) in enumerate(zip(figure_specs, pngs)):
+            png_path = os.path.join(png_dir, f"figure_{i}.png")
+
+            with open(png_path, 'wb') as f:
+                f.write(png)
+
+            # the image is embedded in the report, the file isn't needed after adding it
+            report.add_image(png_path, title=figure_spec['title'], tags=('custom-figure',), section=figure_spec['section'], replace=True)
+
+
+@beartype
+def add_to_report(report: mne.Report, subject_num: str, n_jobs: int | None = config.report_n_jobs):
+    """
+    Recieves:
+    * report: mne.Report instance to add the figures to.
+    * subject_num: the name of the subject folder, used for the report sections.
+    * n_jobs: int, number of processes rendering the figures (see render_figures).
+
+    Function:
+    * Adds the PSD, CSD, coherence, GFP, TFR contrast and topo-plot figures of the subject to the report. The figures are listed
+      first (create_figure_specs), rendered in parallel (render_figures) and added to the report in order by the current process.
+
+    """
+
+    add_figures(report, create_figure_specs(subject_num), n_jobs=n_jobs)
+
+
+def _figure_stage(figure_spec: dict) -> str:
+    # name of the figure in the stage cache
+    return f"report_figure/{figure_spec['section']}/{figure_spec['title']}"
+
+
+def _figure_fingerprint(figure_spec: dict) -> str:
+    # the figure changes only if the file it is plotted from, its plot parameters or the plotting code change
+    return stage_cache.fingerprint(input_files=[figure_spec['file']], 
+        params={key: value for key, value in figure_spec.items() if key != 'file'}, 
+        modules=[sys.modules[__name__], topomap_engine])
+
+
+@beartype
+def update_report(subject_num: str, n_jobs: int | None = config.report_n_jobs, incremental: bool = config.incremental_report, 
+                  sections: list[str] | None = None) -> mne.Report:
+    """
+    Recieves:
+    * subject_num: the name of the subject folder, used for the report title and sections.
+    * n_jobs: int, number of processes rendering the figures (see render_figures).
+    * incremental: bool, if the report of a previous run was saved (config.h5_report_path), it is reloaded and only the figures
+      whose inputs (CSD, TFR, PSD or evoked file, plot parameters or plotting code) changed since it was saved are rendered again.
+    * sections: list of keys of config.get_report_sections, only the figures of these sections are updated, the other
+      figures of a reloaded report are kept (None for all sections, see create_figure_specs).
+
+    Function:
+    * Creates or updates the report of the subject with all figures (see add_to_report) and saves it to h5 (if the report needs 
+      to be changed later) and to html (for report viewing). The fingerprints of the figures are recorded in the stage cache 
+      together with the saved report files, a report changed or deleted outside of the pipeline is rebuilt from scratch.
+
+    Returns:
+    * report: the saved mne.Report instance.
+
+    """
+
+    figure_specs = create_figure_specs(subject_num, sections)
+    figure_fingerprints = [_figure_fingerprint(figure_spec) for figure_spec in figure_specs]
+
+    output_files = [config.h5_report_path, config.html_report_path]
+
+    if incremental and os.path.exists(config.h5_report_path):
+        report = mne.open_report(config.h5_report_path)
+
+        changed_specs = [figure_spec for figure_spec, figure_fingerprint in zip(figure_specs, figure_fingerprints) 
+                         if not stage_cache.is_fresh(_figure_stage(figure_spec), figure_fingerprint, output_files)]
+
+        print(f"{len(changed_specs)}/{len(figure_specs)} report figures of {subject_num} changed since the last saved report")
+
+        if not changed_specs:
+            return report
+
+    else:
+        report = mne.Report(title=f"report for {subject_num}")
+        changed_specs = figure_specs
+
+    # figures of the other sections that are up to date in the reloaded report, they stay up to date in the saved report
+    kept_figures = stage_cache.fresh_records("report_figure/", output_files) if incremental and sections is not None else {}
+
+    add_figures(report, changed_specs, n_jobs=n_jobs)
+
+    report.save(config.h5_report_path, overwrite=True)
+    report.save(config.html_report_path, overwrite=True)
+
+    # all figures of the sections are in the saved report now
+    for figure_stage, figure_fingerprint in kept_figures.items():
+        stage_cache.record(figure_stage, figure_fingerprint, output_files)
+
+    for figure_spec, figure_fingerprint in zip(figure_specs, figure_fingerprints):
+        stage_cache.record(_figure_stage(figure_spec), figure_fingerprint, output_files)
 
+    return report
@@ -1,6 +1,7 @@
-# Define the __all__ variable
-__all__ = ["compute_csd", "tfr_psd_analyses"]
+# The submodules are imported on first access, they load mne
+import lazy_loader as lazy
 
-# Import the submodules
-from . import compute_csd
-from . import tfr_psd_analyses
\ No newline at end of file
+__getattr__, __dir__, __all__ = lazy.attach(
+    __name__,
+    submodules=["cluster_statistics", "compute_csd", "group_average", "induced_power", "pair_csd", "precision", "tfr_psd_analyses"],
+)
@@ -0,0 +1,290 @@
+import os, json
+import traceback
+import numpy as np
+import mne
+from beartype import beartype
+from numpy.typing import NDArray
+from src import config, shared_arrays, resources
+
+# data of the permutation workers, set once per process by _init_permutation_worker
+_worker_data = {}
+
+
+def _t_values(signs: NDArray, data: NDArray, sum_squares: NDArray) -> NDArray:
+    # one sample t-values of the sign flipped subjects for a batch of sign vectors (permutations, subjects) in a single matrix product,
+    # the sum of squares of the subjects doesn't change with the signs
+    n_subjects = data.shape[0]
+    means = signs @ data / n_subjects
+    variances = (sum_squares / n_subjects - means ** 2) * n_subjects / (n_subjects - 1)
+    return means / np.sqrt(variances / n_subjects)
+
+
+def _find_clusters(t_values: NDArray, threshold: float, adjacency) -> list[tuple[NDArray, float]]:
+    # clusters of neighbouring points (adjacency) with t-values above threshold (positive clusters) or below -threshold (negative
+    # clusters), as (indices of the points, sum of the t-values of the cluster)
+    from scipy.sparse.csgraph import connected_components
+
+    clusters = []
+
+    for sign in (1, -1):
+        indices = np.flatnonzero(sign * t_values > threshold)
+
+        if len(indices) == 0:
+            continue
+
+        n_clusters, labels = connected_components(adjacency[indices][:, indices], directed=False)
+        masses = np.bincount(labels, weights=t_values[indices], minlength=n_clusters)
+        order = np.argsort(labels, kind='stable')
+        splits = np.cumsum(np.bincount(labels, minlength=n_clusters))[:-1]
+
+        clusters.extend(zip(np.split(indices[order], splits), masses))
+
+    return clusters
+
+
+def _init_permutation_worker(data: NDArray, sum_squares: NDArray, adjacency, threshold: float):
+    _worker_data.update(data=data, sum_squares=sum_squares, adjacency=adjacency, threshold=threshold)
+
+
+def _init_shared_permutation_worker(data_handle: dict, sum_squares: NDArray, adjacency, threshold: float, blas_threads: int):
+    # the data of the subjects is attached by name (see shared_arrays.py) instead of pickled to every worker, 
+    # the BLAS threads of the worker are limited by the resource plan (see resources.py)
+    from threadpoolctl import threadpool_limits
+
+    _worker_data.update(thread_limits=threadpool_limits(limits=blas_threads))
+    _init_permutation_worker(shared_arrays.attach(data_handle), sum_squares, adjacency, threshold)
+
+
+def _permutation_batch(seed_sequence: np.random.SeedSequence, n_permutations: int) -> NDArray:
+    # largest absolute cluster mass of every permutation of the batch, the signs are drawn from the seed of the batch
+    data, sum_squares = _worker_data["data"], _worker_data["sum_squares"]
+
+    signs = np.random.default_rng(seed_sequence).choice([-1.0, 1.0], size=(n_permutations, data.shape[0]))
+    t_values = _t_values(signs, data, sum_squares)
+
+    max_masses = np.zeros(n_permutations)
+    for i, permutation_t_values in enumerate(t_values):
+        masses = [abs(mass) for _, mass in _find_clusters(permutation_t_values, _worker_data["threshold"], _worker_data["adjacency"])]
+        max_masses[i] = max(masses, default=0.0)
+
+    return max_masses
+
+
+@beartype
+def load_contrast_data(folders: list[str], tfr_file: str, baseline: tuple[float, float] = config.baseline_time,
+                       time_range: tuple[float, float] = config.post_stim_time, decim: int = config.cluster_decim,
+                       mode: str = config.cluster_baseline_mode) -> tuple:
+    """
+    Recieves:
+    * folders: list of the subject folders.
+    * tfr_file: the TFR contrast file of the subjects (see config.get_tfr_contrast_path).
+    * baseline: the baseline of the TFRs, corrected with mode (the correction of the TFR plots of the report).
+    * time_range: the time range of the test, the TFRs are cropped to it after the baseline correction.
+    * decim: only every decim-th time point is kept.
+    * mode: the mode of the baseline correction (see mne.time_frequency.AverageTFR.apply_baseline).
+
+    Function:
+    * Reads the TFR contrasts of the subjects one at a time into a single array (only the kept points are held). A subject missing
+      the file, or with channels or frequencies that differ from the first subject, is left out (and reported).
+
+    Returns:
+    * data: ndarray (subjects, channels, freqs, time points) of the baseline corrected TFRs.
+    * template: the AverageTFR of the first subject (cropped and decimated), holds the channels, frequencies and times of data.
+    * subjects: the names of the subject folders of data.
+
+    """
+    from mne.time_frequency import read_tfrs
+
+    subject_data, subjects, template = [], [], None
+
+    for folder in folders:
+        subject_num = os.path.basename(os.path.normpath(folder))
+        file = os.path.join(folder, tfr_file)
+
+        if not os.path.exists(file):
+            print(f"{subject_num}: {tfr_file} is missing, the subject is left out of the test")
+            continue
+
+        tfr = read_tfrs(file)
+        tfr = tfr[0] if isinstance(tfr, list) else tfr
+        tfr = tfr.apply_baseline(baseline, mode=mode).crop(*time_range).decimate(decim)
+
+        if template is None:
+            template = tfr
+
+        elif tfr.ch_names != template.ch_names or not np.array_equal(tfr.freqs, template.freqs) or tfr.data.shape != template.data.shape:
+            print(f"{subject_num}: the channels, frequencies or times of {tfr_file} differ from the first subject, the subject is left out of the test")
+            continue
+
+        subject_data.append(tfr.data)
+        subjects.append(subject_num)
+
+    if template is None:
+        raise FileNotFoundError(f"No subject has {tfr_file}")
+
+    return np.stack(subject_data), template, subjects
+
+
+@beartype
+def get_adjacency(info: mne.Info, ch_names: list[str], n_freqs: int, n_times: int):
+    """
+    Recieves:
+    * info: mne.Info with the sensor positions (the raw info of a subject, see create_info.extract_raw_info).
+    * ch_names: the channels of the data, in their order.
+    * n_freqs, n_times: number of frequencies and time points of the data.
+
+    Returns:
+    * adjacency: sparse adjacency matrix of the points (channels x freqs x time points, raveled in this order): neighbouring sensors
+      (mne.channels.find_ch_adjacency) at the same frequency and time, and neighbouring frequencies and time points of a sensor.
+
+    """
+    info = mne.pick_info(info, mne.pick_channels(info.ch_names, ch_names, ordered=True))
+    ch_adjacency, _ = mne.channels.find_ch_adjacency(info, ch_type='mag')
+
+    return mne.stats.combine_adjacency(ch_adjacency, n_freqs, n_times).tocsr()
+
+
+@beartype
+def cluster_permutation_test(data: NDArray, adjacency, n_permutations: int = config.cluster_n_permutations,
+                             p_threshold: float = config.cluster_p_threshold, seed: int = config.cluster_seed,
+                             n_jobs: int | None = config.cluster_n_jobs, batch_size: int = config.cluster_batch_size) -> dict:
+    """
+    Recieves:
+    * data: ndarray (subjects, ...) of the values of the subjects (e.g. baseline corrected TFR contrasts), tested against 0.
+    * adjacency: sparse adjacency of the points of a subject (data.shape[1:] raveled, see get_adjacency).
+    * n_permutations: number of sign flip permutations.
+    * p_threshold: two tailed p-value of the t-value threshold of the clusters (t distribution with subjects - 1 degrees of freedom).
+    * seed: seed of the permutations, the results depend only on seed and batch_size (not on n_jobs).
+    * n_jobs: number of worker processes of the permutations (1 computes them in this process), None for the cores of the resource plan
+      (see resources.get_n_jobs, the workers run single-threaded BLAS).
+    * batch_size: number of permutations computed by a single matrix product.
+
+    Function:
+    * Sign flip cluster permutation test (one sample, two tailed, cluster mass): the t-values of the subjects are thresholded, neighbouring
+      points above the threshold form clusters and the mass of a cluster is the sum of its t-values. For every permutation the signs
+      of the subjects are flipped at random and the largest absolute cluster mass is kept; the p-value of an observed cluster is the
+      proportion of the permutations (with the observed one) with a larger mass. The t-values of a batch of permutations are a single
+      matrix product of the signs and the data, the batches are computed in a process pool, each from its own seed
+      (spawned from seed). The workers attach to the data by name (see shared_arrays.py), it isn't copied to every worker.
+
+    Returns:
+    * results: dictionary with 't_obs' (ndarray of data.shape[1:]), 'clusters' (list of index arrays of the raveled points),
+      'cluster_masses', 'cluster_p_values', 'threshold' and 'null_distribution' (largest absolute cluster mass of every permutation).
+
+    """
+    from scipy import stats
+
+    n_subjects, shape = data.shape[0], data.shape[1:]
+    data = data.reshape(n_subjects, -1).astype(np.float64)
+    sum_squares = np.sum(data ** 2, axis=0)
+
+    threshold = float(stats.t.ppf(1 - p_threshold / 2, n_subjects - 1))
+
+    t_obs = _t_values(np.ones((1, n_subjects)), data, sum_squares)[0]
+    observed = _find_clusters(t_obs, threshold, adjacency)
+
+    # the seed of every batch is spawned from seed, the permutations don't depend on the number of workers
+    batch_sizes = [min(batch_size, n_permutations - start) for start in range(0, n_permutations, batch_size)]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+
+    n_jobs = resources.get_n_jobs(n_jobs, exclusive=True)
+    print(f"resources: {len(batch_sizes)} batches of permutations on {n_jobs} worker processes")
+
+    if n_jobs == 1:
+        _init_permutation_worker(data, sum_squares, adjacency, threshold)
+        batches = [_permutation_batch(seed_sequence, size) for seed_sequence, size in zip(seed_sequences, batch_sizes)]
+        _worker_data.clear()
+
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with shared_arrays.SharedArray(data) as shared_data, \
+             ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_shared_permutation_worker,
+                                 initargs=(shared_data.handle, sum_squares, adjacency, threshold, 
+                                           resources.get_resource_plan()["worker_blas_threads"])) as executor:
+            batches = list(executor.map(_permutation_batch, seed_sequences, batch_sizes))
+
+    null_distribution = np.concatenate(batches) if batches else np.zeros(0)
+
+    cluster_masses = np.array([mass for _, mass in observed])
+    cluster_p_values = np.array([(1 + np.sum(null_distribution >= abs(mass))) / (1 + n_permutations) for mass in cluster_masses])
+
+    results = {"t_obs": t_obs.reshape(shape), "clusters": [indices for indices, _ in observed],
+               "cluster_masses": cluster_masses, "cluster_p_values": cluster_p_values, "threshold": threshold,
+               "null_distribution": null_distribution}
+
+    return results
+
+
+@beartype
+def compute_cluster_statistics(folders: list[str], contrasts: list[str] = config.cluster_contrasts,
+                               group_directory: str|os.PathLike = config.group_directory, n_permutations: int = config.cluster_n_permutations,
+                               seed: int = config.cluster_seed, n_jobs: int | None = config.cluster_n_jobs) -> dict:
+    """
+    Recieves:
+    * folders: list of the subject folders.
+    * contrasts: names of the TFR contrasts to test ('<con1>-<con2>' of config.tfr_contrasts).
+    * group_directory: folder the results are written to, created if missing.
+    * n_permutations, seed, n_jobs: see cluster_permutation_test.
+
+    Function:
+    * For every contrast, tests the baseline corrected TFR contrasts of the subjects against 0 over channels x freqs x time points
+      (see load_contrast_data and cluster_permutation_test), with the sensor adjacency of the raw info of the first subject.
+      Writes to group_directory (config.get_cluster_path):
+      - the t-values as an AverageTFR (nave is the number of subjects),
+      - the p-value of the cluster of every point as an AverageTFR (1 outside the clusters), e.g. a mask for AverageTFR.plot,
+      - a json file with the clusters (sign, mass, p-value, channels, frequency and time range) and the parameters of the test.
+
+    Returns:
+    * cluster_summary: dictionary of contrast -> the clusters and parameters written to the json file.
+
+    """
+    os.makedirs(group_directory, exist_ok=True)
+
+    cluster_summary = {}
+
+    for contrast in contrasts:
+        try:
+            data, template, subjects = load_contrast_data(folders, f"evoked_tfr_{contrast}.h5")
+
+            raw_info = mne.io.read_info(os.path.join(next(folder for folder in folders if os.path.basename(os.path.normpath(folder)) == subjects[0]),
+                                                     config.raw_info_path))
+            adjacency = get_adjacency(raw_info, template.ch_names, len(template.freqs), len(template.times))
+
+            results = cluster_permutation_test(data, adjacency, n_permutations=n_permutations, seed=seed, n_jobs=n_jobs)
+
+            p_map = np.ones(results["t_obs"].size)
+            clusters = []
+
+            for indices, mass, p_value in zip(results["clusters"], results["cluster_masses"], results["cluster_p_values"]):
+                p_map[indices] = p_value
+                ch_indices, freq_indices, time_indices = np.unravel_index(indices, results["t_obs"].shape)
+
+                clusters.append({"sign": int(np.sign(mass)), "mass": float(mass), "p_value": float(p_value), "n_points": len(indices),
+                                 "channels": [template.ch_names[i] for i in np.unique(ch_indices)],
+                                 "fmin": float(template.freqs[freq_indices.min()]), "fmax": float(template.freqs[freq_indices.max()]),
+                                 "tmin": float(template.times[time_indices.min()]), "tmax": float(template.times[time_indices.max()])})
+
+            clusters.sort(key=lambda cluster: cluster["p_value"])
+
+            for kind, values in (("t", results["t_obs"]), ("p", p_map.reshape(results["t_obs"].shape))):
+                mne.time_frequency.AverageTFRArray(template.info, values, template.times, template.freqs, nave=len(subjects),
+                                                   comment=f"cluster test {contrast} ({kind})", method=template.method) \
+                    .save(os.path.join(group_directory, config.get_cluster_path(contrast, kind)), overwrite=True)
+
+            cluster_summary[contrast] = {"subjects": subjects, "n_permutations": n_permutations, "seed": seed,
+                                         "p_threshold": config.cluster_p_threshold, "t_threshold": results["threshold"],
+                                         "baseline": config.baseline_time, "baseline_mode": config.cluster_baseline_mode,
+                                         "time_range": config.post_stim_time, "decim": config.cluster_decim, "clusters": clusters}
+
+            with open(os.path.join(group_directory, config.get_cluster_path(contrast, "clusters")), "w") as f:
+                json.dump(cluster_summary[contrast], f, indent=1)
+
+            n_significant = sum(cluster["p_value"] < 0.05 for cluster in clusters)
+            print(f"{contrast}: {len(clusters)} clusters, {n_significant} with p < 0.05 ({len(subjects)} subjects)")
+
+        except Exception as e:
+            print("An error occured:", e)
+            traceback.print_exc()
+
+    return cluster_summary
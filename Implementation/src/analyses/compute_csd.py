@@ -2,7 +2,8 @@ import numpy as np
 import mne
 from beartype import beartype
 import traceback
-from src import  config
+from src import  config, epoch_cache, shared_arrays, resources
+from analyses import precision, pair_csd
 from mne.time_frequency import csd_morlet
 from tests import input_validation_tests
 import warnings
@@ -62,18 +63,376 @@ def compute_csd(epochs_instance: mne.EpochsArray | mne.epochs.EpochsFIF, freq_ba
             
             # Compute CSD for the desired time interval and frequencies
             csd = csd_morlet(epochs_baselined, frequencies=frequencies, tmin=tmin,
-                            tmax=tmax, decim=20, n_jobs=-1, verbose=True)
+                            tmax=tmax, decim=20, n_jobs=resources.get_n_jobs(), verbose=True)
             
             # average csds over frequency bands, each frequency band is a tuple (f[0], f[1])
             csd_mean = csd.mean([f[0] for f in freq_bands], [f[1] for f in freq_bands])
 
             # save original and mean csd:
             if save == True:
-                csd.save(config.get_csd_path(condition)) 
-                csd_mean.save(config.get_csd_mean_path(condition))
+                csd.save(config.get_csd_path(condition), overwrite=True) 
+                csd_mean.save(config.get_csd_mean_path(condition), overwrite=True)
 
         except Exception as e:
             print("An error occured:", e)
             traceback.print_exc()
 
-    return csd, csd_mean
\ No newline at end of file
+    return csd, csd_mean
+
+def _csd_crop(times: np.ndarray, tmin: float, tmax: float, wave_length: int) -> tuple[int, int]:
+    # the samples of the epoch csd_morlet transforms for the (tmin, tmax) window: the window plus half the longest wavelet
+    crop_start = max(0, np.searchsorted(times, tmin) - wave_length)
+    crop_stop = min(len(times), np.searchsorted(times, tmax) + wave_length)
+
+    return crop_start, crop_stop
+
+
+def _csd_window(times: np.ndarray, tmin: float, tmax: float, wave_length: int, decim: int) -> tuple[np.ndarray, float, float]:
+    # samples of the full epoch that csd_morlet averages over for the (tmin, tmax) window: csd_morlet crops the epoch to the window 
+    # plus half the longest wavelet, transforms the cropped epoch, decimates it and slices the window out of the decimated transform.
+    # Inside the window the transform of the cropped epoch equals the transform of the full epoch (up to the taps of the wavelets 
+    # outside of the crop, see _crop_corrections), so the full epoch is transformed once.
+    crop_start, crop_stop = _csd_crop(times, tmin, tmax, wave_length)
+    cropped_times = times[crop_start:crop_stop]
+
+    csd_tstart = np.searchsorted(cropped_times, tmin - 1e-10)
+    csd_tstop = np.searchsorted(cropped_times, tmax + 1e-10)
+    n_decimated = int(np.ceil(len(cropped_times) / decim))
+
+    samples = crop_start + decim * np.arange(csd_tstart // decim, min(csd_tstop // decim, n_decimated))
+    window_times = cropped_times[csd_tstart:csd_tstop]
+
+    return samples, window_times[0], window_times[-1]
+
+
+def _crop_corrections(samples: np.ndarray, crop: tuple[int, int], n_times: int, wavelets: list[np.ndarray]) -> list[tuple]:
+    # the taps of the wavelets on samples of the epoch outside of the crop of csd_morlet (see _csd_window), for the window samples
+    # whose wavelets reach past the crop: the crop stops one sample short of the longest wavelet of the last sample of a window that
+    # ends on a sample. The transform of the cropped epoch at sample n is the transform of the full epoch minus w[n + h - k] * x[k]
+    # for every such sample k (h half the length of w). Returns a list of (position in samples, sample k, weights of shape (freqs,)).
+    crop_start, crop_stop = crop
+    half_lengths = [len(wavelet) // 2 for wavelet in wavelets]
+    longest = max(half_lengths)
+    corrections = []
+
+    for position, sample in enumerate(samples):
+        # the samples outside of the crop within reach of the longest wavelet
+        outside = [*range(max(0, sample - longest), crop_start), *range(crop_stop, min(n_times, sample + longest + 1))]
+
+        for k in outside:
+            weights = np.array([wavelet[sample + h - k] if abs(sample - k) <= h else 0 for wavelet, h in zip(wavelets, half_lengths)])
+            corrections.append((position, k, weights))
+
+    return corrections
+
+
+def _accumulate_csd_block(data_handle: dict, rows: np.ndarray, picks: np.ndarray | None, epoch_conditions: np.ndarray, wavelet_spectra: dict, 
+                          dc_response: np.ndarray, mean_ranges: list[slice], window_samples: list[np.ndarray], 
+                          sample_matrices: list | None = None, pairs: np.ndarray | None = None, blas_threads: int | None = None,
+                          crop_corrections: list | None = None) -> dict:
+    # wavelet transform every epoch of the block once and add its cross spectra to the bins of its condition, 
+    # a bin per time window (post stimulus, baseline). Returns {condition: (sums of shape (windows, freqs, channels, channels), count)},
+    # or of shape (windows, freqs, pairs) with the pairs of a pair-subset CSD (see pair_csd.get_channel_pairs).
+    # The trials are attached by name (see shared_arrays.py) and read one epoch (rows, channels picks) at a time, nothing is pickled.
+    # The epochs are transformed by precision.cwt with the cached spectra of the wavelets, or at the samples of the windows only by
+    # precision.cwt_at_samples with sample_matrices (multi-rate mode, window_samples are then the indices of the samples of every window 
+    # in the transform), in the precision of wavelet_spectra (complex64 in the float32 compute mode), the sums are complex128 in both modes.
+    # crop_corrections (a list per window, see _crop_corrections) remove the taps of the wavelets outside of the crops of csd_morlet.
+    # The BLAS threads of a worker are limited to blas_threads (see resources.py)
+    with resources.limit_threads(blas_threads):
+        return _accumulate_csd_epochs(data_handle, rows, picks, epoch_conditions, wavelet_spectra, dc_response, mean_ranges, window_samples, 
+                                      sample_matrices, pairs, crop_corrections)
+
+
+def _accumulate_csd_epochs(data_handle: dict, rows: np.ndarray, picks: np.ndarray | None, epoch_conditions: np.ndarray, wavelet_spectra: dict, 
+                           dc_response: np.ndarray, mean_ranges: list[slice], window_samples: list[np.ndarray], sample_matrices: list | None,
+                           pairs: np.ndarray | None, crop_corrections: list | None = None) -> dict:
+    # the sums of the epochs of a block (see _accumulate_csd_block)
+    real_dtype, _ = precision.get_dtypes(wavelet_spectra["compute_dtype"])
+    data = shared_arrays.attach(data_handle)
+    n_freqs = len(wavelet_spectra["lengths"])
+
+    sums = {}
+
+    for row, condition in zip(rows, epoch_conditions):
+        epoch = np.asarray(data[row] if picks is None else data[row][picks], dtype=real_dtype)
+
+        if condition not in sums:
+            shape = (n_freqs, len(epoch), len(epoch)) if pairs is None else (n_freqs, len(pairs))
+            sums[condition] = [np.zeros((len(mean_ranges),) + shape, dtype=np.complex128), 0]
+
+        if sample_matrices is None:
+            coefs = precision.cwt(epoch, wavelet_spectra) # (channels, freqs, times)
+        else:
+            coefs = precision.cwt_at_samples(epoch, wavelet_spectra, sample_matrices) # (channels, freqs, samples of the windows)
+
+        for w, (mean_range, samples) in enumerate(zip(mean_ranges, window_samples)):
+            # mean of every channel over the time window, removed by apply_baseline(time_range) in compute_csd.
+            # The transform is linear: transform of the baselined epoch = transform of the epoch - offset * transform of a constant
+            offsets = epoch[:, mean_range].mean(axis=-1)
+            window_coefs = coefs[:, :, samples] - offsets[:, np.newaxis, np.newaxis] * dc_response[np.newaxis, :, samples]
+
+            # csd_morlet transforms the baselined epoch cropped around the window, without the samples past the crop
+            for position, k, weights in (crop_corrections[w] if crop_corrections is not None else []):
+                window_coefs[:, :, position] -= (epoch[:, k] - offsets)[:, np.newaxis] * weights[np.newaxis, :]
+
+            window_coefs = window_coefs.transpose(1, 0, 2) # (freqs, channels, times)
+
+            if pairs is None:
+                sums[condition][0][w] += window_coefs @ window_coefs.conj().transpose(0, 2, 1)
+            else:
+                # the cross spectra of the pairs only, summed over the times of the window
+                sums[condition][0][w] += np.einsum('fpt,fpt->fp', window_coefs[:, pairs[:, 0]], window_coefs[:, pairs[:, 1]].conj())
+
+        sums[condition][1] += 1
+
+    return sums
+
+def _accumulate_csd_sums(epochs_instance: mne.EpochsArray | mne.epochs.EpochsFIF | epoch_cache.EpochCache, freq_bands: list[tuple[int, int]], 
+                         time_ranges: list[tuple[float, float]], n_jobs: int | None, selection: np.ndarray | None = None, 
+                         compute_dtype: str = config.compute_dtype, multirate: bool = config.csd_multirate, channel_groups: dict | None = None,
+                         channel_pairs: list | None = None) -> tuple[dict, list, list[str], np.ndarray, np.ndarray | None]:
+    # wavelet transform the epochs (all or the epochs in selection) in parallel blocks and accumulate their cross spectra per condition
+    # and time window (see _accumulate_csd_block), in the precision of compute_dtype (see precision.py), at the decimated samples 
+    # of the windows only if multirate (see precision.cwt_at_samples). The workers attach to the trials by name (see shared_arrays.py): 
+    # the mapped trials of an EpochCache as they are, the trials of mne epochs copied once to shared memory.
+    # With channel_groups or channel_pairs only the channels of the pairs are transformed and only the cross spectra of the pairs
+    # (and the auto spectra of their channels) are summed (see pair_csd.get_channel_pairs).
+    # Returns the sums, the windows (samples, tmin, tmax), the channel names, the frequencies and the pairs (None for the full CSD)
+    from mne.parallel import parallel_func
+    from mne.time_frequency import morlet
+
+    # same parameters as compute_csd:
+    fmin = freq_bands[0][0]
+    fmax = freq_bands[-1][1]
+
+    frequencies = np.arange(fmin, fmax + 1, 2) # calculate the csd for the frequencies in the frequency range with a 2Hz step
+    decim = 20
+    sfreq = epochs_instance.info['sfreq']
+    times = np.arange(len(epochs_instance.times)) * (1.0 / sfreq) + epochs_instance.tmin # as in csd_morlet
+
+    if selection is None:
+        selection = np.arange(len(epochs_instance.events))
+
+    # picked on a copy of the info: pick_types checks the info in place and the EpochCache (and its info) is shared by the
+    # csd stages running in threads (see pipeline.py), concurrent checks of the same info fail
+    picks = mne.pick_types(epochs_instance.info.copy(), meg=True, eeg=True, ref_meg=False, exclude='bads')
+    ch_names = [epochs_instance.ch_names[pick] for pick in picks]
+    real_dtype, _ = precision.get_dtypes(compute_dtype)
+
+    # a pair-subset CSD reads the channels of its pairs only, the pairs are indices of these channels
+    pairs = pair_csd.get_channel_pairs(ch_names, channel_groups, channel_pairs)
+
+    if pairs is not None:
+        channels, pairs = np.unique(pairs, return_inverse=True)
+        pairs = pairs.reshape(-1, 2)
+        picks = picks[channels]
+        ch_names = [ch_names[channel] for channel in channels]
+
+    if isinstance(epochs_instance, epoch_cache.EpochCache):
+        # the workers read the trials of selection and the picked channels from the mapped cache
+        trials, rows, row_picks = epochs_instance.data, selection, picks
+    else:
+        trials = epochs_instance.get_data(picks=picks, item=selection).astype(real_dtype, copy=False)
+        rows, row_picks = np.arange(len(selection)), None
+
+    # condition of every epoch, epochs are sorted by condition so every parallel block touches few conditions
+    code_to_condition = {code: condition for condition, code in epochs_instance.event_id.items()}
+    epoch_conditions = np.array([code_to_condition[code] for code in epochs_instance.events[selection, 2]])
+    order = np.argsort(epoch_conditions, kind='stable')
+
+    # the samples each time window is averaged over by apply_baseline(time_range) (mne.baseline.rescale, mode 'mean')
+    mean_ranges = [slice(np.flatnonzero(times >= min(time_range))[0], np.flatnonzero(times <= max(time_range))[-1] + 1) 
+                   for time_range in time_ranges]
+
+    # the spectra of the wavelets of csd_morlet, computed once for all conditions and subjects (see precision.morlet_spectra and band_spectra)
+    if multirate:
+        wavelet_spectra = precision.band_spectra(sfreq, len(times), frequencies, n_cycles=7.0, compute_dtype=compute_dtype)
+    else:
+        wavelet_spectra = precision.morlet_spectra(sfreq, len(times), frequencies, n_cycles=7.0, compute_dtype=compute_dtype)
+
+    wave_length = wavelet_spectra["lengths"][np.argmin(frequencies)] // 2
+
+    windows = [_csd_window(times, min(time_range), max(time_range), wave_length, decim) for time_range in time_ranges]
+    window_samples = [window[0] for window in windows]
+
+    # the wavelets of the window samples that reach past the crops of csd_morlet (the last sample of a window that ends on a sample)
+    wavelets = morlet(sfreq, frequencies, n_cycles=7.0)
+    crop_corrections = [_crop_corrections(samples, _csd_crop(times, min(time_range), max(time_range), wave_length), len(times), wavelets)
+                        for samples, time_range in zip(window_samples, time_ranges)]
+    ones = np.ones((1, len(times)), dtype=real_dtype)
+
+    if multirate:
+        # the epochs are transformed at the samples of the windows only, window_samples become the indices of the samples in the transform
+        sample_matrices = precision.band_sample_matrices(wavelet_spectra, np.concatenate(window_samples))
+        bounds = np.cumsum([0] + [len(samples) for samples in window_samples])
+        window_samples = [np.arange(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+        # transform of a constant signal, to remove the mean of each time window after the transform
+        dc_response = precision.cwt_at_samples(ones, wavelet_spectra, sample_matrices)[0]
+
+    else:
+        sample_matrices = None
+        dc_response = precision.cwt(ones, wavelet_spectra)[0]
+
+    # the workers of the resource plan, each with its BLAS threads (a single job runs in this process, under the limits of the process)
+    plan = resources.get_resource_plan()
+    parallel, accumulate_block, n_jobs = parallel_func(_accumulate_csd_block, resources.get_n_jobs(n_jobs))
+    blas_threads = plan["worker_blas_threads"] if n_jobs > 1 else None
+    blocks = np.array_split(order, n_jobs)
+
+    # the trials are shared once for all blocks, a copy made above is released (the workers read the shared copy)
+    shared_data = shared_arrays.SharedArray(trials)
+    del trials
+
+    with shared_data:
+        block_sums = parallel(accumulate_block(shared_data.handle, rows[block], row_picks, epoch_conditions[block], wavelet_spectra, dc_response, 
+                                               mean_ranges, window_samples, sample_matrices, pairs, blas_threads, crop_corrections) 
+                              for block in blocks if len(block) > 0)
+
+    # combine the bins of the blocks
+    sums = {}
+    for block_sum in block_sums:
+        for condition, (condition_sums, count) in block_sum.items():
+            if condition in sums:
+                sums[condition][0] += condition_sums
+                sums[condition][1] += count
+            else:
+                sums[condition] = [condition_sums, count]
+
+    return sums, windows, ch_names, frequencies, pairs
+
+
+def _create_csd(csd_sum: np.ndarray, n_epochs: int, window: tuple, ch_names: list[str], frequencies: np.ndarray, sfreq: float, 
+                freq_bands: list[tuple[int, int]], projs: list, pairs: np.ndarray | None = None) -> tuple:
+    # average over epochs and window times, upper triangle of the matrices as in csd_morlet (scaled by sampling frequency),
+    # a PairCSD of the pairs if pairs isn't None (see pair_csd.py)
+    from mne.time_frequency import CrossSpectralDensity
+
+    samples, tmin, tmax = window
+
+    if pairs is None:
+        upper_triangle = np.triu_indices(len(ch_names))
+        csd_data = csd_sum[:, upper_triangle[0], upper_triangle[1]].T / (n_epochs * len(samples) * sfreq)
+        csd = CrossSpectralDensity(csd_data, ch_names=ch_names, frequencies=frequencies, n_fft=1, tmin=tmin, tmax=tmax, projs=projs)
+    else:
+        csd_data = csd_sum.T / (n_epochs * len(samples) * sfreq)
+        csd = pair_csd.PairCSD(csd_data, ch_names, pairs, frequencies, n_fft=1, tmin=tmin, tmax=tmax, projs=projs)
+    
+    # average csds over frequency bands, each frequency band is a tuple (f[0], f[1])
+    csd_mean = csd.mean([f[0] for f in freq_bands], [f[1] for f in freq_bands])
+    return csd, csd_mean
+
+
+@beartype
+def compute_csd_condition(epochs_instance: mne.EpochsArray | mne.epochs.EpochsFIF | epoch_cache.EpochCache, condition: str, freq_bands: list[tuple[int, int]], 
+                          post_stim_time: tuple[float,float], baseline_time: tuple[float,float], save=True, n_jobs: int | None = None,
+                          compute_dtype: str = config.compute_dtype, multirate: bool = config.csd_multirate,
+                          channel_groups: dict | None = config.csd_channel_groups, channel_pairs: list | None = config.csd_channel_pairs) \
+    -> tuple[tuple[mne.time_frequency.CrossSpectralDensity | pair_csd.PairCSD, mne.time_frequency.CrossSpectralDensity | pair_csd.PairCSD], 
+             mne.time_frequency.CrossSpectralDensity | pair_csd.PairCSD]:
+    """
+    Recieves:
+    * epochs_instance: mne.EpochsArray, only the epochs of condition are read (epochs_instance may be read from file without preloading,
+      or be the EpochCache of the subject with the combined conditions, see epoch_cache.py).
+    * condition: str, the event_id key present in epochs_instance.
+    * freq_bands: list of tuples(1,2) containing the lower an upper bound for each frequency band.
+    * post_stim_time: tuple, post stimulus time range.
+    * baseline_time: tuple, baseline time range.
+    * n_jobs: int, number of parallel jobs over blocks of epochs, None (or -1) for the workers of the resource plan (see resources.py).
+    * compute_dtype: 'float64' or 'float32', precision of the wavelet transform (see analyses/precision.py), the cross spectra 
+      are accumulated in complex128 in both.
+    * multirate: bool, transform the epochs at the decimated samples of the time windows only, each frequency from the band of the
+      spectrum its wavelet passes (see precision.band_spectra), the csds match the full transform within config.csd_band_tolerance.
+    * channel_groups: dictionary of ROI name -> channel names, or channel_pairs: list of (channel, channel) pairs, compute only the 
+      cross spectra of these pairs and the auto spectra of their channels (a PairCSD, see analyses/pair_csd.py), the full csd if both are None.
+
+    Function:
+    * Calculate the cross spectral density of the epochs of a single condition over post_stim_time and over baseline_time, in a single pass over the epochs of the condition. The baseline csd of the condition
+      is saved to config.get_csd_baseline_part_path(condition), the baseline csd of all epochs is combined from the baseline csds of 
+      all conditions by compute_baseline_csd.
+
+    Returns:
+    * (csd, csd_mean): the csd of the condition and the csd averaged across frequency bands.
+    * baseline_part: the baseline csd of the epochs of the condition.
+
+    """
+
+    # vaidate input values 
+    try:
+        input_validation_tests.compute_csd_val(freq_bands=freq_bands, time_range=post_stim_time)
+        input_validation_tests.compute_csd_val(freq_bands=freq_bands, time_range=baseline_time)
+
+    except Exception as e:
+        print("An error occured:", e)
+        traceback.print_exc()
+
+    else:
+        try:
+            output_files = [config.get_csd_path(condition), config.get_csd_mean_path(condition), config.get_csd_baseline_part_path(condition)]
+
+            selection = np.where(epochs_instance.events[:, 2] == epochs_instance.event_id[condition])[0]
+
+            sums, windows, ch_names, frequencies, pairs = _accumulate_csd_sums(epochs_instance, freq_bands, [post_stim_time, baseline_time], 
+                                                                               n_jobs, selection=selection, compute_dtype=compute_dtype, 
+                                                                               multirate=multirate, channel_groups=channel_groups, 
+                                                                               channel_pairs=channel_pairs)
+
+            sfreq, projs = epochs_instance.info['sfreq'], epochs_instance.info['projs']
+            condition_sums, n_epochs = sums[condition]
+
+            csd, csd_mean = _create_csd(condition_sums[0], n_epochs, windows[0], ch_names, frequencies, sfreq, freq_bands, projs, pairs)
+            baseline_part, _ = _create_csd(condition_sums[1], n_epochs, windows[1], ch_names, frequencies, sfreq, freq_bands, projs, pairs)
+
+            # save original and mean csd and the baseline of the condition:
+            if save == True:
+                for csd_instance, file_name in zip([csd, csd_mean, baseline_part], output_files):
+                    csd_instance.save(file_name, overwrite=True)
+
+        except Exception as e:
+            print("An error occured:", e)
+            traceback.print_exc()
+
+    return (csd, csd_mean), baseline_part
+
+
+@beartype
+def compute_baseline_csd(baseline_parts: dict, counts: dict, freq_bands: list[tuple[int, int]], save=True) \
+    -> tuple[mne.time_frequency.CrossSpectralDensity | pair_csd.PairCSD, mne.time_frequency.CrossSpectralDensity | pair_csd.PairCSD]:
+    """
+    Recieves:
+    * baseline_parts: dictionary of condition -> the baseline csd of the epochs of the condition (see compute_csd_condition).
+    * counts: dictionary of condition -> number of epochs of the condition.
+    * freq_bands: list of tuples(1,2) containing the lower an upper bound for each frequency band.
+
+    Function:
+    * Combines the baseline csds of the conditions to the baseline csd of all epochs (the 'baseline' csd of compute_csd):
+      the average of the baseline csds weighted by the number of epochs of every condition. Only the csds are read, not the epochs.
+
+    Returns:
+    * csd: the baseline CrossSpectralDensity.
+    * csd_mean: the baseline csd averaged across frequency bands.
+
+    """
+    from mne.time_frequency import CrossSpectralDensity
+
+    n_epochs = sum(counts[condition] for condition in baseline_parts)
+
+    first = next(iter(baseline_parts.values()))
+    csd_data = sum(counts[condition] * baseline_part._data for condition, baseline_part in baseline_parts.items()) / n_epochs
+
+    if isinstance(first, pair_csd.PairCSD):
+        csd = pair_csd.PairCSD(csd_data, first.ch_names, first.pairs, first.frequencies, n_fft=first.n_fft, tmin=first.tmin, tmax=first.tmax, 
+                               projs=first.projs)
+    else:
+        csd = CrossSpectralDensity(csd_data, ch_names=first.ch_names, frequencies=first.frequencies, n_fft=first.n_fft, 
+                                   tmin=first.tmin, tmax=first.tmax, projs=first.projs)
+
+    # average csds over frequency bands, each frequency band is a tuple (f[0], f[1])
+    csd_mean = csd.mean([f[0] for f in freq_bands], [f[1] for f in freq_bands])
+
+    if save == True:
+        csd.save(config.get_csd_path('baseline'), overwrite=True) 
+        csd_mean.save(config.get_csd_mean_path('baseline'), overwrite=True)
+
+    return csd, csd_mean
@@ -0,0 +1,243 @@
+import os, json
+import traceback
+import numpy as np
+import mne
+from beartype import beartype
+from numpy.typing import NDArray
+from mne.time_frequency import CrossSpectralDensity, read_spectrum, read_tfrs
+from src import config
+from analyses import pair_csd
+
+
+class RunningMoments:
+    """
+    Running mean and sum of squared deviations of arrays of a fixed shape (Welford's algorithm): the arrays are added one at a time
+    and only the mean and the sum of squared deviations are held, the memory doesn't grow with the number of arrays.
+    Complex arrays are accumulated per real and imaginary part (the variance of the real part in the real part of m2 and the
+    variance of the imaginary part in its imaginary part), in complex128, real arrays in float64.
+
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def add(self, x: NDArray):
+        """
+        Recieves:
+        * x: ndarray of the shape of the arrays added before.
+
+        Function:
+        * Updates the mean and the sum of squared deviations with x.
+
+        """
+        x = np.asarray(x, dtype=np.complex128 if np.iscomplexobj(x) else np.float64)
+
+        if self.mean is None:
+            self.mean = np.zeros_like(x)
+            self.m2 = np.zeros_like(x)
+
+        if x.shape != self.mean.shape:
+            raise ValueError(f"expected an array of shape {self.mean.shape}, got {x.shape}")
+
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        delta_after = x - self.mean
+
+        if np.iscomplexobj(x):
+            self.m2 += delta.real * delta_after.real + 1j * (delta.imag * delta_after.imag)
+        else:
+            self.m2 += delta * delta_after
+
+    def standard_error(self) -> NDArray | None:
+        """
+        Returns:
+        * the standard error of the mean (sample standard deviation / sqrt(n), per real and imaginary part for complex arrays),
+          None with less than two arrays.
+
+        """
+        if self.n < 2:
+            return None
+
+        if np.iscomplexobj(self.m2):
+            return np.sqrt(self.m2.real / (self.n - 1) / self.n) + 1j * np.sqrt(self.m2.imag / (self.n - 1) / self.n)
+
+        return np.sqrt(self.m2 / (self.n - 1) / self.n)
+
+
+def _coherence(csd_data: NDArray, n_channels: int) -> NDArray:
+    # coherence |csd_ij| / sqrt(csd_ii * csd_jj) of the upper triangle data of a csd (pairs, freqs), as plotted by csd.plot(mode='coh')
+    rows, cols = np.triu_indices(n_channels)
+    auto_spectra = np.zeros((n_channels, csd_data.shape[1]))
+    auto_spectra[rows[rows == cols]] = np.abs(csd_data[rows == cols])
+
+    return np.abs(csd_data) / np.sqrt(auto_spectra[rows] * auto_spectra[cols])
+
+
+def _read_csd(file: str, coherence: bool = False) -> tuple:
+    # a full csd of mne or a pair-subset csd (see analyses/pair_csd.py), the subjects of a group have the same pairs
+    csd = pair_csd.read_csd(file)
+
+    if isinstance(csd, pair_csd.PairCSD):
+        data = csd.coherence() if coherence else csd._data
+        pairs = tuple(map(tuple, csd.pairs.tolist()))
+    else:
+        data = _coherence(csd._data, len(csd.ch_names)) if coherence else csd._data
+        pairs = None
+
+    # the frequencies of a csd averaged over bands are the arrays of frequencies of every band
+    frequencies = tuple(np.concatenate([np.atleast_1d(frequency) for frequency in csd.frequencies]).tolist())
+    return csd, data, (tuple(csd.ch_names), pairs, frequencies, csd.tmin, csd.tmax)
+
+
+def _write_csd(template: CrossSpectralDensity | pair_csd.PairCSD, data: NDArray, n_subjects: int) -> CrossSpectralDensity | pair_csd.PairCSD:
+    if isinstance(template, pair_csd.PairCSD):
+        return pair_csd.PairCSD(data, template.ch_names, template.pairs, template.frequencies, n_fft=template.n_fft, tmin=template.tmin,
+                                tmax=template.tmax, projs=template.projs)
+
+    return CrossSpectralDensity(data, ch_names=template.ch_names, frequencies=template.frequencies, n_fft=template.n_fft,
+                                tmin=template.tmin, tmax=template.tmax, projs=template.projs)
+
+
+def _read_tfr(file: str) -> tuple:
+    tfr = read_tfrs(file)
+    tfr = tfr[0] if isinstance(tfr, list) else tfr
+    return tfr, tfr.data, (tuple(tfr.ch_names), tuple(tfr.freqs), tuple(np.round(tfr.times, 6)))
+
+
+def _write_tfr(template, data: NDArray, n_subjects: int):
+    return mne.time_frequency.AverageTFRArray(template.info, data, template.times, template.freqs, nave=n_subjects,
+                                              comment=f"group of {n_subjects} subjects", method=template.method)
+
+
+def _read_spectrum(file: str) -> tuple:
+    spectrum = read_spectrum(file)
+    return spectrum, spectrum.get_data(), (tuple(spectrum.ch_names), tuple(spectrum.freqs))
+
+
+def _write_spectrum(template, data: NDArray, n_subjects: int):
+    return mne.time_frequency.SpectrumArray(data, template.info, template.freqs)
+
+
+readers = {"csd": _read_csd, "coherence": lambda file: _read_csd(file, coherence=True), "tfr": _read_tfr, "spectrum": _read_spectrum}
+writers = {"csd": _write_csd, "coherence": _write_csd, "tfr": _write_tfr, "spectrum": _write_spectrum}
+
+
+@beartype
+def get_group_items(conditions: list[str] = list(config.new_event_ids.keys()), tfr_contrasts: list = config.tfr_contrasts) -> list[dict]:
+    """
+    Recieves:
+    * conditions: the conditions of the CSDs (the combined conditions, the baseline CSD is added).
+    * tfr_contrasts: the contrasts of the TFRs (see config.tfr_contrasts), with their induced power and ITC contrasts if config.compute_induced_power.
+
+    Returns:
+    * group_items: list of the outputs of a subject to average over the subjects, dictionaries with 'name' (the name of the group
+      files), 'file' (the file of the subject) and 'kind' ('csd', 'coherence' (of the mean csd), 'tfr' or 'spectrum').
+
+    """
+    group_items = []
+
+    for condition in conditions + ['baseline']:
+        group_items.append({"name": config.get_csd_path(condition), "file": config.get_csd_path(condition), "kind": "csd"})
+        group_items.append({"name": config.get_csd_mean_path(condition), "file": config.get_csd_mean_path(condition), "kind": "csd"})
+        group_items.append({"name": config.get_group_coherence_path(condition), "file": config.get_csd_mean_path(condition), "kind": "coherence"})
+
+    for con1, con2 in tfr_contrasts:
+        group_items.append({"name": config.get_tfr_contrast_path(con1, con2), "file": config.get_tfr_contrast_path(con1, con2), "kind": "tfr"})
+
+        if config.compute_induced_power:
+            for get_path in (config.get_induced_tfr_contrast_path, config.get_itc_contrast_path):
+                group_items.append({"name": get_path(con1, con2), "file": get_path(con1, con2), "kind": "tfr"})
+
+    group_items.append({"name": config.psd_path, "file": config.psd_path, "kind": "spectrum"})
+
+    return group_items
+
+
+@beartype
+def compute_group_averages(folders: list[str], group_directory: str|os.PathLike = config.group_directory,
+                           group_items: list[dict] | None = None) -> dict:
+    """
+    Recieves:
+    * folders: list of the subject folders.
+    * group_directory: folder the group files are written to, created if missing.
+    * group_items: the outputs to average (see get_group_items), all CSDs, coherences, TFR contrasts and the PSD by default.
+
+    Function:
+    * Streams the subjects one at a time: every output of the subject is read, added to the running mean and variance of its
+      item (see RunningMoments) and released, so the memory is flat in the number of subjects (an item holds its mean and
+      sum of squared deviations only). A subject missing an output, or with an output that doesn't match the channels,
+      frequencies and times of the first subject, is left out of that item (and reported).
+      For every item the grand average and the standard error over the subjects are written in the mne format of the subject
+      outputs (CrossSpectralDensity for CSDs and coherences, AverageTFR, Spectrum) to config.get_group_path(name, 'mean' / 'se'),
+      the subjects of every item to config.group_summary_path.
+
+    Returns:
+    * group_summary: dictionary of name -> {'kind', 'subjects', 'files'} of the written items.
+
+    """
+    group_items = get_group_items() if group_items is None else group_items
+
+    os.makedirs(group_directory, exist_ok=True)
+
+    moments = {item["name"]: RunningMoments() for item in group_items}
+    templates = {} # name -> (object of the first subject, its signature)
+    subjects = {item["name"]: [] for item in group_items}
+
+    for folder in folders:
+        subject_num = os.path.basename(os.path.normpath(folder))
+
+        for item in group_items:
+            file = os.path.join(folder, item["file"])
+
+            if not os.path.exists(file):
+                print(f"{subject_num}: {item['file']} is missing, the subject is left out of the group {item['name']}")
+                continue
+
+            try:
+                instance, data, signature = readers[item["kind"]](file)
+
+                if item["name"] not in templates:
+                    templates[item["name"]] = (instance, signature)
+
+                elif signature != templates[item["name"]][1]:
+                    print(f"{subject_num}: the channels, frequencies or times of {item['file']} differ from the first subject, "
+                          f"the subject is left out of the group {item['name']}")
+                    continue
+
+                moments[item["name"]].add(data)
+                subjects[item["name"]].append(subject_num)
+
+            except Exception as e:
+                print(f"An error occured in reading {file}:", e)
+                traceback.print_exc()
+
+    group_summary = {}
+
+    for item in group_items:
+        name, running = item["name"], moments[item["name"]]
+
+        if running.n == 0:
+            print(f"No subject has {item['file']}, the group {name} isn't written")
+            continue
+
+        template = templates[name][0]
+        files = []
+
+        for statistic, data in (("mean", running.mean), ("se", running.standard_error())):
+            if data is None:
+                print(f"The standard error of the group {name} needs at least two subjects, it isn't written")
+                continue
+
+            file = os.path.join(group_directory, config.get_group_path(name, statistic))
+            writers[item["kind"]](template, data, running.n).save(file, overwrite=True)
+            files.append(file)
+
+        group_summary[name] = {"kind": item["kind"], "subjects": subjects[name], "files": files}
+
+    with open(os.path.join(group_directory, config.group_summary_path), "w") as f:
+        json.dump(group_summary, f, indent=1)
+
+    return group_summary
@@ -0,0 +1,195 @@
+"""
+
+Induced power and inter-trial coherence (ITC) of the conditions, from the single trials: the TFR contrasts of tfr_psd_analyses are
+the power of the evoked difference, the activity that isn't phase locked to the stimulus averages out of the evoked response.
+Transforming all trials at once would hold trials x channels x tapers x freqs x time points complex values, here the trials of every
+condition are transformed in chunks (the multitaper transform of compute_tfr, see precision.tfr_array_multitaper) and summed on the fly:
+per condition (of event_ids) the sum of the power and the sum of the unit phasors of every taper. The memory is a chunk and the
+accumulators of the conditions, it doesn't grow with the number of trials.
+The power and ITC of any union of the conditions, and any contrast between unions, are derived from the accumulators without
+transforming the trials again (see induced_from_sums).
+
+"""
+import os
+import numpy as np
+import mne
+from beartype import beartype
+from numpy.typing import NDArray
+from src import config, epoch_cache, resources
+from analyses import precision, tfr_psd_analyses
+
+
+@beartype
+def compute_induced_sums(epochs: mne.EpochsArray | mne.epochs.EpochsFIF | epoch_cache.EpochCache, freqs: NDArray,
+                         condition_sums: dict | None = None, chunk_size: int = config.induced_chunk_size, decim: int = config.induced_decim,
+                         subtract_evoked: bool = config.induced_subtract_evoked, compute_dtype: str = config.compute_dtype) -> dict:
+    """
+    Recieves:
+    * epochs: the epochs with the conditions of event_ids (not combined), or the EpochCache of the subject (see epoch_cache.py).
+    * freqs: 1D-array of the frequencies.
+    * condition_sums: the sums and counts of the trials per condition (see tfr_psd_analyses.compute_condition_sums), the evoked
+      responses subtracted from the trials. Computed from epochs if None and subtract_evoked.
+    * chunk_size: number of trials transformed at a time.
+    * decim: every decim-th time point of the transform is accumulated.
+    * subtract_evoked: bool, the evoked response of its condition is subtracted from every trial before its power is taken (induced power),
+      the total power of the trials if False. The ITC is the phase locking of the trials themselves in both cases.
+    * compute_dtype: 'float64' or 'float32', precision of the transform (see analyses/precision.py), the sums are accumulated in double precision.
+
+    Function:
+    * Transforms the trials of every condition chunk by chunk and adds the power (averaged over the tapers) and the unit phasors
+      (coefs / |coefs|) of every trial to the sums of its condition. The transform is linear: the spectra of a trial minus the evoked response
+      are the spectra of the trial minus the spectra of the evoked response, transformed once per condition.
+
+    Returns:
+    * induced_sums: dictionary with 'power' (ndarray (conditions, channels, freqs, time points), sum of the power of the trials),
+      'phase' (ndarray (conditions, channels, tapers, freqs, time points), sum of the unit phasors), 'counts' (ndarray of the number of trials),
+      'conditions', 'freqs', 'times' (the decimated times) and 'subtract_evoked'.
+
+    """
+    # the transforms of the chunks run on the BLAS threads of the resource plan of the process (see resources.py)
+    resources.get_resource_plan()
+
+    if subtract_evoked and condition_sums is None:
+        condition_sums = tfr_psd_analyses.compute_condition_sums(epochs)
+
+    real_dtype, _ = precision.get_dtypes(compute_dtype)
+    data = epochs.get_data(copy=False)
+    sfreq = epochs.info["sfreq"]
+    conditions = list(epochs.event_id.keys())
+
+    times = (epochs.tmin + np.arange(data.shape[-1]) / sfreq)[::decim]
+    power = np.zeros((len(conditions), data.shape[1], len(freqs), len(times)))
+    phase = None
+    counts = np.zeros(len(conditions), dtype=int)
+
+    for i, condition in enumerate(conditions):
+        indices = np.flatnonzero(epochs.events[:, 2] == epochs.event_id[condition])
+        counts[i] = len(indices)
+
+        if subtract_evoked and len(indices) > 0:
+            evoked = condition_sums["sums"][condition] / condition_sums["counts"][condition]
+            evoked_coefs = precision.tfr_array_multitaper(evoked[np.newaxis].astype(real_dtype), sfreq, freqs, compute_dtype=compute_dtype,
+                                                          decim=decim)[0]
+
+        for start in range(0, len(indices), chunk_size):
+            chunk = data[indices[start:start + chunk_size]].astype(real_dtype, copy=False)
+            coefs = precision.tfr_array_multitaper(chunk, sfreq, freqs, compute_dtype=compute_dtype, decim=decim)
+
+            if phase is None:
+                phase = np.zeros((len(conditions),) + coefs.shape[1:], dtype=np.complex128)
+
+            magnitude = np.abs(coefs)
+            phase[i] += np.divide(coefs, magnitude, out=np.zeros_like(coefs), where=magnitude > 0).sum(axis=0, dtype=np.complex128)
+
+            if subtract_evoked:
+                coefs -= evoked_coefs
+                magnitude = np.abs(coefs)
+
+            power[i] += (magnitude ** 2).mean(axis=2, dtype=np.float64).sum(axis=0)
+
+    induced_sums = {"power": power, "phase": phase, "counts": counts, "conditions": conditions, "freqs": np.asarray(freqs),
+                    "times": times, "subtract_evoked": subtract_evoked}
+
+    return induced_sums
+
+
+@beartype
+def save_induced_sums(induced_sums: dict, path: str|os.PathLike = config.induced_sums_path):
+    """
+    Recieves:
+    * induced_sums: the accumulators of the conditions (see compute_induced_sums).
+    * path: path of the npz file.
+
+    Function:
+    * Saves the accumulators, contrasts of other unions of the conditions can be derived later without the trials (see read_induced_sums).
+
+    """
+    np.savez(path, **{key: np.asarray(value) for key, value in induced_sums.items()})
+
+
+@beartype
+def read_induced_sums(path: str|os.PathLike = config.induced_sums_path) -> dict:
+    """
+    Recieves:
+    * path: path of the npz file written by save_induced_sums.
+
+    Returns:
+    * induced_sums: the accumulators of the conditions (see compute_induced_sums).
+
+    """
+    with np.load(path) as saved:
+        induced_sums = {key: saved[key] for key in saved.files}
+
+    induced_sums["conditions"] = induced_sums["conditions"].tolist()
+    induced_sums["subtract_evoked"] = bool(induced_sums["subtract_evoked"])
+
+    return induced_sums
+
+
+@beartype
+def induced_from_sums(induced_sums: dict, names: list[str]) -> tuple[NDArray, NDArray, int]:
+    """
+    Recieves:
+    * induced_sums: the accumulators of the conditions (see compute_induced_sums).
+    * names: list of names of the conditions to average, combined conditions or tags (see tfr_psd_analyses.get_leaf_conditions).
+
+    Function:
+    * Averages the power and the phasors over all trials of the conditions. The ITC is |mean of the unit phasors| averaged over the tapers,
+      as mne.time_frequency.tfr_array_multitaper(output='itc') of the trials.
+
+    Returns:
+    * power: ndarray (channels, freqs, time points).
+    * itc: ndarray (channels, freqs, time points), in [0, 1].
+    * n_trials: number of trials of the conditions.
+
+    """
+    leaf_conditions = tfr_psd_analyses.get_leaf_conditions(names, induced_sums["conditions"])
+    indices = [induced_sums["conditions"].index(condition) for condition in leaf_conditions]
+
+    n_trials = int(induced_sums["counts"][indices].sum())
+
+    if n_trials == 0:
+        raise ValueError(f"no trials of the conditions {names}")
+
+    power = induced_sums["power"][indices].sum(axis=0) / n_trials
+    itc = np.abs(induced_sums["phase"][indices].sum(axis=0)).mean(axis=1) / n_trials
+
+    return power, itc, n_trials
+
+
+@beartype
+def compute_induced_contrast(induced_sums: dict, info: mne.Info, con1: tuple, con2: tuple, save: bool = True) \
+    -> tuple[mne.time_frequency.AverageTFR, mne.time_frequency.AverageTFR]:
+    """
+    Recieves:
+    * induced_sums: the accumulators of the conditions of the subject (see compute_induced_sums), shared by all contrasts.
+    * info: mne.Info of the epochs.
+    * con1, con2: tuples (name of the combined condition, list of names of conditions), as in tfr_psd_analyses.compute_tfr_contrast.
+    * save: bool, save the contrasts to the current directory (config.get_induced_tfr_contrast_path and config.get_itc_contrast_path).
+
+    Function:
+    * Derives the contrasts (con1 - con2) of the induced power and of the ITC from the accumulators, cropped to the times of
+      the evoked TFR contrasts. Not baselined, as the evoked TFR contrasts.
+
+    Returns:
+    * induced_contrast, itc_contrast: AverageTFRs of the differences.
+
+    """
+    power_1, itc_1, n_trials_1 = induced_from_sums(induced_sums, con1[1])
+    power_2, itc_2, n_trials_2 = induced_from_sums(induced_sums, con2[1])
+
+    kind = "induced" if induced_sums["subtract_evoked"] else "total"
+    contrasts = []
+
+    for data, comment, path in ((power_1 - power_2, f"{kind} power {con1[0]}-{con2[0]}", config.get_induced_tfr_contrast_path(con1, con2)),
+                                (itc_1 - itc_2, f"itc {con1[0]}-{con2[0]}", config.get_itc_contrast_path(con1, con2))):
+        tfr = mne.time_frequency.AverageTFRArray(info, data, induced_sums["times"], induced_sums["freqs"], nave=min(n_trials_1, n_trials_2),
+                                                 comment=comment, method='multitaper')
+        tfr.crop(tmin=config.baseline_time[0], tmax=config.post_stim_time[1])
+
+        if save:
+            tfr.save(path, overwrite=True)
+
+        contrasts.append(tfr)
+
+    return contrasts[0], contrasts[1]
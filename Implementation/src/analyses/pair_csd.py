@@ -0,0 +1,234 @@
+"""
+
+Cross-spectral densities of a subset of the channel pairs (the ROIs or the pairs of a connectivity question) instead of the full
+channels x channels matrix: PairCSD holds the cross-spectra of the requested pairs and the auto-spectra of their channels, in the
+layout of mne.time_frequency.CrossSpectralDensity (data of shape (pairs, frequencies)), the work and storage scale with the number
+of pairs. It has the methods of a CrossSpectralDensity the pipeline uses (mean, save, plot with mode 'csd' or 'coh') and is read
+back by read_csd, which reads the full CSDs of mne as well.
+
+"""
+import os
+import numpy as np
+from beartype import beartype
+from numpy.typing import NDArray
+
+h5_title = "pair_csd" # title of the pair-subset CSDs in their h5 files (mne CSDs are saved with the title 'conpy')
+
+
+@beartype
+def get_channel_pairs(ch_names: list[str], channel_groups: dict | None = None, channel_pairs: list | None = None) -> NDArray | None:
+    """
+    Recieves:
+    * ch_names: the channels of the epochs, in their order.
+    * channel_groups: dictionary of ROI name -> list of channel names, all pairs of the channels of the ROIs (within and between them).
+    * channel_pairs: list of (channel name, channel name) pairs.
+
+    Function:
+    * Collects the requested pairs of both arguments and adds the auto-spectra (channel, channel) of every channel they involve.
+      Channels that aren't in ch_names raise a ValueError.
+
+    Returns:
+    * pairs: ndarray (pairs, 2) of indices of ch_names (row <= column, sorted), None if no groups or pairs are given (the full CSD).
+
+    """
+    if not channel_groups and not channel_pairs:
+        return None
+
+    requested = [tuple(pair) for pair in (channel_pairs or [])]
+
+    group_channels = sorted({channel for channels in (channel_groups or {}).values() for channel in channels}, key=str)
+    requested += [(first, second) for first in group_channels for second in group_channels]
+
+    missing = sorted({channel for pair in requested for channel in pair if channel not in ch_names})
+    if missing:
+        raise ValueError(f"the channels {missing} of the CSD pairs aren't channels of the epochs")
+
+    index = {channel: i for i, channel in enumerate(ch_names)}
+    pairs = {tuple(sorted((index[first], index[second]))) for first, second in requested}
+    pairs |= {(channel, channel) for pair in list(pairs) for channel in pair}
+
+    return np.array(sorted(pairs))
+
+
+class PairCSD:
+    """
+    Cross-spectral density of a subset of the channel pairs.
+
+    * _data: ndarray (pairs, frequencies) of the cross-spectra, the auto-spectra are the pairs (channel, channel).
+    * ch_names: the channels of the pairs.
+    * pairs: ndarray (pairs, 2) of indices of ch_names (see get_channel_pairs).
+    * frequencies, n_fft, tmin, tmax, projs: as in mne.time_frequency.CrossSpectralDensity (frequencies is a list of arrays
+      of the frequencies of every band after mean).
+
+    """
+
+    def __init__(self, data: NDArray, ch_names: list[str], pairs: NDArray, frequencies, n_fft: int, tmin: float | None = None,
+                 tmax: float | None = None, projs: list | None = None):
+        pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+        data = np.asarray(data).reshape(len(pairs), -1)
+
+        if not all((channel, channel) in set(map(tuple, pairs.tolist())) for channel in np.unique(pairs)):
+            raise ValueError("the pairs of a PairCSD should include the auto-spectra of their channels")
+
+        self._data = data
+        self.ch_names = list(ch_names)
+        self.pairs = pairs
+        self.frequencies = frequencies
+        self.n_fft = n_fft
+        self.tmin = tmin
+        self.tmax = tmax
+        self.projs = projs
+
+    @property
+    def n_channels(self) -> int:
+        return len(self.ch_names)
+
+    def __repr__(self) -> str:
+        return f"<PairCSD | {len(self.pairs)} pairs of {self.n_channels} channels, {len(self.frequencies)} frequencies>"
+
+    def mean(self, fmin=None, fmax=None) -> "PairCSD":
+        """
+        Recieves:
+        * fmin, fmax: lower and upper bounds (inclusive) of the frequency bands, as in CrossSpectralDensity.mean.
+
+        Returns:
+        * csd_mean: the PairCSD averaged over the frequencies of every band.
+
+        """
+        frequencies = np.asarray(self.frequencies)
+        fmin = [frequencies[0]] if fmin is None else np.atleast_1d(fmin)
+        fmax = [frequencies[-1]] if fmax is None else np.atleast_1d(fmax)
+
+        bands = [np.flatnonzero((frequencies >= low) & (frequencies <= high)) for low, high in zip(fmin, fmax)]
+        data = np.stack([self._data[:, band].mean(axis=1) for band in bands], axis=1)
+
+        return PairCSD(data, self.ch_names, self.pairs, [frequencies[band] for band in bands], self.n_fft, self.tmin, self.tmax, self.projs)
+
+    def coherence(self) -> NDArray:
+        """
+        Returns:
+        * coherence: ndarray (pairs, frequencies) of |csd_ij| / sqrt(csd_ii * csd_jj), as CrossSpectralDensity.plot(mode='coh').
+
+        """
+        auto_spectra = np.zeros((self.n_channels, self._data.shape[1]))
+        diagonal = self.pairs[:, 0] == self.pairs[:, 1]
+        auto_spectra[self.pairs[diagonal, 0]] = np.abs(self._data[diagonal])
+
+        return np.abs(self._data) / np.sqrt(auto_spectra[self.pairs[:, 0]] * auto_spectra[self.pairs[:, 1]])
+
+    def get_matrix(self, index: int, mode: str = "csd") -> NDArray:
+        """
+        Recieves:
+        * index: index of the frequency (or band).
+        * mode: 'csd' (magnitude of the cross-spectra) or 'coh' (coherence).
+
+        Returns:
+        * matrix: ndarray (channels, channels), NaN for the pairs that weren't computed.
+
+        """
+        values = self.coherence()[:, index] if mode == "coh" else np.abs(self._data[:, index])
+
+        matrix = np.full((self.n_channels, self.n_channels), np.nan)
+        matrix[self.pairs[:, 0], self.pairs[:, 1]] = values
+        matrix[self.pairs[:, 1], self.pairs[:, 0]] = values
+
+        return matrix
+
+    def plot(self, info=None, mode: str = "csd", colorbar: bool = True, cmap: str = "viridis", n_cols: int | None = None, show: bool = True) -> list:
+        """
+        Recieves:
+        * info: unused, for the signature of CrossSpectralDensity.plot.
+        * mode: 'csd' (magnitude of the cross-spectra) or 'coh' (coherence).
+        * colorbar, cmap, n_cols, show: as in CrossSpectralDensity.plot.
+
+        Function:
+        * Plots the channels x channels matrix of every frequency (or band) as CrossSpectralDensity.plot, the pairs that weren't
+          computed are left blank.
+
+        Returns:
+        * figures: list with the figure (as CrossSpectralDensity.plot).
+
+        """
+        import matplotlib.pyplot as plt
+
+        n_frequencies = len(self.frequencies)
+        n_cols = min(n_frequencies, 4) if n_cols is None else n_cols
+        n_rows = int(np.ceil(n_frequencies / n_cols))
+
+        fig, axes = plt.subplots(n_rows, n_cols, figsize=(2.5 * n_cols, 2.5 * n_rows), squeeze=False)
+        matrices = [self.get_matrix(index, mode) for index in range(n_frequencies)]
+        vmax = max(np.nanmax(matrix) for matrix in matrices)
+
+        for ax, matrix, frequency in zip(axes.ravel(), matrices, self.frequencies):
+            image = ax.imshow(matrix, cmap=cmap, vmin=0, vmax=vmax, interpolation="nearest")
+            frequency = np.atleast_1d(frequency)
+            ax.set_title(f"{frequency[0]:.1f} Hz" if len(frequency) == 1 else f"{frequency[0]:.1f}-{frequency[-1]:.1f} Hz")
+
+            if self.n_channels <= 20:
+                ax.set_xticks(range(self.n_channels), self.ch_names, rotation=90, fontsize=6)
+                ax.set_yticks(range(self.n_channels), self.ch_names, fontsize=6)
+            else:
+                ax.set_xticks([])
+                ax.set_yticks([])
+
+        for ax in axes.ravel()[n_frequencies:]:
+            ax.set_visible(False)
+
+        if colorbar:
+            fig.colorbar(image, ax=axes.ravel().tolist(), label="coherence" if mode == "coh" else "CSD magnitude")
+
+        fig.suptitle("Coherence" if mode == "coh" else "Cross-spectral density")
+
+        if show:
+            plt.show()
+
+        return [fig]
+
+    def save(self, fname: str|os.PathLike, overwrite: bool = False):
+        """
+        Recieves:
+        * fname: path of the h5 file.
+        * overwrite: bool, overwrite an existing file.
+
+        Function:
+        * Saves the PairCSD (read back by read_csd).
+
+        """
+        from h5io import write_hdf5
+
+        state = {"data": self._data, "ch_names": self.ch_names, "pairs": self.pairs, "frequencies": self.frequencies, "n_fft": self.n_fft,
+                 "tmin": self.tmin, "tmax": self.tmax, "projs": self.projs}
+
+        if os.path.exists(fname) and not overwrite:
+            raise FileExistsError(f"{fname} exists, use overwrite=True")
+
+        write_hdf5(fname, state, title=h5_title, overwrite=True)
+
+
+@beartype
+def read_csd(fname: str|os.PathLike):
+    """
+    Recieves:
+    * fname: path of a CSD h5 file, saved by PairCSD.save or by mne.time_frequency.CrossSpectralDensity.save.
+
+    Returns:
+    * csd: the PairCSD or the mne CrossSpectralDensity of the file.
+
+    """
+    import h5py
+    from h5io import read_hdf5
+
+    with h5py.File(fname, "r") as f:
+        is_pair_csd = h5_title in f
+
+    if not is_pair_csd:
+        from mne.time_frequency import read_csd as read_mne_csd
+        return read_mne_csd(str(fname))
+
+    state = read_hdf5(fname, title=h5_title)
+
+    if state["projs"] is not None:
+        from mne import Projection
+        state["projs"] = [Projection(**proj) for proj in state["projs"]]
+
+    return PairCSD(**state)
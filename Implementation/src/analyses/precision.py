@@ -0,0 +1,383 @@
+"""
+
+The FFT backend of the wavelet transforms of the CSD and TFR, and their precision (config.compute_dtype).
+All channels (and epochs) of a transform are convolved with all wavelets in batched FFTs. The spectra of the wavelets depend only on
+(sfreq, n_times, freqs, n_cycles), the same for every condition and subject: they are computed once and cached in memory and in
+config.wavelet_cache_directory, shared by the worker processes and the next runs (see morlet_spectra and multitaper_spectra).
+The wavelets are grouped by length and every group is convolved with its own FFT length (see _group_wavelets): the long wavelets of
+the low frequencies don't set the FFT length of all frequencies. The multi-rate transform of the CSDs (config.csd_multirate, see
+cwt_at_samples) computes every frequency from the band of its wavelet only, at the decimated samples the CSD averages over.
+In "float64" the transforms run in complex128 and reproduce the mne transforms to rounding (the reference path),
+in "float32" the trials stay in single precision and the transforms run in complex64, half the memory and memory traffic of complex128.
+The results are accumulated in double precision by the callers: the cross spectra of the epochs are summed in complex128
+(compute_csd._accumulate_csd_block) and the power is averaged over tapers in float64 (tfr_psd_analyses.compute_tfr_contrast).
+The accuracy of float32 against float64 is measured by benchmarks/precision_report.py.
+
+"""
+import os, hashlib, threading
+import numpy as np
+from beartype import beartype
+from numpy.typing import NDArray
+from src import config
+
+compute_dtypes = {"float64": (np.float64, np.complex128), "float32": (np.float32, np.complex64)}
+
+_spectra_cache = {} # key -> wavelet spectra of this process (see _cached_spectra)
+_spectra_cache_lock = threading.Lock()
+
+
+@beartype
+def get_dtypes(compute_dtype: str = config.compute_dtype) -> tuple[type, type]:
+    """
+    Recieves:
+    * compute_dtype: 'float32' or 'float64' (see config.compute_dtype).
+
+    Returns:
+    * real_dtype, complex_dtype: the numpy dtypes of the trials and of the transforms.
+
+    """
+    if compute_dtype not in compute_dtypes:
+        raise ValueError(f"compute_dtype should be 'float32' or 'float64', got {compute_dtype}")
+
+    return compute_dtypes[compute_dtype]
+
+
+def _group_wavelets(lengths: NDArray, n_times: int) -> list[tuple[NDArray, int]]:
+    # groups of wavelets convolved with the same FFT length, the partition of the wavelets (sorted by length) with the least
+    # FFT work: a group costs an FFT per wavelet and half an FFT for the real signal, at the FFT length of its longest wavelet
+    from scipy.fft import next_fast_len
+
+    order = np.argsort(lengths, kind="stable")
+    nffts = [next_fast_len(int(n_times + lengths[index] - 1)) for index in order]
+
+    best, cuts = [0.0] + [np.inf] * len(order), [0] * (len(order) + 1)
+    for stop in range(1, len(order) + 1):
+        for start in range(stop):
+            cost = best[start] + (stop - start + 0.5) * nffts[stop - 1] * np.log2(nffts[stop - 1])
+            if cost < best[stop]:
+                best[stop], cuts[stop] = cost, start
+
+    groups, stop = [], len(order)
+    while stop > 0:
+        groups.append((order[cuts[stop]:stop], nffts[stop - 1]))
+        stop = cuts[stop]
+
+    return groups[::-1]
+
+
+@beartype
+def fft_wavelets(wavelets: list, n_times: int, compute_dtype: str = config.compute_dtype) -> dict:
+    """
+    Recieves:
+    * wavelets: list of the wavelets (complex 1D-arrays, e.g. mne.time_frequency.morlet), one per frequency.
+    * n_times: number of time points of the signals to transform.
+    * compute_dtype: 'float32' or 'float64', the precision of the transform.
+
+    Function:
+    * Computes the spectra of the wavelets once for all signals of n_times time points, per group of wavelets of similar length
+      with the shortest FFT length of the group that gives the linear convolution (see _group_wavelets).
+
+    Returns:
+    * wavelet_spectra: dictionary with 'groups' (list of {'indices' (of the wavelets), 'spectra' (ndarray (wavelets, nfft) of the
+      complex dtype), 'starts' (first sample of the centered convolution per wavelet)}), 'lengths' (of the wavelets), 'n_times' and 'compute_dtype'.
+
+    """
+    from scipy.fft import fft
+
+    real_dtype, complex_dtype = get_dtypes(compute_dtype)
+
+    lengths = np.array([len(wavelet) for wavelet in wavelets])
+    groups = [{"indices": indices, "spectra": np.stack([fft(wavelets[index], nfft) for index in indices]).astype(complex_dtype),
+               "starts": (lengths[indices] - 1) // 2}
+              for indices, nfft in _group_wavelets(lengths, n_times)]
+
+    return {"groups": groups, "lengths": lengths, "n_times": n_times, "compute_dtype": compute_dtype}
+
+
+def _spectra_file(cache_directory: str|os.PathLike, key: tuple) -> str:
+    # the file of the spectra of key in the cache folder, named by a hash of the key
+    return os.path.join(cache_directory, f"{key[0]}_{hashlib.sha1(repr(key).encode()).hexdigest()[:16]}.h5")
+
+
+def _save_spectra(file: str, key: tuple, taper_spectra: list[dict]):
+    # writes to a temporary file renamed to file, workers writing the same spectra at the same time don't read partial files
+    import h5io
+
+    tmp_file = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    h5io.write_hdf5(tmp_file, {"key": repr(key), "spectra": taper_spectra}, overwrite=True)
+    os.replace(tmp_file, file)
+
+
+def _load_spectra(file: str, key: tuple) -> list[dict] | None:
+    # the spectra saved by _save_spectra, None if the file is missing, unreadable or of another key
+    import h5io
+
+    try:
+        saved = h5io.read_hdf5(file)
+    except (OSError, KeyError, ValueError, TypeError):
+        return None
+
+    return saved["spectra"] if saved.get("key") == repr(key) else None
+
+
+def _cached_spectra(key: tuple, create, cache_directory: str|os.PathLike|None) -> list[dict]:
+    # the spectra of key from the memory of the process, the cache folder or created (and saved to both). The cache folder is used
+    # if its parent folder exists (e.g. the subjects folder), a missing or unwritable folder leaves the spectra in memory only
+    with _spectra_cache_lock:
+        if key in _spectra_cache:
+            return _spectra_cache[key]
+
+    use_directory = cache_directory is not None and os.path.isdir(os.path.dirname(os.path.abspath(cache_directory)))
+    taper_spectra = _load_spectra(_spectra_file(cache_directory, key), key) if use_directory else None
+
+    if taper_spectra is None:
+        taper_spectra = create()
+
+        if use_directory:
+            try:
+                os.makedirs(cache_directory, exist_ok=True)
+                _save_spectra(_spectra_file(cache_directory, key), key, taper_spectra)
+            except OSError as e:
+                print(f"The wavelet spectra couldn't be saved to {cache_directory}:", e)
+
+    with _spectra_cache_lock:
+        return _spectra_cache.setdefault(key, taper_spectra)
+
+
+def _key_values(values) -> tuple:
+    # hashable values of the frequencies or numbers of cycles of a key
+    return tuple(np.atleast_1d(np.asarray(values, dtype=float)).tolist())
+
+
+@beartype
+def morlet_spectra(sfreq: float, n_times: int, freqs: NDArray | list, n_cycles: float | NDArray = 7.0,
+                   compute_dtype: str = config.compute_dtype, cache_directory: str|os.PathLike|None = config.wavelet_cache_directory) -> dict:
+    """
+    Recieves:
+    * sfreq: sampling frequency.
+    * n_times: number of time points of the signals to transform.
+    * freqs: frequencies of the wavelets.
+    * n_cycles: number of cycles of the wavelets (mne.time_frequency.morlet).
+    * compute_dtype: 'float32' or 'float64', the precision of the transform.
+    * cache_directory: folder of the saved spectra, None to keep them in memory only.
+
+    Function:
+    * The spectra of the Morlet wavelets (see fft_wavelets), computed once per (sfreq, n_times, freqs, n_cycles, compute_dtype)
+      and reused by every later call of the process, and of other processes and runs through the cache folder.
+
+    Returns:
+    * wavelet_spectra: the spectra of the wavelets (see fft_wavelets).
+
+    """
+    from mne.time_frequency import morlet
+
+    key = ("morlet", float(sfreq), n_times, _key_values(freqs), _key_values(n_cycles), compute_dtype)
+
+    def create():
+        return [fft_wavelets(morlet(sfreq, freqs, n_cycles=n_cycles), n_times, compute_dtype)]
+
+    return _cached_spectra(key, create, cache_directory)[0]
+
+
+@beartype
+def multitaper_spectra(sfreq: float, n_times: int, freqs: NDArray | list, n_cycles: float | NDArray = 7.0, time_bandwidth: float = 4.0,
+                       compute_dtype: str = config.compute_dtype, cache_directory: str|os.PathLike|None = config.wavelet_cache_directory) -> list[dict]:
+    """
+    Recieves:
+    * sfreq, n_times, freqs, n_cycles, compute_dtype, cache_directory: see morlet_spectra.
+    * time_bandwidth: time bandwidth product of the DPSS tapers.
+
+    Function:
+    * The spectra of the DPSS tapered wavelets of mne's multitaper transform (zero mean, as tfr_array_multitaper), cached as morlet_spectra.
+
+    Returns:
+    * taper_spectra: list of the spectra of the wavelets of every taper (see fft_wavelets).
+
+    """
+    from mne.time_frequency.tfr import _make_dpss
+
+    key = ("multitaper", float(sfreq), n_times, _key_values(freqs), _key_values(n_cycles), float(time_bandwidth), compute_dtype)
+
+    def create():
+        tapers = _make_dpss(sfreq, freqs, n_cycles=n_cycles, time_bandwidth=time_bandwidth, zero_mean=True)
+        return [fft_wavelets(list(taper_wavelets), n_times, compute_dtype) for taper_wavelets in tapers]
+
+    return _cached_spectra(key, create, cache_directory)
+
+
+@beartype
+def band_spectra(sfreq: float, n_times: int, freqs: NDArray | list, n_cycles: float | NDArray = 7.0, tolerance: float = config.csd_band_tolerance,
+                 compute_dtype: str = config.compute_dtype, cache_directory: str|os.PathLike|None = config.wavelet_cache_directory) -> dict:
+    """
+    Recieves:
+    * sfreq, n_times, freqs, n_cycles, compute_dtype, cache_directory: see morlet_spectra.
+    * tolerance: the band of a wavelet is the FFT bins where the magnitude of its spectrum is at least tolerance x its peak.
+
+    Function:
+    * The spectra of the Morlet wavelets on their bands only (the multi-rate transform, see cwt_at_samples): a wavelet is a band pass
+      filter, the bins outside its band are dropped. The number of bins of a wavelet is proportional to its bandwidth (~20 bins at 3 Hz,
+      ~200 at 31 Hz with tolerance 1e-5 and 1119 time points), the sampling rate of its demodulated signal. Cached as morlet_spectra.
+
+    Returns:
+    * band_spectra: dictionary with 'bands' (list of {'bins' (of the FFT), 'spectra'} per wavelet), 'starts' (first sample of the
+      centered convolution per wavelet), 'lengths', 'nfft', 'n_times' and 'compute_dtype'.
+
+    """
+    from scipy.fft import fft, next_fast_len
+    from mne.time_frequency import morlet
+
+    key = ("band", float(sfreq), n_times, _key_values(freqs), _key_values(n_cycles), float(tolerance), compute_dtype)
+
+    def create():
+        real_dtype, complex_dtype = get_dtypes(compute_dtype)
+
+        wavelets = morlet(sfreq, freqs, n_cycles=n_cycles)
+        lengths = np.array([len(wavelet) for wavelet in wavelets])
+        nfft = next_fast_len(int(n_times + lengths.max() - 1))
+
+        bands = []
+        for wavelet in wavelets:
+            spectrum = fft(wavelet, nfft)
+            bins = np.flatnonzero(np.abs(spectrum) >= tolerance * np.abs(spectrum).max())
+            bands.append({"bins": bins, "spectra": spectrum[bins].astype(complex_dtype)})
+
+        return [{"bands": bands, "starts": (lengths - 1) // 2, "lengths": lengths, "nfft": nfft, "n_times": n_times, "compute_dtype": compute_dtype}]
+
+    return _cached_spectra(key, create, cache_directory)[0]
+
+
+@beartype
+def band_sample_matrices(band_spectra: dict, samples: NDArray[np.integer]) -> list[NDArray]:
+    """
+    Recieves:
+    * band_spectra: the spectra of the wavelets on their bands (see band_spectra).
+    * samples: the time points (of the signals) at which the transform is evaluated.
+
+    Returns:
+    * sample_matrices: list of ndarrays (bins, samples) per wavelet, the inverse FFT of the band of the wavelet at the samples
+      (with the spectrum of the wavelet), computed once for all signals of cwt_at_samples.
+
+    """
+    real_dtype, complex_dtype = get_dtypes(band_spectra["compute_dtype"])
+    nfft = band_spectra["nfft"]
+
+    return [(band["spectra"][:, np.newaxis] * np.exp(2j * np.pi * np.outer(band["bins"], start + samples) / nfft) / nfft).astype(complex_dtype)
+            for band, start in zip(band_spectra["bands"], band_spectra["starts"])]
+
+
+@beartype
+def cwt_at_samples(signals: NDArray[np.floating], band_spectra: dict, sample_matrices: list[NDArray]) -> NDArray[np.complexfloating]:
+    """
+    Recieves:
+    * signals: ndarray (signals, time points), cast to the precision of band_spectra.
+    * band_spectra: the spectra of the wavelets on their bands (see band_spectra).
+    * sample_matrices: the matrices of the samples (see band_sample_matrices).
+
+    Function:
+    * Multi-rate continuous wavelet transform: the transform of cwt at the samples only, every frequency from the bins of its band.
+      The signals are transformed by a single FFT, every frequency is then a product of the bins of its band with its sample matrix,
+      the work of a frequency is proportional to its bandwidth and to the number of samples, not to the FFT length.
+      Equal to cwt at the samples up to the spectrum of the wavelets outside their bands (see band_spectra).
+
+    Returns:
+    * coefs: ndarray (signals, freqs, samples) of the complex dtype.
+
+    """
+    from scipy.fft import rfft
+
+    real_dtype, complex_dtype = get_dtypes(band_spectra["compute_dtype"])
+    nfft = band_spectra["nfft"]
+
+    # spectrum of the real signals, the negative frequencies are the conjugates of the positive frequencies
+    half_spectrum = rfft(signals.astype(real_dtype, copy=False), nfft, axis=-1)
+
+    coefs = np.empty((len(signals), len(sample_matrices), sample_matrices[0].shape[1]), dtype=complex_dtype)
+
+    for k, (band, sample_matrix) in enumerate(zip(band_spectra["bands"], sample_matrices)):
+        negative = band["bins"] > nfft // 2
+        band_spectrum = half_spectrum[:, np.where(negative, nfft - band["bins"], band["bins"])]
+        band_spectrum[:, negative] = band_spectrum[:, negative].conj()
+
+        coefs[:, k] = band_spectrum @ sample_matrix
+
+    return coefs
+
+
+@beartype
+def cwt(signals: NDArray[np.floating], wavelet_spectra: dict, decim: int = 1) -> NDArray[np.complexfloating]:
+    """
+    Recieves:
+    * signals: ndarray (signals, time points), cast to the precision of wavelet_spectra.
+    * wavelet_spectra: the spectra of the wavelets (see fft_wavelets).
+    * decim: every decim-th time point of the transform is returned.
+
+    Function:
+    * Continuous wavelet transform of every signal by FFT convolution, centered as mne.time_frequency.tfr.cwt(mode='same', decim=decim):
+      all signals and the wavelets of a group are transformed in one batched FFT, in the precision of wavelet_spectra.
+
+    Returns:
+    * coefs: ndarray (signals, freqs, decimated time points) of the complex dtype.
+
+    """
+    from scipy.fft import rfft, ifft
+
+    real_dtype, complex_dtype = get_dtypes(wavelet_spectra["compute_dtype"])
+    n_times = wavelet_spectra["n_times"]
+    signals = signals.astype(real_dtype, copy=False)
+
+    coefs = np.empty((len(signals), len(wavelet_spectra["lengths"]), len(range(0, n_times, decim))), dtype=complex_dtype)
+
+    for group in wavelet_spectra["groups"]:
+        nfft = group["spectra"].shape[-1]
+
+        # spectrum of the real signals, the negative frequencies are the conjugates of the positive frequencies
+        half_spectrum = rfft(signals, nfft, axis=-1)
+        signal_spectrum = np.empty((len(signals), nfft), dtype=complex_dtype)
+        signal_spectrum[:, :half_spectrum.shape[-1]] = half_spectrum
+        signal_spectrum[:, half_spectrum.shape[-1]:] = half_spectrum[:, 1:(nfft + 1) // 2][:, ::-1].conj()
+
+        convolved = ifft(signal_spectrum[:, np.newaxis, :] * group["spectra"][np.newaxis], axis=-1, overwrite_x=True)
+
+        for k, (index, start) in enumerate(zip(group["indices"], group["starts"])):
+            coefs[:, index] = convolved[:, k, start:start + n_times:decim]
+
+    return coefs
+
+
+@beartype
+def tfr_array_multitaper(data: NDArray[np.floating], sfreq: float, freqs: NDArray, n_cycles: float = 7.0, time_bandwidth: float = 4.0,
+                         compute_dtype: str = config.compute_dtype, block_size: int = 64, decim: int = 1) -> NDArray[np.complexfloating]:
+    """
+    Recieves:
+    * data: ndarray (epochs, channels, time points).
+    * sfreq: sampling frequency.
+    * freqs: 1D-array of the frequencies.
+    * n_cycles, time_bandwidth: parameters of the DPSS tapered wavelets, the defaults of mne.time_frequency.tfr_array_multitaper.
+    * compute_dtype: 'float32' or 'float64', the precision of the transform.
+    * block_size: number of signals (epochs x channels) transformed at a time, bounds the memory of the batched FFT.
+    * decim: every decim-th time point of the spectra is returned (as decim of mne).
+
+    Function:
+    * The complex tapered spectra of mne.time_frequency.tfr_array_multitaper(data, sfreq, freqs, output='complex', decim=decim) (zero mean
+      tapered wavelets, mne's defaults), by the batched transform of cwt per taper with the cached spectra of the tapers (see multitaper_spectra).
+
+    Returns:
+    * coefs: ndarray (epochs, channels, tapers, freqs, decimated time points) of the complex dtype.
+
+    """
+    real_dtype, complex_dtype = get_dtypes(compute_dtype)
+
+    n_epochs, n_channels, n_times = data.shape
+    taper_spectra = multitaper_spectra(sfreq, n_times, freqs, n_cycles=n_cycles, time_bandwidth=time_bandwidth, compute_dtype=compute_dtype)
+
+    n_decimated = len(range(0, n_times, decim))
+    coefs = np.empty((n_epochs, n_channels, len(taper_spectra), len(freqs), n_decimated), dtype=complex_dtype)
+    signals = data.reshape(-1, n_times).astype(real_dtype, copy=False)
+
+    block_coefs = coefs.reshape(n_epochs * n_channels, len(taper_spectra), len(freqs), n_decimated) # view of coefs
+
+    for taper_index, wavelet_spectra in enumerate(taper_spectra):
+        for start in range(0, len(signals), block_size):
+            block_coefs[start:start + block_size, taper_index] = cwt(signals[start:start + block_size], wavelet_spectra, decim)
+
+    return coefs
@@ -1,24 +1,240 @@
+import threading
 import mne
 import numpy as np
 from beartype import beartype
 from numpy.typing import NDArray
-from src import config
+from src import config, epoch_cache, resources
+from analyses import precision
 import traceback
 from tests import input_validation_tests
 
 @beartype
-def compute_tfr_contrast(epochs: mne.EpochsArray, freqs: NDArray, con1: tuple, con2: tuple)\
+def compute_condition_sums(epochs: mne.EpochsArray | mne.epochs.EpochsFIF | epoch_cache.EpochCache, block_size: int = 64) -> dict:
+    """
+
+    Recieves:
+    * epochs: mne.EpochsArray object, with the conditions of event_ids (not combined), or the EpochCache of the subject (see epoch_cache.py).
+    * block_size: number of trials summed at a time if the trials are float32 (a float32 cache).
+
+    Function:
+    * Computes the sufficient statistics for averaging any group of conditions: the sum of the trials and the number of trials 
+      of every event_id key, in a single grouped pass over the epochs data (a matrix product with the condition indicators) without copying it.
+
+    Returns: 
+    * condition_sums: dictionary with keys 'sums' (dict of condition -> ndarray (channels, time points)), 'counts' (dict of condition -> int),
+      'info' (mne.Info of the epochs) and 'tmin'.
+
+    """
+    # the matrix products run on the BLAS threads of the resource plan of the process (see resources.py)
+    resources.get_resource_plan()
+
+    data = epochs.get_data(copy=False)
+    conditions = list(epochs.event_id.keys())
+
+    # indicator matrix (conditions, trials), 1 where the trial belongs to the condition
+    codes = np.array([epochs.event_id[condition] for condition in conditions])
+    indicators = (codes[:, np.newaxis] == epochs.events[np.newaxis, :, 2]).astype(np.float64)
+
+    if data.dtype == np.float64:
+        sums = (indicators @ data.reshape(len(data), -1)).reshape((len(conditions),) + data.shape[1:])
+
+    else:
+        # float32 trials are summed in float64 block by block, without a float64 copy of all trials
+        sums = np.zeros((len(conditions), np.prod(data.shape[1:])))
+        for start in range(0, len(data), block_size):
+            sums += indicators[:, start:start + block_size] @ data[start:start + block_size].reshape(-1, sums.shape[1]).astype(np.float64)
+        sums = sums.reshape((len(conditions),) + data.shape[1:])
+
+    condition_sums = {"sums": dict(zip(conditions, sums)), "counts": dict(zip(conditions, indicators.sum(axis=1).astype(int).tolist())), 
+                      "info": epochs.info, "tmin": epochs.tmin}
+
+    return condition_sums
+
+
+@beartype
+def get_leaf_conditions(names: list[str], conditions: list[str]) -> list[str]:
+    """
+
+    Recieves:
+    * names: list of names of conditions, combined conditions (keys of config.new_event_ids) or tags (e.g. 'short/rep1').
+    * conditions: list of the (leaf) conditions, keys of config.event_ids.
+
+    Function:
+    * Resolves the names to the leaf conditions they include: a condition is included by its own name, by the combined condition 
+      it is combined under (see combine_epochs) or by tags if its name contains all of them (as in mne epochs[tags]).
+
+    Returns: 
+    * leaf_conditions: list of the included conditions, in the order of conditions.
+
+    """
+    from mat_to_epochs_conversion import get_combined_conditions
+
+    combined_conditions = get_combined_conditions(config.event_ids, config.new_event_ids)
+
+    leaf_conditions = set()
+
+    for name in names:
+        if name in conditions:
+            leaf_conditions.add(name)
+
+        elif name in combined_conditions:
+            leaf_conditions.update(combined_conditions[name])
+
+        else:
+            leaf_conditions.update(condition for condition in conditions if set(name.split('/')).issubset(condition.split('/')))
+
+    return [condition for condition in conditions if condition in leaf_conditions]
+
+
+@beartype
+def evoked_from_condition_sums(condition_sums: dict, names: list[str]) -> mne.EvokedArray:
+    """
+
+    Recieves:
+    * condition_sums: dictionary of sums and counts per condition (see compute_condition_sums).
+    * names: list of names of the conditions to average (see get_leaf_conditions).
+
+    Function:
+    * Averages all trials of the conditions from the sums and counts, without touching the trial data.
+      The same evoked response as epochs[names].average().
+
+    Returns: 
+    * evoked: mne.EvokedArray of the average.
+
+    """
+
+    leaf_conditions = get_leaf_conditions(names, list(condition_sums["sums"].keys()))
+
+    total = sum(condition_sums["sums"][condition] for condition in leaf_conditions)
+    nave = sum(condition_sums["counts"][condition] for condition in leaf_conditions)
+
+    evoked = mne.EvokedArray(total / nave, condition_sums["info"], tmin=condition_sums["tmin"], nave=nave, comment=" + ".join(names))
+
+    return evoked
+
+
+@beartype
+def create_tfr_coefs_cache(condition_sums: dict, freqs: NDArray, conditions: list[str] | None = None, compute_dtype: str = config.compute_dtype,
+                           tmin: float = config.baseline_time[0], tmax: float = config.post_stim_time[1]) -> dict:
+    """
+
+    Recieves:
+    * condition_sums: dictionary of sums and counts per condition (see compute_condition_sums).
+    * freqs: 1D-array of the frequencies of the TFRs.
+    * conditions: list of names of the conditions to transform (see get_leaf_conditions), None for the (leaf) conditions of condition_sums,
+      the conditions of event_ids, every union or tag contrast is derived from their spectra.
+    * compute_dtype: 'float64' or 'float32', precision of the multitaper transform and of the cached spectra (see analyses/precision.py).
+    * tmin, tmax: time range of the TFRs, the evoked responses are cropped to it before the transform (as compute_tfr(tmin=, tmax=)).
+
+    Function:
+    * Creates the cache of the complex tapered spectra (multitaper, as in compute_tfr) of the evoked response of every condition.
+      The spectra are computed once per subject, when first needed by compute_tfr_contrast. The multitaper transform is linear, 
+      the spectra of any contrast between unions of the conditions is a weighted difference of the cached spectra (see contrast_coefs_from_cache).
+      The cache may be shared by contrasts computed concurrently (in threads), the spectra are computed once.
+
+    Returns: 
+    * tfr_coefs_cache: dictionary with keys 'condition_sums', 'freqs', 'conditions', 'compute_dtype', 'tmin', 'tmax', 'times' 
+      (of the cropped evoked responses), 'coefs' (ndarray (conditions, channels, tapers, freqs, time points), None until first needed) and 'lock'.
+
+    """
+
+    if conditions is None:
+        conditions = list(condition_sums["sums"].keys())
+
+    times = evoked_from_condition_sums(condition_sums, [conditions[0]]).crop(tmin, tmax).times
+
+    tfr_coefs_cache = {"condition_sums": condition_sums, "freqs": freqs, "conditions": conditions, "compute_dtype": compute_dtype, 
+                       "tmin": tmin, "tmax": tmax, "times": times, "coefs": None, "lock": threading.Lock()}
+
+    return tfr_coefs_cache
+
+
+def _condition_weights(tfr_coefs_cache: dict, names: list[str]) -> NDArray | None:
+    # weights of the cached conditions in the average of names (number of trials of the condition / number of trials of names), 
+    # None if names isn't a union of the cached conditions
+    condition_sums = tfr_coefs_cache["condition_sums"]
+    leaf_conditions = list(condition_sums["sums"].keys())
+
+    names_leaves = set(get_leaf_conditions(names, leaf_conditions))
+    included_leaves = set()
+    counts = np.zeros(len(tfr_coefs_cache["conditions"]))
+
+    for i, condition in enumerate(tfr_coefs_cache["conditions"]):
+        condition_leaves = set(get_leaf_conditions([condition], leaf_conditions))
+
+        if condition_leaves and condition_leaves.issubset(names_leaves):
+            included_leaves.update(condition_leaves)
+            counts[i] = sum(condition_sums["counts"][leaf] for leaf in condition_leaves)
+
+    if included_leaves != names_leaves:
+        return None
+
+    return counts / counts.sum()
+
+
+@beartype
+def contrast_coefs_from_cache(tfr_coefs_cache: dict, freqs: NDArray, names_1: list[str], names_2: list[str]) -> NDArray | None:
+    """
+
+    Recieves:
+    * tfr_coefs_cache: the cache of spectra of the conditions (see create_tfr_coefs_cache).
+    * freqs: 1D-array of the frequencies of the TFR.
+    * names_1, names_2: lists of names of the conditions to contrast (names_1 - names_2).
+
+    Function:
+    * Derives the complex tapered spectra of the contrast between the averages of names_1 and names_2 from the cached spectra 
+      of the conditions, computing the cached spectra if not computed yet.
+
+    Returns: 
+    * contrast_coefs: ndarray (channels, tapers, freqs, time points) in the complex dtype of the cache, None if freqs are not the cached frequencies or 
+      names_1 or names_2 are not unions of the cached conditions.
+
+    """
+
+    if not np.array_equal(freqs, tfr_coefs_cache["freqs"]):
+        return None
+
+    weights_1 = _condition_weights(tfr_coefs_cache, names_1)
+    weights_2 = _condition_weights(tfr_coefs_cache, names_2)
+
+    if weights_1 is None or weights_2 is None:
+        return None
+
+    # the first contrast computes the spectra, concurrent contrasts wait for them
+    with tfr_coefs_cache["lock"]:
+        if tfr_coefs_cache["coefs"] is None:
+            condition_sums = tfr_coefs_cache["condition_sums"]
+            data = np.stack([evoked_from_condition_sums(condition_sums, [condition]).crop(tfr_coefs_cache["tmin"], tfr_coefs_cache["tmax"]).data 
+                             for condition in tfr_coefs_cache["conditions"]])
+            tfr_coefs_cache["coefs"] = precision.tfr_array_multitaper(data, condition_sums["info"]["sfreq"], freqs, 
+                                                                      compute_dtype=tfr_coefs_cache["compute_dtype"])
+
+    # weights in the precision of the spectra, complex64 spectra aren't copied to complex128
+    real_dtype, _ = precision.get_dtypes(tfr_coefs_cache["compute_dtype"])
+    contrast_coefs = np.tensordot((weights_1 - weights_2).astype(real_dtype), tfr_coefs_cache["coefs"], axes=1)
+
+    return contrast_coefs
+
+
+@beartype
+def compute_tfr_contrast(epochs: mne.EpochsArray | mne.epochs.EpochsFIF | None, freqs: NDArray, con1: tuple, con2: tuple, 
+                         condition_sums: dict | None = None, tfr_coefs_cache: dict | None = None)\
     -> mne.time_frequency.AverageTFR:
     """
 
     Recieves:
-    * epochs: mne.EpochsArray object
+    * epochs: mne.EpochsArray object (may be None if condition_sums is given)
     * freqs: 1D-array, a range of numbers defining the start, end, and step frequencies.
     * con1: tuple, tuple[0] - name of first combined condition to contrast, 
       tuple[1] - a list of str of the name of conditions present in epochs combined under the same new condition -> tuple[0]
+      (names of conditions, combined conditions or tags, see get_leaf_conditions)
     * con2: tuple, tuple[0] - name of second combined condition to contrast, 
       tuple[1] - a list of str of the name of conditions present in epochs combined under the same new condition -> tuple[0]
-    * report: mne.Report instance
+    * condition_sums: the sums and counts per condition of the epochs (see compute_condition_sums), computed once per subject and 
+      shared by all contrasts. Computed from epochs if None.
+    * tfr_coefs_cache: the complex tapered spectra of the conditions (see create_tfr_coefs_cache), shared by all contrasts. 
+      The TFR is derived from the spectra instead of a new multitaper transform (in the precision of the cache, config.compute_dtype).
+      If None, or if con1 or con2 isn't a union of its conditions, the spectra of the leaf conditions are computed for the contrast.
 
     Function:
     * Compute Time-Frequency Representation (TFR) of the contrast (con1-con2) between two conditions and save it to the current directory.
@@ -28,10 +244,16 @@ def compute_tfr_contrast(epochs: mne.EpochsArray, freqs: NDArray, con1: tuple, c
 
     """
 
+    # the transforms run on the BLAS threads of the resource plan of the process (see resources.py)
+    resources.get_resource_plan()
+
     # input testing
     try:
 
-        input_validation_tests.compute_tfr_contrast(epochs, freqs, con1, con2)
+        if condition_sums is None:
+            condition_sums = compute_condition_sums(epochs)
+
+        input_validation_tests.compute_tfr_contrast(condition_sums, freqs, con1, con2)
 
     except Exception as e:
         print("An error occured:", e)
@@ -39,30 +261,24 @@ def compute_tfr_contrast(epochs: mne.EpochsArray, freqs: NDArray, con1: tuple, c
 
     else:
         try:
-            # Duplicate the epochs and work with the copy
-            epochs_copy = epochs.copy()
+            # Note: baselining is preformed in the spectrum and topo-map plots in add_to_report.py and that's why it's not included here
 
-            # Take the average within each condition
-            epochs_con_1 = epochs_copy[con1[1]].average()
-            epochs_con_2 = epochs_copy[con2[1]].average()
+            # Compute TFR
+            try:
+                contrast_coefs = None if tfr_coefs_cache is None else contrast_coefs_from_cache(tfr_coefs_cache, freqs, con1[1], con2[1])
 
-            # Subtract the data (assuming the data shapes are the same)
-            contrast = epochs_con_1.data - epochs_con_2.data
+                if contrast_coefs is None:
+                    # every contrast is a union of the leaf conditions of the sums
+                    tfr_coefs_cache = create_tfr_coefs_cache(condition_sums, freqs)
+                    contrast_coefs = contrast_coefs_from_cache(tfr_coefs_cache, freqs, con1[1], con2[1])
 
-            # Create a new info object, assuming the same channels and info as the original EvokedArrays
-            info = epochs_con_1.info 
+                # power of the contrast averaged over tapers, as in compute_tfr(method='multitaper'), averaged in float64
+                power = (contrast_coefs * contrast_coefs.conj()).real.mean(axis=1, dtype=np.float64)
+                tfr_contrast = mne.time_frequency.AverageTFRArray(condition_sums["info"], power, tfr_coefs_cache["times"], freqs, 
+                                                                  nave=1, method='multitaper')
 
-            # Create a new Evoked object with the contrast data
-            # Note: baselining is preformed in the spectrum and topo-map plots in add_to_report.py and that's why it's not included here
-            evo_contrast = mne.EvokedArray(contrast, info, tmin=epochs_con_1.tmin)
-            
-            # Compute TFR
-            try:
-                tfr_contrast = evo_contrast.compute_tfr(method='multitaper', tmin=config.baseline_time[0], tmax=config.post_stim_time[1], freqs=freqs)
+                tfr_contrast.save(config.get_tfr_contrast_path(con1, con2), overwrite=True)
 
-                tfr_contrast.save(config.get_tfr_contrast_path(con1, con2))
-                traceback.print_exc()
-                
             except ValueError as e:
                 print(f"Error in computing the TFR: {e}\nAdjust the frequency range. freqs=(8, 24, 2) works best!")
 
@@ -97,11 +313,11 @@ def compute_psd(evoked_instance: mne.Evoked, fmin: int, fmax: int, tmin: float,
     """
 
     try:
+        # a single evoked response, computed in this process on the BLAS threads of the resource plan (see resources.py)
+        resources.get_resource_plan()
+        psd = evoked_instance.compute_psd(method='multitaper', fmin=fmin, fmax=fmax, tmin=tmin, tmax=tmax, picks=picks, n_jobs=1)
 
-
-        psd = evoked_instance.compute_psd(method='multitaper', fmin=fmin, fmax=fmax, tmin=tmin, tmax=tmax, picks=picks)
-
-        psd.save(config.psd_path)
+        psd.save(config.psd_path, overwrite=True)
 
     except Exception as e:
         print("An error occured:", e)
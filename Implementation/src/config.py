@@ -38,6 +38,53 @@ nonfood = ['positive_1', 'positive_2', 'neutral_1', 'neutral_2']
 nonfood_1 = ['positive_1', 'neutral_1']
 nonfood_2 = ['positive_2', 'neutral_2']
 
+# Define combination of conditions for contrasting the repetitions within each lag, 
+# names are tags of the event_ids keys (an event_ids key is included if it contains all tags, as in mne epochs['short/rep1'])
+short_rep1 = ['short/rep1']
+short_rep2 = ['short/rep2']
+medium_rep1 = ['medium/rep1']
+medium_rep2 = ['medium/rep2']
+long_rep1 = ['long/rep1']
+long_rep2 = ['long/rep2']
+
+# TFR contrasts computed per subject, each contrast is (con1, con2) with con = (name of the combined condition, list of conditions)
+tfr_contrasts = [
+    (('pres_1', pres_1), ('pres_2', pres_2)),
+    (('food', food), ('nonfood', nonfood)),
+    (('nonfood_1', nonfood_1), ('nonfood_2', nonfood_2)),
+    (('short_rep1', short_rep1), ('short_rep2', short_rep2)),
+    (('medium_rep1', medium_rep1), ('medium_rep2', medium_rep2)),
+    (('long_rep1', long_rep1), ('long_rep2', long_rep2)),
+]
+
+# Induced power and inter-trial coherence of the TFR contrasts, from the single trials (see analyses/induced_power.py):
+
+compute_induced_power = False # adds the compute_induced_power and compute_induced_contrast/<con1>-<con2> stages to the pipeline (a transform of all single trials)
+
+induced_chunk_size = 16 # trials transformed at a time, the spectra of a chunk and their temporaries take ~30 MB per trial (at induced_decim = 8)
+
+induced_decim = 8 # every induced_decim-th time point is accumulated (~8 ms at 1017 Hz, 5 points per cycle at 24 Hz), the accumulators of the 18 conditions take ~280 MB
+
+induced_subtract_evoked = True # subtract the evoked response of its condition from every trial, the power of the phase locked response is left out
+
+# Group level cluster permutation tests of TFR contrasts (see analyses/cluster_statistics.py):
+
+cluster_contrasts = ['food-nonfood', 'pres_1-pres_2'] # '<con1>-<con2>' names of tfr_contrasts tested over the subjects
+
+cluster_n_permutations = 1000
+
+cluster_p_threshold = 0.05 # two tailed p-value of the t-value threshold of the clusters
+
+cluster_seed = 0 # seed of the permutations, the same seed gives the same results
+
+cluster_n_jobs = None # number of worker processes of the permutations, None for the cores of the resource plan (see resources.py)
+
+cluster_batch_size = 32 # permutations computed by a single matrix product (memory: batch_size x channels x freqs x time points x 8 bytes)
+
+cluster_decim = 4 # every cluster_decim-th time point of the TFR contrasts is tested (~4 ms at 1017 Hz, the power at 8-24 Hz is smooth in time)
+
+cluster_baseline_mode = "mean" # baseline correction of the TFR contrasts before the test, as in the TFR plots of the report
+
 #bad + reference channel names
 bad_ch_names = ['A17','A203','TRIGGER','RESPONSE','MLzA','MLyA','MLzaA','MLyaA','MLxA','MLxaA','MRzA','MRxA','MRzaA','MRxaA','MRyA',
                 'MCzA','MRyaA','MCzaA','MCyA','GzxA','MCyaA','MCxA','MCxaA','GyyA','GzyA','GxxA','GyxA','UACurrent','X1','X3','X5','X2','X4','X6']
@@ -50,10 +97,58 @@ time_points = 1119 # number of time points in each event
 
 oddball_id = 8 # the id of the oddball stimulus condition
 
+bad_trials = {} # indices of bad trials to exclude per subject folder name, e.g. {"subject_003": [4, 17]} (indices in the mat file)
+
 baseline_time = (-0.3, 0.0)
 
 post_stim_time = (0.0, 0.8)
 
+# Run parameters:
+
+n_workers = 2 # number of subjects processed in parallel, each in its own worker process (1 runs the subjects serially)
+
+n_stage_workers = 3 # number of independent stages of a subject run concurrently (e.g. CSD per condition, TFR contrasts and PSD), 1 runs them in order
+
+cpu_budget = None # number of cores of the run, divided between the subject processes, their stages, the joblib workers and the BLAS threads (see resources.py), all usable cores if None
+
+memory_budget = None # bytes, the subject processes are limited to memory_budget // subject_memory (the available memory if None)
+
+subject_memory = 8 * 2**30 # bytes, estimated peak memory of a subject process (see the peak_rss of the profile files)
+
+csd_multirate = True # the CSD wavelet transform computes every frequency from the band of its wavelet at the decimated samples only
+                     # (analyses/precision.py, cwt_at_samples), the CSDs are within 5e-7 (relative to the largest value) of the full transform
+
+csd_channel_groups = None # ROIs of a pair-subset CSD, e.g. {"occipital": ["A1", "A2"], "frontal": ["A30", "A31"]}: only the cross spectra of the pairs of 
+                          # the channels of the ROIs (within and between them) and their auto spectra are computed and saved (analyses/pair_csd.py), the full CSD if None
+
+csd_channel_pairs = None # explicit channel pairs of a pair-subset CSD, e.g. [("A1", "A30")], added to the pairs of csd_channel_groups
+
+csd_band_tolerance = 1e-5 # the band of a wavelet: the FFT bins where its spectrum is at least csd_band_tolerance x its peak (smaller is closer to the full transform)
+
+compute_dtype = "float64" # precision of the CSD and TFR transforms (analyses/precision.py): "float32" keeps the trials in single precision and
+                          # runs the wavelet and multitaper transforms in complex64, the sums are still accumulated in double precision
+
+epoch_cache_dtype = compute_dtype # dtype of the cached trials (epoch_cache.py), "float32" halves the cache and the page cache the workers share
+
+shared_memory_directory = None # folder of the trials shared with the CSD and permutation workers by name (shared_arrays.py), None uses /dev/shm (the temporary folder without it)
+
+prefetch_depth = 1 # number of subjects whose raw info and trials are read ahead in a background thread while the current subject is computed (0 disables)
+
+prefetch_memory_budget = 4 * 2**30 # bytes, the subjects read ahead are held in memory up to this size, a larger subject is read by its own stages
+
+report_n_jobs = None # number of processes rendering the report figures of a subject (1 renders them in the subject's process), None for the workers of the resource plan (see resources.py)
+
+use_stage_cache = True # skip the pipeline stages whose inputs didn't change since the last run, their saved outputs are kept
+
+incremental_report = True # reload the saved report (report.h5) and render again only the figures whose inputs changed
+
+trace_memory = False # also record the tracemalloc peak of every stage in the profile of the subject (slows python heavy stages down ~3x)
+
+cprofile_hot_stages = False # dump cProfile statistics of the hot_stages to profile_<stage>.prof in the subject's folder, set n_stage_workers = 1 for it
+                            # (a cProfile only profiles its own thread, the other stage threads and the joblib workers of a stage are not profiled)
+
+hot_stages = ["compute_csd", "compute_tfr_contrast", "compute_induced_power", "add_to_report"] # stages profiled with cProfile (add_to_report includes the topo-plot rendering)
+
 # Paths for file accessing and results saving:
 
 project_directory = "C:/Projects/Data_Science_Project/Implementation" 
@@ -62,6 +157,12 @@ subs_directory = f"{project_directory}/SUBS_DIR"
 
 subject_directory_pattern = f"{subs_directory}/sub*"
 
+group_directory = f"{subs_directory}/group" # grand averages and standard errors over the subjects (see analyses/group_average.py)
+
+wavelet_cache_directory = f"{subs_directory}/wavelet_cache" # spectra of the wavelets of the CSD and TFR transforms, shared by all subjects (see analyses/precision.py)
+
+group_summary_path = "group_summary.json"
+
 mat_file_path_pattern = f"*.mat"
 
 html_report_path = f"report.html"
@@ -74,12 +175,30 @@ epochs_combined_path = "combined_epo.fif"
 
 evoked_path = "evo.fif"
 
+raw_info_path = "raw-info.fif"
+
+epoch_cache_path = "epoch_cache" # folder of the memory-mappable trials of the subject (see epoch_cache.py)
+
 psd_path = "psd.h5"
 
+induced_sums_path = "induced_sums.npz" # per condition accumulators of the induced power and inter-trial coherence
+
+stage_cache_path = "stage_cache.json"
+
+profile_path = "profile.json"
+
 def get_tfr_contrast_path(con1, con2):
     evoked_tfr_contrast_path = f"evoked_tfr_{con1[0]}-{con2[0]}.h5"
     return evoked_tfr_contrast_path
 
+def get_induced_tfr_contrast_path(con1, con2):
+    induced_tfr_contrast_path = f"induced_tfr_{con1[0]}-{con2[0]}.h5"
+    return induced_tfr_contrast_path
+
+def get_itc_contrast_path(con1, con2):
+    itc_contrast_path = f"itc_{con1[0]}-{con2[0]}.h5"
+    return itc_contrast_path
+
 def get_csd_path(condition):
     csd_path = f"csd_{condition}.h5"
     return csd_path
@@ -88,6 +207,23 @@ def get_csd_mean_path(condition):
     csd_mean_path = f"csd_mean_{condition}.h5"
     return csd_mean_path 
 
+def get_csd_baseline_part_path(condition):
+    csd_baseline_part_path = f"csd_baseline_part_{condition}.h5"
+    return csd_baseline_part_path
+
+def get_group_coherence_path(condition):
+    group_coherence_path = f"coherence_{condition}.h5"
+    return group_coherence_path
+
+def get_cluster_path(contrast, kind):
+    # kind: 't' and 'p' (AverageTFR files) or 'clusters' (json file)
+    cluster_path = f"cluster_{kind}_{contrast}.json" if kind == "clusters" else f"cluster_{kind}_{contrast}.h5"
+    return cluster_path
+
+def get_group_path(file_name, statistic):
+    group_path = f"group_{statistic}_{file_name}"
+    return group_path
+
 # Titles and sections for reporting purposes of results:
 
 def get_report_titles(condition=None, contrast=None, fmin=None, fmax=None, tmin=None, tmax=None):
@@ -0,0 +1,200 @@
+"""
+
+Memory-mappable cache of the cleaned trials of a subject, written once after the conversion (pipeline stage write_epoch_cache):
+the trials are a single contiguous array in a .npy file (float32 or float64, config.epoch_cache_dtype), the events, event ids,
+times and info are saved alongside. The analyses open the cache with EpochCache instead of reading the epochs fif file: opening
+maps the file without reading it, the trials are read from the page cache of the system when used, and worker processes that open
+the same cache share the pages instead of holding private copies.
+
+"""
+import os, json
+import numpy as np
+from beartype import beartype
+from numpy.typing import NDArray
+from src import config
+
+data_file = "data.npy"
+events_file = "events.npy"
+info_file = "epochs-info.fif"
+meta_file = "meta.json" # written last, a cache without it is incomplete
+
+
+@beartype
+def get_cache_files(cache_path: str|os.PathLike = config.epoch_cache_path) -> list[str]:
+    """
+    Recieves:
+    * cache_path: path to the cache folder.
+
+    Returns:
+    * the paths of the files of the cache (the outputs of the write_epoch_cache stage).
+
+    """
+    return [os.path.join(cache_path, file_name) for file_name in (data_file, events_file, info_file, meta_file)]
+
+
+@beartype
+def write_epoch_cache(epochs, cache_path: str|os.PathLike = config.epoch_cache_path, dtype: str = config.epoch_cache_dtype,
+                      block_size: int = 64) -> list[str]:
+    """
+    Recieves:
+    * epochs: mne epochs instance (mne.EpochsArray or mne.epochs.EpochsFIF) with the cleaned trials of the subject.
+    * cache_path: path to the cache folder, created if missing.
+    * dtype: 'float32' or 'float64', dtype of the cached trials.
+    * block_size: number of trials converted to dtype at a time.
+
+    Function:
+    * Writes the trials to a contiguous (trials, channels, time points) array of dtype in a .npy file, block by block (a float32 cache
+      never holds a second copy of the trials), and the events, event ids, times and info alongside. The files are written under
+      temporary names and replaced, the meta file last, so an interrupted write never leaves a cache that looks complete.
+
+    Returns:
+    * cache_files: the paths of the written files.
+
+    """
+    import mne
+
+    if dtype not in ("float32", "float64"):
+        raise ValueError(f"dtype should be 'float32' or 'float64', got {dtype}")
+
+    os.makedirs(cache_path, exist_ok=True)
+    data_path, events_path, info_path, meta_path = get_cache_files(cache_path)
+
+    # the meta file is removed first, the cache is incomplete until it is written again
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    n_epochs, n_channels, n_times = len(epochs.events), len(epochs.ch_names), len(epochs.times)
+
+    tmp_data_path = f"{data_path}.tmp.npy"
+    data = np.lib.format.open_memmap(tmp_data_path, mode="w+", dtype=dtype, shape=(n_epochs, n_channels, n_times))
+
+    for start in range(0, n_epochs, block_size):
+        selection = np.arange(start, min(start + block_size, n_epochs))
+        data[selection] = epochs.get_data(item=selection)
+
+    data.flush()
+    del data
+    os.replace(tmp_data_path, data_path)
+
+    np.save(events_path, epochs.events)
+    mne.io.write_info(info_path, epochs.info)
+
+    meta = {"event_id": epochs.event_id, "tmin": float(epochs.tmin), "times": epochs.times.tolist(), "dtype": dtype}
+
+    with open(f"{meta_path}.tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(f"{meta_path}.tmp", meta_path)
+
+    return get_cache_files(cache_path)
+
+
+class EpochCache:
+    """
+    Memory-mapped epochs of a subject (see write_epoch_cache).
+
+    Has the attributes of mne epochs the analyses use (info, ch_names, events, event_id, tmin, times) and get_data, so it can be
+    passed to compute_csd.compute_csd_condition and tfr_psd_analyses.compute_condition_sums in place of the epochs.
+    combined=True presents the events with the combined conditions (config.new_event_ids, see combine_epochs) instead of the
+    conditions of the mat file, the trials are the same.
+
+    Opening reads only the events, the meta file and the info, the trials are mapped read-only (data).
+
+    """
+
+    def __init__(self, cache_path: str|os.PathLike = config.epoch_cache_path, combined: bool = False):
+        import mne
+
+        data_path, events_path, info_path, meta_path = get_cache_files(cache_path)
+
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(f"The epoch cache {cache_path} is missing or incomplete (no {meta_file}), see epoch_cache.write_epoch_cache")
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+        self.cache_path = cache_path
+        self.data = np.load(data_path, mmap_mode="r")
+        self.events = np.load(events_path)
+        self.event_id = meta["event_id"]
+        self.tmin = meta["tmin"]
+        self.times = np.array(meta["times"])
+        self.info = mne.io.read_info(info_path)
+
+        if combined:
+            self.events, self.event_id = combine_events(self.events, self.event_id)
+
+    @property
+    def ch_names(self) -> list[str]:
+        return self.info.ch_names
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    def get_data(self, picks=None, item=None, copy: bool = True, dtype=np.float64) -> NDArray[np.floating]:
+        """
+        Recieves:
+        * picks: indices of the channels, all channels if None.
+        * item: indices (or a slice) of the trials, all trials if None.
+        * copy: bool, if False and picks and item are None, the mapped array itself is returned (read-only, in the dtype of the cache).
+        * dtype: dtype of the copy, float32 keeps the trials of a float32 cache in single precision (config.compute_dtype).
+
+        Returns:
+        * data: ndarray of shape (trials, channels, time points), a copy in dtype unless copy is False.
+
+        """
+        data = self.data if item is None else self.data[item]
+
+        if picks is not None:
+            data = data[:, picks]
+
+        if not copy:
+            return data
+
+        return np.array(data, dtype=dtype)
+
+    def to_epochs(self):
+        """
+        Returns:
+        * epochs: mne.EpochsArray of the cache, backed by the mapped trials if the cache is float64 (read-only), a float64 copy otherwise.
+
+        """
+        import mne
+
+        return mne.EpochsArray(self.data, self.info, events=self.events, tmin=self.tmin, event_id=self.event_id, baseline=None)
+
+
+@beartype
+def combine_events(events: NDArray[np.integer], event_id: dict, old_event_ids: dict = config.event_ids,
+                   new_event_ids: dict = config.new_event_ids) -> tuple[NDArray[np.integer], dict]:
+    """
+    Recieves:
+    * events: events array of the epochs with the conditions of old_event_ids.
+    * event_id: the event ids of the epochs.
+    * old_event_ids, new_event_ids: the event ids to combine and the combined event ids (see combine_epochs).
+
+    Function:
+    * Relabels the events with the combined conditions, as combine_epochs relabels the epochs (the trials and their order are kept).
+      A combined condition is listed only if some of its conditions are in event_id (mne.epochs.combine_event_ids, used by 
+      combine_epochs, raises a KeyError for a missing condition).
+
+    Returns:
+    * combined_events: a relabeled copy of events.
+    * combined_event_id: the event ids of the combined conditions present in the events and of the conditions not combined.
+
+    """
+    from mat_to_epochs_conversion import get_combined_conditions
+
+    combined_conditions = get_combined_conditions(old_event_ids, new_event_ids)
+
+    code_map = {event_id[old_condition]: new_event_ids[new_condition]
+                for new_condition, old_conditions in combined_conditions.items() for old_condition in old_conditions if old_condition in event_id}
+
+    combined_events = events.copy()
+    combined_events[:, 2] = [code_map.get(code, code) for code in events[:, 2]]
+
+    combined_event_id = {condition: code for condition, code in event_id.items() if condition not in
+                         {old_condition for old_conditions in combined_conditions.values() for old_condition in old_conditions}}
+    combined_event_id.update({new_condition: new_event_ids[new_condition] for new_condition, old_conditions in combined_conditions.items()
+                              if any(old_condition in event_id for old_condition in old_conditions)})
+
+    return combined_events, combined_event_id
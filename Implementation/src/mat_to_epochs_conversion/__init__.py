@@ -1,13 +1,18 @@
-# Define the __all__ variable
+# The functions are imported from their submodules on first access, the submodules load mne, h5py and pymatreader.
+# combine_epochs is the function, the module is imported as mat_to_epochs_conversion.combine_epochs
+import lazy_loader as lazy
 
-__all__ = ["convert_mat_to_dict", "convert_dict_to_epochs", "convert_mat_to_epochs", \
-    "create_events_for_epochs", "extract_from_dict", "remove_oddball_trials", "combine_epochs", \
-       "create_mne_info", "extract_raw_info"]
-
-# Import the submodules
-from mat_to_epochs_conversion.convert_main_funcs import convert_mat_to_dict, convert_dict_to_epochs, convert_mat_to_epochs
-from mat_to_epochs_conversion.create_events_for_epochs import create
-from mat_to_epochs_conversion.extract_from_dict import extract
-from mat_to_epochs_conversion.remove_oddball_trials import remove
-from mat_to_epochs_conversion.combine_epochs import combine_epochs
-from mat_to_epochs_conversion.create_info import create_mne_info, extract_raw_info
\ No newline at end of file
+__getattr__, __dir__, __all__ = lazy.attach(
+    __name__,
+    submodules=["create_info", "read_mat_h5"],
+    submod_attrs={
+        "convert_main_funcs": ["convert_mat_to_dict", "convert_dict_to_epochs", "convert_mat_to_epochs", "convert_mat_h5_to_epochs",
+                               "convert_array_to_epochs"],
+        "read_mat_h5": ["open_mat_h5"],
+        "create_events_for_epochs": ["create"],
+        "extract_from_dict": ["extract"],
+        "remove_oddball_trials": ["remove", "create_keep_mask", "keep_trials"],
+        "combine_epochs": ["combine_epochs", "get_combined_conditions"],
+        "create_info": ["create_mne_info", "extract_raw_info"],
+    },
+)
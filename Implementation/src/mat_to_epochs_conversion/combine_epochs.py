@@ -6,7 +6,8 @@ from tests import input_validation_tests
 from beartype import beartype
 
 @beartype
-def combine_epochs(epochs: mne.EpochsArray, old_event_ids: dict, new_event_ids: dict)-> mne.EpochsArray:
+def combine_epochs(epochs: mne.EpochsArray | mne.epochs.EpochsFIF, old_event_ids: dict, new_event_ids: dict) \
+    -> mne.EpochsArray | mne.epochs.EpochsFIF:
     """
     Recieves:
     * epochs: mne epochs array instance
@@ -39,20 +40,43 @@ def combine_epochs(epochs: mne.EpochsArray, old_event_ids: dict, new_event_ids:
         
     else:
         try:
-            old_event_ids = list(old_event_ids.keys())
-            num_keys_combined = int(len(old_event_ids)/len(new_event_ids))
+            combined_conditions = get_combined_conditions(old_event_ids, new_event_ids)
 
-            # goes through new event_ids and assignes a new event id for every num_keys_combined of old_event_ids (every triplet in implementation) and returns a new epochs 
+            # goes through new event_ids and combines the old event ids of each new event id, returns a new epochs 
             # array with the combined event ids
-            for i in np.arange(len(new_event_ids)):
-                epochs_combined = mne.epochs.combine_event_ids(epochs, 
-                old_event_ids[(num_keys_combined*i):(num_keys_combined*i+num_keys_combined)] , 
-                {list(new_event_ids.keys())[i]: list(new_event_ids.values())[i]}, copy=False)
+            for new_condition, old_conditions in combined_conditions.items():
+                epochs_combined = mne.epochs.combine_event_ids(epochs, old_conditions, 
+                {new_condition: new_event_ids[new_condition]}, copy=False)
 
-            epochs_combined.save(config.epochs_combined_path)
+            epochs_combined.save(config.epochs_combined_path, overwrite=True)
         
         except Exception as e:
             print("An error occured:", e)
             traceback.print_exc()
 
     return epochs_combined
+
+
+@beartype
+def get_combined_conditions(old_event_ids: dict, new_event_ids: dict) -> dict[str, list[str]]:
+    """
+    Recieves:
+    * old_event_ids: dictionary of the conditions to combine (see combine_epochs).
+    * new_event_ids: dictionary of the combined conditions (see combine_epochs).
+
+    Function:
+    * Assigns every num_keys_combined consecutive old event ids (every triplet in implementation) to a new event id, 
+      num_keys_combined = len(old_event_ids) / len(new_event_ids).
+
+    Returns:
+    * combined_conditions: dictionary with the new condition names as keys and lists of the old condition names combined under them as values.
+    """
+
+    old_conditions = list(old_event_ids.keys())
+    num_keys_combined = int(len(old_conditions)/len(new_event_ids))
+
+    combined_conditions = {new_condition: old_conditions[(num_keys_combined*i):(num_keys_combined*i+num_keys_combined)] 
+                           for i, new_condition in enumerate(new_event_ids.keys())}
+
+    return combined_conditions
+
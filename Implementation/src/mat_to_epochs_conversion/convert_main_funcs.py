@@ -1,8 +1,11 @@
 import os
+import h5py
 import numpy as np
 import mne
+from numpy.typing import NDArray
+from src import config
 from tests import input_validation_tests
-from . import create_events_for_epochs, extract_from_dict, remove_oddball_trials
+from . import create_events_for_epochs, extract_from_dict, remove_oddball_trials, read_mat_h5
 from beartype import beartype
 
 @beartype
@@ -46,7 +49,7 @@ def convert_mat_to_dict(file_name: str|os.PathLike) -> dict:
 
 
 @beartype
-def convert_dict_to_epochs(sub_dict: dict, mne_info: mne.Info) -> tuple[mne.EpochsArray, mne.EvokedArray]:
+def convert_dict_to_epochs(sub_dict: dict, mne_info: mne.Info, bad_trials: list[int] | None = None) -> tuple[mne.EpochsArray, mne.EvokedArray]:
 
     """
 
@@ -54,6 +57,7 @@ def convert_dict_to_epochs(sub_dict: dict, mne_info: mne.Info) -> tuple[mne.Epoc
     * sub_dict: subject dictionary with the already epoched data that was converted from mat file, with fields:['datafinalLow']['trial'], ['datafinalLow']['trialinfo'], 
     ['datafinalLow']['grad']['label'], ['datafinalLow']['fsample'].  
     * mne_info: instance of mne.Info class
+    * bad_trials: list of indices of trials to exclude in addition to the oddball trials.
 
     Function:
     * Converts dictionary to MNE epochs array, averages it to compute the evoked response and saves the epochs and evoked instances.
@@ -80,48 +84,135 @@ def convert_dict_to_epochs(sub_dict: dict, mne_info: mne.Info) -> tuple[mne.Epoc
     try:      
         # variables imported from config.py:
 
-        tmin = config.baseline_time[0] # starting point of baseline (-0.3 in our case) 
-
-        baseline = config.baseline_time # tuple for baseline time (-0.3,0)
-
         oddball_id = config.oddball_id # int of code for oddball stimulus
 
 
         data, events_code,_,_ = extract_from_dict.extract(sub_dict)
 
-        # Identify and remove oddball trials
-        data, events_code =  remove_oddball_trials.remove(data, events_code, oddball_id)
+        # Identify and remove oddball trials and bad trials, the kept trials are moved within the extracted array (not copied)
+        keep_mask = remove_oddball_trials.create_keep_mask(events_code, oddball_id, bad_trials)
+        data, events_code = remove_oddball_trials.keep_trials(data, keep_mask), events_code[keep_mask]
 
-        events = create_events_for_epochs.create(events_code)
+        epochs, evoked = convert_array_to_epochs(data, events_code, mne_info)
 
-        # Create the epochs instance:
-        epochs = mne.EpochsArray(data, mne_info, events=events, tmin=tmin, event_id=config.event_ids,
-            reject=None, flat=None, reject_tmin=None, reject_tmax=None,
-            baseline=baseline, proj=True, on_missing='raise', metadata=None,
-            selection=None, drop_log=None, raw_sfreq=None, verbose=None)
-        
-        # average epochs to get a general evoked response to all visual stimuli
-        evoked = epochs.average()
+    except Exception as e:
+        print(" An error occured:", e)
+        traceback.print_exc()
+
+    return epochs, evoked   
+
+
+@beartype
+def convert_mat_h5_to_epochs(file_name: str|os.PathLike, mne_info: mne.Info | None = None, bad_trials: list[int] | None = None,
+                             data: NDArray[np.floating] | None = None) -> tuple[mne.EpochsArray, mne.EvokedArray]:
+
+    """
+
+    Recieves:
+    * file_name: path to a v. 7.3 mat file with the epoched data in the fields ['datafinalLow']['trial'], ['datafinalLow']['trialinfo'], 
+    ['datafinalLow']['label'], ['datafinalLow']['fsample'].
+    * mne_info: instance of mne.Info class, if None a manual info is created (without sensor positions, see create_info.create_mne_info).
+    * bad_trials: list of indices of trials to exclude in addition to the oddball trials.
+    * data: the kept trials already read from the mat file (see prefetch.py), of shape (kept trials, channels, time points),
+      None to read them.
+
+    Function:
+    * Reads the mat file directly as HDF5 (see read_mat_h5.py): the trials are read one at a time straight into a single preallocated 
+      buffer that backs the epochs array, instead of converting the whole mat file to a dictionary and copying the trials again.
+      The oddball and bad trials are excluded by a mask built from trialinfo before reading, they are never loaded and the buffer 
+      is allocated once in the size of the final number of epochs.
+      Converts to MNE epochs array, averages it to compute the evoked response and saves the epochs and evoked instances.
+
+    Reutrns:
+    * epochs: mne.EpochsArray instance
+    * evoked: mne.Evoked instance
+
+    """
+    import traceback
+
+    try:
+        with read_mat_h5.open_mat_h5(file_name) as reader:
+
+            if mne_info is None:
+                ch_types = config.channels_number * ['mag'] # same manual info as create_info.create_mne_info
+                mne_info = mne.create_info(reader.ch_names, reader.sfreq, ch_types)
+
+            # Identify oddball trials and bad trials, read only the trials to keep
+            keep_mask = remove_oddball_trials.create_keep_mask(reader.events_code, config.oddball_id, bad_trials)
+            keep_indices = np.flatnonzero(keep_mask)
+
+            if data is None:
+                data = np.empty((len(keep_indices),) + reader.trial.shape[1:], dtype=np.float64)
+                reader.trial.read_into(data, keep_indices)
+
+            elif data.shape != (len(keep_indices),) + reader.trial.shape[1:]:
+                raise ValueError(f"The read ahead trials of {file_name} should be of shape {(len(keep_indices),) + reader.trial.shape[1:]}, got {data.shape}")
 
-                        
-        # save the epochs array and evoked in the current subject's folder:
-        epochs.save(config.epochs_path)
-        evoked.save(config.evoked_path)
+            events_code = reader.events_code[keep_mask]
+
+        epochs, evoked = convert_array_to_epochs(data, events_code, mne_info)
 
     except Exception as e:
         print(" An error occured:", e)
         traceback.print_exc()
 
-    return epochs, evoked   
+    return epochs, evoked
 
 
 @beartype
-def convert_mat_to_epochs(file_name: str|os.PathLike, mne_info: mne.Info = None) -> tuple[mne.EpochsArray, mne.evoked.Evoked]:
+def convert_array_to_epochs(data: NDArray[np.floating], events_code: NDArray[np.integer], mne_info: mne.Info) -> tuple[mne.EpochsArray, mne.EvokedArray]:
+
+    """
+
+    Recieves:
+    * data: ndarray of shape (trials, channels, time points), after oddball trial removal.
+    * events_code: ndarray of shape (trials,), the integer code of the condition of each trial.
+    * mne_info: instance of mne.Info class
+
+    Function:
+    * Creates the MNE epochs array, averages it to compute the evoked response and saves the epochs and evoked instances.
+
+    Reutrns:
+    * epochs: mne.EpochsArray instance
+    * evoked: mne.Evoked instance
+
+    """
+
+    tmin = config.baseline_time[0] # starting point of baseline (-0.3 in our case) 
+
+    baseline = config.baseline_time # tuple for baseline time (-0.3,0)
+
+    events = create_events_for_epochs.create(events_code)
+
+    # Create the epochs instance:
+    epochs = mne.EpochsArray(data, mne_info, events=events, tmin=tmin, event_id=config.event_ids,
+        reject=None, flat=None, reject_tmin=None, reject_tmax=None,
+        baseline=baseline, proj=True, on_missing='raise', metadata=None,
+        selection=None, drop_log=None, raw_sfreq=None, verbose=None)
+    
+    # average epochs to get a general evoked response to all visual stimuli
+    evoked = epochs.average()
+
+                    
+    # save the epochs array and evoked in the current subject's folder:
+    epochs.save(config.epochs_path, overwrite=True)
+    evoked.save(config.evoked_path, overwrite=True)
+
+    return epochs, evoked
+
+
+@beartype
+def convert_mat_to_epochs(file_name: str|os.PathLike, mne_info: mne.Info = None, bad_trials: list[int] | None = None,
+                          prefetched: dict | None = None) \
+    -> tuple[mne.EpochsArray, mne.evoked.Evoked]:
 
     """
     Recieves:
     * file_name: mat file path to convert to an mne.EpochsArray instance
     * info: mne.Info instance, if info is not given a manual info is created (the manuall info doesn't contain sensor positions)
+    * bad_trials: list of indices of trials (in the mat file) to exclude in addition to the oddball trials.
+    * prefetched: the content of the mat file read ahead by prefetch.py, 'data' (the kept trials of a v. 7.3 mat file) or 'sub_dict'
+      (the dictionary of another mat file), None to read the mat file.
 
     Function:
     * Convert mat structure to an EpochsArray instance and average to get evoked response
@@ -132,7 +223,6 @@ def convert_mat_to_epochs(file_name: str|os.PathLike, mne_info: mne.Info = None)
 
     """
 
-    from src import config
     from mat_to_epochs_conversion import create_info
     import traceback
     from tests import input_validation_tests
@@ -149,12 +239,20 @@ def convert_mat_to_epochs(file_name: str|os.PathLike, mne_info: mne.Info = None)
 
         try:
 
-            sub_dict = convert_mat_to_dict(file_name)
+            if h5py.is_hdf5(file_name):
+                # v. 7.3 mat files are HDF5 files, read them directly without the intermediate dictionary
+                epochs, evoked = convert_mat_h5_to_epochs(file_name, mne_info, bad_trials, data=(prefetched or {}).get("data"))
 
-            if mne_info is None:
-                mne_info = create_info.create_mne_info(sub_dict)
-                
-            epochs, evoked = convert_dict_to_epochs(sub_dict, mne_info)
+            else:
+                sub_dict = (prefetched or {}).get("sub_dict")
+
+                if sub_dict is None:
+                    sub_dict = convert_mat_to_dict(file_name)
+
+                if mne_info is None:
+                    mne_info = create_info.create_mne_info(sub_dict)
+                    
+                epochs, evoked = convert_dict_to_epochs(sub_dict, mne_info, bad_trials)
 
         except Exception as e:
             print("An error occured:", e)
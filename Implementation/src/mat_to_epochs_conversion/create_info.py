@@ -24,16 +24,16 @@ def extract_raw_info(folder_directory: str|os.PathLike) -> mne.Info:
         
         input_validation_tests.file_exists(folder_directory)
 
-        # redirect to the folder
-        os.chdir(folder_directory) 
-
         # glob.glob returns a list of the paths with the desired pattern, return the first and only object in the list
-        raw_path = glob.glob(f"*1Hz")[0] 
+        # (the folder isn't made the current directory, the info of the next subject may be read while a subject is computed, see prefetch.py)
+        raw_path = glob.glob(os.path.join(folder_directory, "*1Hz"))[0] 
 
         print(raw_path)
 
         # read raw object
-        raw = mne.io.read_raw_bti(raw_path, rename_channels=False)
+        # (config and hs_file of the folder, mne looks for them in the current directory first)
+        raw = mne.io.read_raw_bti(raw_path, config_fname=os.path.join(folder_directory, "config"),
+                                  head_shape_fname=os.path.join(folder_directory, "hs_file"), rename_channels=False)
 
         # drop all bad channels and reference channels (leaves 246 channels)
         raw.drop_channels(config.bad_ch_names)
@@ -80,7 +80,7 @@ def create_mne_info(sub_dict: dict) -> mne.Info:
 
     else:
         try:
-            _, _, ch_names, sfreq = extract_from_dict(sub_dict) #ec=xtracts from the dictionary that has the epoched data the channel names and sampling frequency.
+            _, _, ch_names, sfreq = extract_from_dict.extract(sub_dict) #ec=xtracts from the dictionary that has the epoched data the channel names and sampling frequency.
             ch_types = np.array(config.channels_number * ['mag']) # create 246 'mag' channel types relating to the 246 extracted channel names in extract_from_dict channels 
             mne_info = mne.create_info(ch_names, sfreq, ch_types, verbose=None)  
         
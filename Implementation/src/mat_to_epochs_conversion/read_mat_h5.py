@@ -0,0 +1,150 @@
+import os
+import h5py
+import numpy as np
+from beartype import beartype
+from numpy.typing import NDArray
+
+
+class LazyTrials:
+    """
+    Lazy (trials, channels, time points) view of the ['datafinalLow']['trial'] cell array of a v. 7.3 mat file.
+
+    Nothing is read until requested, trials are read one dataset at a time straight into a preallocated buffer.
+    Matlab stores every trial transposed (time points, channels) in the HDF5 file, the trials are transposed while copied to the buffer.
+
+    """
+
+    def __init__(self, h5_file: h5py.File, trial_refs: h5py.Dataset):
+        self._h5_file = h5_file
+        self._refs = np.asarray(trial_refs[()]).ravel() # cell array of references, (trials, 1) or (1, trials)
+
+        first_trial = self._h5_file[self._refs[0]]
+        n_times, n_channels = first_trial.shape
+        self.shape = (len(self._refs), n_channels, n_times)
+        self.dtype = first_trial.dtype
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, index: int) -> NDArray[np.floating]:
+        return self._h5_file[self._refs[index]][()].T
+
+    def read_into(self, out: NDArray[np.floating], indices: NDArray[np.integer] | None = None):
+        """
+        Recieves:
+        * out: preallocated float ndarray of shape (len(indices), channels, time points), any float dtype.
+        * indices: indices of the trials to read, all trials if None.
+
+        Function:
+        * Reads the trials into out, only a single trial in file layout is held in memory besides out.
+
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+
+        if out.shape != (len(indices),) + self.shape[1:]:
+            raise ValueError(f"out should be of shape {(len(indices),) + self.shape[1:]}, got {out.shape}")
+
+        # scratch buffer in the file layout (time points, channels), reused for every trial
+        scratch = np.empty(self.shape[:0:-1], dtype=self.dtype)
+
+        for i, index in enumerate(indices):
+            self._h5_file[self._refs[index]].read_direct(scratch)
+            out[i] = scratch.T
+
+    def iter_blocks(self, block_size: int, indices: NDArray[np.integer] | None = None, dtype=np.float64):
+        """
+        Recieves:
+        * block_size: number of trials in each block.
+        * indices: indices of the trials to read, all trials if None.
+        * dtype: float dtype of the blocks.
+
+        Function:
+        * Generator of consecutive blocks of trials, the same block buffer is reused (copy a block to keep it).
+
+        Yields:
+        * start: index of the first trial of the block (in indices).
+        * block: ndarray of shape (block trials, channels, time points).
+
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+
+        block_buffer = np.empty((block_size,) + self.shape[1:], dtype=dtype)
+
+        for start in range(0, len(indices), block_size):
+            block_indices = indices[start:start + block_size]
+            block = block_buffer[:len(block_indices)]
+            self.read_into(block, block_indices)
+            yield start, block
+
+
+class MatH5Reader:
+    """
+    Reader of a v. 7.3 (HDF5) mat file with the epoched data in a 'datafinalLow' struct.
+
+    trialinfo, label and fsample are read eagerly, trial is exposed as a LazyTrials instance.
+    Use as a context manager, the file is closed on exit.
+
+    """
+
+    def __init__(self, file_name: str|os.PathLike, struct_name: str = "datafinalLow"):
+        self._h5_file = h5py.File(file_name, "r")
+
+        try:
+            struct = self._h5_file[struct_name]
+
+            # trialinfo is saved transposed (columns, trials)
+            self.trialinfo = struct["trialinfo"][()].T
+            self.events_code = np.array(self.trialinfo[:, 0], dtype=int) # convert from float to int
+            self.ch_names = [self._read_string(ref) for ref in np.asarray(struct["label"][()]).ravel()]
+            self.sfreq = float(np.squeeze(struct["fsample"][()]))
+            self.trial = LazyTrials(self._h5_file, struct["trial"])
+
+        except Exception:
+            self._h5_file.close()
+            raise
+
+    def _read_string(self, ref: h5py.Reference) -> str:
+        # matlab chars are saved as uint16 codes
+        return "".join(chr(code) for code in self._h5_file[ref][()].ravel())
+
+    def close(self):
+        self._h5_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@beartype
+def open_mat_h5(file_name: str|os.PathLike) -> MatH5Reader:
+    """
+
+    Recieves:
+    * file_name: path to a v. 7.3 mat file.
+
+    Function:
+    * Opens the mat file directly as HDF5, without converting the whole matlab struct to python objects (see convert_mat_to_dict).
+
+    Returns:
+    * reader: MatH5Reader instance with trialinfo, events_code, ch_names, sfreq and the lazy trial array.
+
+    """
+
+    from tests import input_validation_tests
+
+    input_validation_tests.file_exists(file_name)
+
+    reader = MatH5Reader(file_name)
+
+    try:
+        input_validation_tests.mat_h5_reader(reader)
+
+    except Exception:
+        reader.close()
+        raise
+
+    return reader
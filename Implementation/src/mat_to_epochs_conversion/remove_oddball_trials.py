@@ -48,3 +48,65 @@ def remove(data: NDArray[np.floating], events_code: NDArray[np.integer], oddball
             traceback.print_exc() 
 
     return data_removed, events_code_removed
+
+
+@beartype
+def create_keep_mask(events_code: NDArray[np.integer], oddball_id: int, bad_trials: list[int] | None = None) -> NDArray[np.bool_]:
+
+    """ 
+    
+    Recieves:
+    * events_code: numpy ndarray of type int, shape (trials,), contains unique code for each stimuls.
+    * odball_id: integer, code of the odball stimulus.
+    * bad_trials: list of indices of trials to exclude (indices of the trials in the mat file, before oddball removal).
+
+    Function:
+    * Builds a mask of the trials to keep from events_code alone, before any trial data is read: excludes all trials 
+      coressponding to oddball stimulus id and the bad trials. Only the kept trials need to be loaded (see convert_mat_h5_to_epochs).
+
+    Reutrns:
+    * keep_mask: numpy ndarray of type bool, shape (trials,), True for the trials to keep.
+    
+    """
+    from tests import input_validation_tests
+
+    input_validation_tests.create_keep_mask(events_code, bad_trials)
+
+    keep_mask = events_code != oddball_id
+
+    if bad_trials is not None:
+        keep_mask[bad_trials] = False
+
+    return keep_mask
+
+
+
+@beartype
+def keep_trials(data: NDArray[np.floating], keep_mask: NDArray[np.bool_]) -> NDArray[np.floating]:
+
+    """ 
+    
+    Recieves:
+    * data: numpy ndarray, shape (trials, channels, time points), the kept trials are moved within it (modified in place).
+    * keep_mask: numpy ndarray of type bool, shape (trials,), True for the trials to keep (see create_keep_mask).
+
+    Function:
+    * Moves the kept trials to the front of data in their order, one trial at a time. Unlike data[keep_mask], no second array 
+      of the kept trials is allocated.
+
+    Reutrns:
+    * data_kept: view of the first (kept) trials of data, shape (kept trials, channels, time points).
+    
+    """
+
+    if keep_mask.shape != data.shape[:1]:
+        raise ValueError(f"keep_mask should be of shape {data.shape[:1]}, got {keep_mask.shape}")
+
+    keep_indices = np.flatnonzero(keep_mask)
+
+    # the kept indices are increasing, a trial is moved only to a position already moved from or removed
+    for i, index in enumerate(keep_indices):
+        if i != index:
+            data[i] = data[index]
+
+    return data[:len(keep_indices)]
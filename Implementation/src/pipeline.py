@@ -0,0 +1,524 @@
+"""
+
+Stages of the pipeline of a subject: every step (conversion, combining, CSD per condition, TFR contrasts, PSD, report sections)
+is a Stage that declares the files it reads (inputs) and writes (outputs), the dependencies between the stages follow from them.
+run_stages runs only the stages needed for the requested targets, independent stages concurrently in threads of the subject's
+process, and skips the stages completed in a previous run whose inputs didn't change, a crashed run resumes after its last completed stages.
+
+"""
+import os, glob, threading, traceback
+from functools import partial
+import numpy as np
+from beartype import beartype
+from src import config, stage_cache
+
+tfr_freqs = np.arange(8, 24, 2) # frequencies of the TFR contrasts (freqs=(8, 24, 2) works best, see compute_tfr_contrast)
+
+
+class Stage:
+    """
+    A step of the pipeline of a subject.
+
+    * name: name of the stage, stages of the same kind share a prefix (e.g. compute_csd/food_1 and compute_csd/baseline).
+    * run: function of the run context (see run_stages), reads the inputs and writes the outputs in the subject's folder.
+    * inputs: list of paths of the files the stage reads, the stages that write them run first.
+    * outputs: list of paths of the files the stage writes.
+    * params: dictionary of the config values the stage depends on, a change reruns the stage.
+    * modules: list of the names of the modules that implement the stage, a change in their code reruns the stage (the modules
+      are not imported to check the stage, a dry run starts without loading mne).
+    * after: names of stages that run first if they run in the same run, without depending on them (the report sections are
+      added to the report in order).
+
+    """
+
+    def __init__(self, name: str, run, inputs: list, outputs: list, params: dict | None = None, modules: list | None = None,
+                 after: list | None = None):
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = {} if params is None else params
+        self.modules = [] if modules is None else modules
+        self.after = [] if after is None else after
+
+    def fingerprint(self) -> str | None:
+        """
+        Returns:
+        * the fingerprint of the inputs, parameters and code of the stage (see stage_cache.fingerprint), None if an input is missing.
+
+        """
+        if not all(os.path.exists(file_name) for file_name in self.inputs):
+            return None
+
+        return stage_cache.fingerprint(input_files=self.inputs, params=self.params, modules=self.modules)
+
+    def is_complete(self, stage_fingerprint: str | None) -> bool:
+        """
+        Returns:
+        * True if the stage was completed with the same inputs and its outputs were not changed since.
+
+        """
+        return stage_fingerprint is not None and stage_cache.is_fresh(f"pipeline/{self.name}", stage_fingerprint, self.outputs)
+
+
+def _shared(context: dict, key: str, load):
+    # value shared by the stages of a run (e.g. the epochs of all TFR contrasts), stored by the stage that computed it or
+    # loaded once by the first stage that needs it
+    with context["lock"]:
+        key_lock = context["locks"].setdefault(key, threading.Lock())
+
+    with key_lock:
+        if key not in context["values"]:
+            context["values"][key] = load()
+
+    return context["values"][key]
+
+
+def _extract_raw_info(context: dict):
+    import mne
+    from mat_to_epochs_conversion import create_info
+    from tests import output_tests
+
+    # the info read ahead by the prefetcher of the run (see prefetch.py)
+    raw_info = context["prefetched"].get("raw_info")
+    if raw_info is None:
+        raw_info = create_info.extract_raw_info(context["folder"])
+    output_tests.test_raw_info(raw_info)
+
+    # saved for the stages of later runs
+    mne.io.write_info(config.raw_info_path, raw_info)
+    context["values"][config.raw_info_path] = raw_info
+
+
+def _convert_mat_to_epochs(context: dict, mat_file: str):
+    import mne
+    from mat_to_epochs_conversion import convert_main_funcs
+
+    raw_info = _shared(context, config.raw_info_path, lambda: mne.io.read_info(config.raw_info_path))
+
+    # the trials read ahead by the prefetcher of the run (see prefetch.py), released after the conversion
+    prefetched = {key: context["prefetched"].pop(key, None) for key in ("data", "sub_dict")}
+    if context["prefetched"].get("mat_file") != os.path.abspath(mat_file):
+        prefetched = None
+
+    epochs, evoked = convert_main_funcs.convert_mat_to_epochs(mat_file, mne_info=raw_info, bad_trials=config.bad_trials.get(context["subject_num"]),
+                                                              prefetched=prefetched)
+
+    context["values"][config.epochs_path] = epochs
+    context["values"][config.evoked_path] = evoked
+
+
+def _write_epoch_cache(context: dict):
+    import mne
+    from src import epoch_cache
+
+    # the saved epochs read without their data (the trials are copied block by block): the fif file holds the trials in single
+    # precision, the cache has the same values whether the epochs were converted in this run or not
+    epochs = mne.read_epochs(config.epochs_path, preload=False)
+
+    epoch_cache.write_epoch_cache(epochs)
+
+
+def _get_epoch_cache(context: dict, combined: bool = False):
+    # the memory-mapped trials (see epoch_cache.py), opened once per run and shared by the stages
+    from src import epoch_cache
+
+    return _shared(context, f"epoch_cache/combined={combined}", lambda: epoch_cache.EpochCache(combined=combined))
+
+
+def _combine_epochs(context: dict):
+    import mne
+    from mat_to_epochs_conversion.combine_epochs import combine_epochs
+    from tests import output_tests
+
+    # the saved epochs are read without their data: combine_epochs combines the event ids in place and the epochs shared
+    # by the other stages (TFR contrasts) must not change, the data is copied from file to file when saving
+    epochs = mne.read_epochs(config.epochs_path, preload=False)
+
+    epochs_combined = combine_epochs(epochs, config.event_ids, config.new_event_ids)
+    output_tests.test_epochs_combined(epochs_combined)
+
+
+def _compute_csd_condition(context: dict, condition: str):
+    from src import epoch_cache
+    from analyses import compute_csd
+    from tests import output_tests
+
+    # the trials of the condition are read from the mapped epoch cache (stages run concurrently, the pages are shared)
+    epochs_combined = _get_epoch_cache(context, combined=True)
+
+    (csd, csd_mean), baseline_part = compute_csd.compute_csd_condition(epochs_combined, condition, config.freq_bands, config.post_stim_time,
+                                                                       config.baseline_time)
+
+    for csd_instance in (csd, csd_mean, baseline_part):
+        output_tests.test_csd(csd_instance)
+
+
+def _compute_baseline_csd(context: dict):
+    from analyses import compute_csd, pair_csd
+    from tests import output_tests
+
+    # we assume that all conditions have same baseline activity, the baseline csd is computed over the epochs of all conditions
+    epochs_combined = _get_epoch_cache(context, combined=True)
+    counts = {condition: int(np.sum(epochs_combined.events[:, 2] == code)) for condition, code in epochs_combined.event_id.items()}
+
+    baseline_parts = {condition: pair_csd.read_csd(config.get_csd_baseline_part_path(condition)) for condition in config.new_event_ids}
+
+    csd, csd_mean = compute_csd.compute_baseline_csd(baseline_parts, counts, config.freq_bands)
+
+    output_tests.test_csd(csd)
+    output_tests.test_csd(csd_mean)
+
+
+def _get_tfr_coefs_cache(context: dict) -> dict:
+    # sums and counts of the trials per condition (of event_ids) and the cache of the spectra of these conditions, every TFR
+    # contrast of the run is derived from them (see tfr_psd_analyses.create_tfr_coefs_cache)
+    from analyses import tfr_psd_analyses
+
+    def create():
+        epochs = _get_epoch_cache(context)
+        condition_sums = tfr_psd_analyses.compute_condition_sums(epochs)
+        return tfr_psd_analyses.create_tfr_coefs_cache(condition_sums, tfr_freqs)
+
+    return _shared(context, "tfr_coefs_cache", create)
+
+
+def _compute_tfr_contrast(context: dict, con1: tuple, con2: tuple):
+    from src import epoch_cache
+    from analyses import tfr_psd_analyses
+    from tests import output_tests
+
+    tfr_coefs_cache = _get_tfr_coefs_cache(context)
+
+    tfr_contrast = tfr_psd_analyses.compute_tfr_contrast(epochs=None, freqs=tfr_freqs, con1=con1, con2=con2,
+                                                         condition_sums=tfr_coefs_cache["condition_sums"], tfr_coefs_cache=tfr_coefs_cache)
+    output_tests.test_tfr(tfr_contrast, tfr_freqs)
+
+
+def _compute_induced_power(context: dict):
+    from analyses import induced_power
+
+    # the trials are transformed in chunks, the evoked responses subtracted from them are the condition sums shared with the TFR contrasts
+    epochs = _get_epoch_cache(context)
+    condition_sums = _get_tfr_coefs_cache(context)["condition_sums"]
+
+    induced_sums = induced_power.compute_induced_sums(epochs, tfr_freqs, condition_sums=condition_sums)
+    induced_power.save_induced_sums(induced_sums)
+
+    context["values"][config.induced_sums_path] = induced_sums
+
+
+def _compute_induced_contrast(context: dict, con1: tuple, con2: tuple):
+    from analyses import induced_power
+    from tests import output_tests
+
+    # the accumulators of the conditions, computed in this run or read once and shared by all contrasts
+    induced_sums = _shared(context, config.induced_sums_path, induced_power.read_induced_sums)
+    epochs = _get_epoch_cache(context)
+
+    for tfr in induced_power.compute_induced_contrast(induced_sums, epochs.info, con1, con2):
+        output_tests.test_induced_tfr(tfr, tfr_freqs, config.induced_decim)
+
+
+def _compute_psd(context: dict):
+    import mne
+    from analyses import tfr_psd_analyses
+    from tests import output_tests
+
+    evoked = _shared(context, config.evoked_path, lambda: mne.read_evokeds(config.evoked_path)[0])
+
+    # compute psd (power spectral density) over the desired frequencies, times and channels:
+    psd = tfr_psd_analyses.compute_psd(evoked_instance=evoked, fmin=config.freq_bands[0][0], fmax=config.freq_bands[-1][-1],
+                                       tmin=config.baseline_time[0], tmax=config.post_stim_time[1], picks='meg')
+    output_tests.test_psd(psd)
+
+
+def _add_report_section(context: dict, section: str):
+    import add_to_report
+
+    report_files = [config.h5_report_path, config.html_report_path]
+
+    # the sections share the report files: the sections that are complete with the current report are recorded again with the
+    # report saved by this section, as the figures of the kept sections are (see add_to_report.update_report)
+    kept_sections = {name: section_fingerprint for name, section_fingerprint in stage_cache.fresh_records("pipeline/add_to_report/", report_files).items()
+                     if name != f"pipeline/add_to_report/{section}"}
+
+    # only the changed figures of the section are rendered, the other sections of a saved report are kept
+    add_to_report.update_report(context["subject_num"], sections=[section])
+
+    for name, section_fingerprint in kept_sections.items():
+        stage_cache.record(name, section_fingerprint, report_files)
+
+
+@beartype
+def create_stages(subject_num: str) -> list[Stage]:
+    """
+    Recieves:
+    * subject_num: the name of the subject folder (the current directory).
+
+    Function:
+    * Defines the stages of the pipeline of the subject, in an order in which every stage comes after the stages it depends on:
+      extract_raw_info, convert_mat_to_epochs, write_epoch_cache (the memory-mappable trials the analyses read, see epoch_cache.py),
+      combine_epochs, compute_csd/<condition> (post stimulus CSD per combined condition),
+      compute_csd/baseline, compute_tfr_contrast/<con1>-<con2> (per contrast of config.tfr_contrasts), compute_induced_power and
+      compute_induced_contrast/<con1>-<con2> (if config.compute_induced_power), compute_psd and add_to_report/<section>
+      (per section of config.get_report_sections).
+
+    Returns:
+    * stages: list of Stage instances.
+
+    """
+    from src import epoch_cache
+
+    # the mat file with the epoched data (the first and only mat file of the folder)
+    mat_files = glob.glob(config.mat_file_path_pattern)
+    mat_file = mat_files[0] if mat_files else config.mat_file_path_pattern
+
+    conditions = list(config.new_event_ids.keys())
+    csd_params = {"freq_bands": config.freq_bands, "post_stim_time": config.post_stim_time, "baseline_time": config.baseline_time,
+                  "event_ids": config.event_ids, "new_event_ids": config.new_event_ids, "compute_dtype": config.compute_dtype,
+                  "csd_multirate": config.csd_multirate, "csd_band_tolerance": config.csd_band_tolerance,
+                  "csd_channel_groups": config.csd_channel_groups, "csd_channel_pairs": config.csd_channel_pairs}
+    cache_files = epoch_cache.get_cache_files()
+
+    # the raw recording isn't hashed (multi-GB), its info is saved once and rerun only if the saved info is missing or changed
+    stages = [Stage("extract_raw_info", _extract_raw_info, inputs=[], outputs=[config.raw_info_path],
+                    params={"bad_ch_names": config.bad_ch_names}, modules=["mat_to_epochs_conversion.create_info"]),
+
+              Stage("convert_mat_to_epochs", partial(_convert_mat_to_epochs, mat_file=mat_file), inputs=[mat_file, config.raw_info_path],
+                    outputs=[config.epochs_path, config.evoked_path],
+                    params={"event_ids": config.event_ids, "baseline_time": config.baseline_time, "oddball_id": config.oddball_id,
+                            "bad_trials": config.bad_trials.get(subject_num)}, modules=["mat_to_epochs_conversion.convert_main_funcs"]),
+
+              Stage("write_epoch_cache", _write_epoch_cache, inputs=[config.epochs_path], outputs=cache_files,
+                    params={"dtype": config.epoch_cache_dtype}, modules=["epoch_cache"]),
+
+              Stage("combine_epochs", _combine_epochs, inputs=[config.epochs_path], outputs=[config.epochs_combined_path],
+                    params={"event_ids": config.event_ids, "new_event_ids": config.new_event_ids}, modules=["mat_to_epochs_conversion.combine_epochs"])]
+
+    for condition in conditions:
+        stages.append(Stage(f"compute_csd/{condition}", partial(_compute_csd_condition, condition=condition), inputs=cache_files,
+                            outputs=[config.get_csd_path(condition), config.get_csd_mean_path(condition), config.get_csd_baseline_part_path(condition)],
+                            params=csd_params, modules=["analyses.compute_csd", "analyses.pair_csd", "analyses.precision", "epoch_cache"]))
+
+    stages.append(Stage("compute_csd/baseline", _compute_baseline_csd,
+                        inputs=cache_files + [config.get_csd_baseline_part_path(condition) for condition in conditions],
+                        outputs=[config.get_csd_path('baseline'), config.get_csd_mean_path('baseline')], params=csd_params, modules=["analyses.compute_csd", "analyses.pair_csd"]))
+
+    for con1, con2 in config.tfr_contrasts:
+        stages.append(Stage(f"compute_tfr_contrast/{con1[0]}-{con2[0]}", partial(_compute_tfr_contrast, con1=con1, con2=con2),
+                            inputs=cache_files, outputs=[config.get_tfr_contrast_path(con1, con2)],
+                            params={"freqs": tfr_freqs, "con1": con1, "con2": con2, "new_event_ids": config.new_event_ids,
+                                    "tmin": config.baseline_time[0], "tmax": config.post_stim_time[1], "compute_dtype": config.compute_dtype},
+                            modules=["analyses.tfr_psd_analyses", "analyses.precision", "epoch_cache"]))
+
+    if config.compute_induced_power:
+        induced_params = {"freqs": tfr_freqs, "chunk_size": config.induced_chunk_size, "decim": config.induced_decim,
+                          "subtract_evoked": config.induced_subtract_evoked, "compute_dtype": config.compute_dtype}
+
+        stages.append(Stage("compute_induced_power", _compute_induced_power, inputs=cache_files, outputs=[config.induced_sums_path],
+                            params=induced_params, modules=["analyses.induced_power", "analyses.precision", "epoch_cache"]))
+
+        for con1, con2 in config.tfr_contrasts:
+            stages.append(Stage(f"compute_induced_contrast/{con1[0]}-{con2[0]}", partial(_compute_induced_contrast, con1=con1, con2=con2),
+                                inputs=[config.induced_sums_path] + cache_files[2:3],
+                                outputs=[config.get_induced_tfr_contrast_path(con1, con2), config.get_itc_contrast_path(con1, con2)],
+                                params={"con1": con1, "con2": con2, "new_event_ids": config.new_event_ids, "tmin": config.baseline_time[0],
+                                        "tmax": config.post_stim_time[1]}, modules=["analyses.induced_power"]))
+
+    stages.append(Stage("compute_psd", _compute_psd, inputs=[config.evoked_path], outputs=[config.psd_path],
+                        params={"freq_bands": config.freq_bands, "baseline_time": config.baseline_time, "post_stim_time": config.post_stim_time},
+                        modules=["analyses.tfr_psd_analyses"]))
+
+    # input files of every report section
+    csd_files = [get_path(condition) for condition in conditions + ['baseline'] for get_path in (config.get_csd_path, config.get_csd_mean_path)]
+    tfr_files = [config.get_tfr_contrast_path(con1, con2) for con1, con2 in config.tfr_contrasts]
+
+    section_inputs = {'psd': [config.psd_path],
+                      'csd': cache_files[-1:] + csd_files,
+                      'coherence': cache_files[-1:] + [config.get_csd_mean_path(condition) for condition in conditions + ['baseline']],
+                      'gfp': [config.evoked_path],
+                      'tfr_contrast': tfr_files,
+                      'tfr_contrast_topoplots': tfr_files}
+
+    section_stages = []
+
+    # sections in the order of the report (see add_to_report.create_figure_specs)
+    for section in ['psd', 'csd', 'coherence', 'gfp', 'tfr_contrast', 'tfr_contrast_topoplots']:
+        stages.append(Stage(f"add_to_report/{section}", partial(_add_report_section, section=section), inputs=section_inputs[section],
+                            outputs=[config.h5_report_path, config.html_report_path], params={"time_frames": config.time_frames},
+                            modules=["add_to_report", "topomap_engine"], after=list(section_stages)))
+        section_stages.append(f"add_to_report/{section}")
+
+    return stages
+
+
+def _dependencies(stages: list[Stage]) -> dict[str, list[str]]:
+    # names of the stages that write the inputs of every stage
+    writers = {}
+    for stage in stages:
+        for file_name in stage.outputs:
+            writers.setdefault(file_name, []).append(stage.name)
+
+    return {stage.name: [writer for file_name in stage.inputs for writer in writers.get(file_name, []) if writer != stage.name] for stage in stages}
+
+
+@beartype
+def select_stages(stages: list[Stage], targets: list[str] | None = None) -> list[Stage]:
+    """
+    Recieves:
+    * stages: list of Stage instances (see create_stages).
+    * targets: list of names of stages or of kinds of stages (e.g. compute_csd selects compute_csd/food_1, ..., compute_csd/baseline),
+      None for all stages.
+
+    Function:
+    * Selects the target stages and all the stages they depend on.
+
+    Returns:
+    * selected_stages: list of the selected stages in the order of stages.
+
+    """
+
+    if targets is None:
+        return list(stages)
+
+    dependencies = _dependencies(stages)
+
+    needed = set()
+    for target in targets:
+        matched = [stage.name for stage in stages if stage.name == target or stage.name.startswith(f"{target}/")]
+
+        if not matched:
+            raise ValueError(f"Unknown target {target}, the stages are: {', '.join(stage.name for stage in stages)}")
+
+        needed.update(matched)
+
+    # add the stages the targets depend on
+    to_visit = list(needed)
+    while to_visit:
+        for dependency in dependencies[to_visit.pop()]:
+            if dependency not in needed:
+                needed.add(dependency)
+                to_visit.append(dependency)
+
+    return [stage for stage in stages if stage.name in needed]
+
+
+def _run_stage(stage: Stage, context: dict, profiler, stage_fingerprint: str | None):
+    # run a stage (measured by the profiler) and record it as completed
+    with profiler.stage(stage.name):
+        stage.run(context)
+
+    if stage_fingerprint is not None:
+        stage_cache.record(f"pipeline/{stage.name}", stage_fingerprint, stage.outputs)
+
+
+@beartype
+def run_stages(stages: list[Stage], subject_num: str, folder: str|os.PathLike, targets: list[str] | None = None, profiler=None,
+               n_workers: int = config.n_stage_workers, dry_run: bool = False, resume: bool = config.use_stage_cache,
+               prefetched: dict | None = None) -> dict[str, dict]:
+    """
+    Recieves:
+    * stages: list of Stage instances of the subject (see create_stages).
+    * subject_num: the name of the subject folder.
+    * folder: path to the subject folder (the current directory).
+    * targets: list of names of stages or kinds of stages to run, with the stages they depend on (see select_stages), None for all stages.
+    * profiler: profiling.Profiler measuring every stage, None for a new profiler of the subject.
+    * n_workers: int, number of stages run concurrently (threads), 1 runs the stages in order.
+    * dry_run: bool, only print the stages that would run, without running them.
+    * resume: bool, skip the stages completed in a previous run whose inputs, parameters and code didn't change
+      (recorded in the stage cache as pipeline/<stage>).
+    * prefetched: the inputs of the subject read ahead (see prefetch.load_subject_inputs), used by extract_raw_info and
+      convert_mat_to_epochs instead of reading them (the trials are removed from the dictionary after the conversion), None to read them.
+
+    Function:
+    * Runs the selected stages, every stage as soon as the stages it depends on finished. A failing stage doesn't stop the
+      stages that don't depend on it, the stages that depend on it are blocked. Completed stages are recorded, so the next run
+      resumes after them. A dry run predicts a stage is up to date if it is complete and none of the stages it depends on runs.
+
+    Returns:
+    * stage_summary: dictionary of stage name -> {'status': 'done', 'up to date', 'failed', 'blocked' or 'would run' (dry run), 'error'}.
+
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    from src import profiling
+
+    if n_workers < 1:
+        raise ValueError(f"n_workers must be a positive integer, got {n_workers}")
+
+    selected_stages = select_stages(stages, targets)
+    selected_names = [stage.name for stage in selected_stages]
+
+    dependencies = _dependencies(selected_stages)
+    order_after = {stage.name: [name for name in stage.after if name in selected_names] for stage in selected_stages}
+
+    stage_summary = {}
+
+    if dry_run:
+        for stage in selected_stages:
+            if any(stage_summary[dependency]["status"] == "would run" for dependency in dependencies[stage.name]):
+                status = "would run"
+            else:
+                status = "up to date" if resume and stage.is_complete(stage.fingerprint()) else "would run"
+
+            stage_summary[stage.name] = {"status": status, "error": None}
+            print(f"{subject_num} - {stage.name}: {status}")
+
+        return stage_summary
+
+    if profiler is None:
+        profiler = profiling.Profiler(subject_num)
+
+    context = {"subject_num": subject_num, "folder": folder, "values": {}, "locks": {}, "lock": threading.Lock(),
+               "prefetched": {} if prefetched is None else prefetched}
+
+    pending = list(selected_stages)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+
+        while pending or running:
+
+            for stage in list(pending):
+                if not all(name in stage_summary for name in dependencies[stage.name] + order_after[stage.name]):
+                    continue
+
+                pending.remove(stage)
+
+                failed_dependencies = [name for name in dependencies[stage.name] if stage_summary[name]["status"] in ("failed", "blocked")]
+
+                if failed_dependencies:
+                    stage_summary[stage.name] = {"status": "blocked", "error": f"depends on {', '.join(failed_dependencies)}"}
+                    print(f"{subject_num} - {stage.name}: blocked, depends on {', '.join(failed_dependencies)}")
+                    continue
+
+                # the inputs are final now, the stage is skipped if it was completed with the same inputs
+                stage_fingerprint = stage.fingerprint()
+
+                if resume and stage.is_complete(stage_fingerprint):
+                    stage_summary[stage.name] = {"status": "up to date", "error": None}
+                    print(f"{subject_num} - {stage.name}: up to date")
+                    continue
+
+                running[executor.submit(_run_stage, stage, context, profiler, stage_fingerprint)] = stage
+
+            if not running:
+                if pending:
+                    raise RuntimeError(f"The stages {', '.join(stage.name for stage in pending)} can't be ordered")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                stage = running.pop(future)
+
+                try:
+                    future.result()
+                    stage_summary[stage.name] = {"status": "done", "error": None}
+
+                except Exception as e:
+                    print(f"An error occured in {stage.name} of {subject_num}:", e)
+                    traceback.print_exception(e)
+                    stage_summary[stage.name] = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+
+    return {name: stage_summary[name] for name in selected_names}
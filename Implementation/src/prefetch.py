@@ -0,0 +1,307 @@
+"""
+
+Read ahead of the inputs of the next subjects: while a subject is computed (CSD, TFR, report), a background thread reads the
+raw info (the header of the raw BTi recording) and the trials of the mat file of the following subjects into a bounded buffer,
+the conversion stages of a subject then start from memory instead of waiting for multi-GB reads from the network share.
+
+At most config.prefetch_depth subjects are held ahead and their size is bounded by config.prefetch_memory_budget, a subject
+larger than the budget isn't read ahead (its stages read it). Only the inputs the stages will read are read ahead: the raw
+info if it wasn't saved yet, and the trials if the epochs weren't converted since the last change of the mat file.
+
+"""
+import os, glob, threading, traceback
+from beartype import beartype
+from src import config
+
+
+def _mat_file(folder: str|os.PathLike) -> str | None:
+    # the mat file with the epoched data (the first and only mat file of the folder, see pipeline.create_stages)
+    mat_files = glob.glob(os.path.join(folder, config.mat_file_path_pattern))
+    return os.path.abspath(mat_files[0]) if mat_files else None
+
+
+def _needs_raw_info(folder: str|os.PathLike) -> bool:
+    return not os.path.exists(os.path.join(folder, config.raw_info_path))
+
+
+def _needs_trials(folder: str|os.PathLike, mat_file: str | None) -> bool:
+    # the epochs are converted again only if the mat file changed since (see stage_cache.py)
+    if mat_file is None:
+        return False
+
+    epochs_file = os.path.join(folder, config.epochs_path)
+    return not os.path.exists(epochs_file) or os.path.getmtime(epochs_file) < os.path.getmtime(mat_file)
+
+
+def _keep_indices(reader, folder: str|os.PathLike):
+    # indices of the trials the conversion keeps (oddball and bad trials excluded, see convert_main_funcs.convert_mat_h5_to_epochs)
+    import numpy as np
+    from mat_to_epochs_conversion import remove_oddball_trials
+
+    keep_mask = remove_oddball_trials.create_keep_mask(reader.events_code, config.oddball_id,
+                                                       config.bad_trials.get(os.path.basename(os.path.normpath(folder))))
+    return np.flatnonzero(keep_mask)
+
+
+@beartype
+def estimate_subject_bytes(folder: str|os.PathLike) -> int:
+    """
+    Recieves:
+    * folder: path to a subject folder.
+
+    Function:
+    * Estimates the memory of the inputs of the subject that would be read ahead (see load_subject_inputs), without reading them:
+      the kept trials of a v. 7.3 mat file in float64, the size of the file for other mat files, the raw info is negligible.
+
+    Returns:
+    * the estimated size in bytes, 0 if nothing would be read ahead.
+
+    """
+    import h5py
+    from mat_to_epochs_conversion import read_mat_h5
+
+    mat_file = _mat_file(folder)
+
+    if not _needs_trials(folder, mat_file):
+        return 0
+
+    if h5py.is_hdf5(mat_file):
+        with read_mat_h5.open_mat_h5(mat_file) as reader:
+            n_channels, n_times = reader.trial.shape[1:]
+            return len(_keep_indices(reader, folder)) * n_channels * n_times * 8
+
+    return os.path.getsize(mat_file)
+
+
+@beartype
+def load_subject_inputs(folder: str|os.PathLike) -> dict:
+    """
+    Recieves:
+    * folder: path to a subject folder.
+
+    Function:
+    * Reads the inputs of the subject that its stages will read: the raw info (if it wasn't saved yet, see create_info.extract_raw_info)
+      and the trials of the mat file (if the epochs weren't converted since the last change of the mat file): the kept trials of
+      a v. 7.3 mat file (as convert_main_funcs.convert_mat_h5_to_epochs reads them) or the dictionary of another mat file.
+      The current directory isn't changed, the inputs are read while another subject is computed.
+
+    Returns:
+    * inputs: dictionary with 'mat_file' (absolute path), 'raw_info', 'data' and 'sub_dict', None for the inputs not read.
+
+    """
+    import numpy as np
+    import h5py
+    from mat_to_epochs_conversion import create_info, read_mat_h5, convert_main_funcs
+
+    mat_file = _mat_file(folder)
+    inputs = {"mat_file": mat_file, "raw_info": None, "data": None, "sub_dict": None}
+
+    if _needs_raw_info(folder):
+        inputs["raw_info"] = create_info.extract_raw_info(folder)
+
+    if _needs_trials(folder, mat_file):
+
+        if h5py.is_hdf5(mat_file):
+            with read_mat_h5.open_mat_h5(mat_file) as reader:
+                keep_indices = _keep_indices(reader, folder)
+
+                inputs["data"] = np.empty((len(keep_indices),) + reader.trial.shape[1:], dtype=np.float64)
+                reader.trial.read_into(inputs["data"], keep_indices)
+
+        else:
+            inputs["sub_dict"] = convert_main_funcs.convert_mat_to_dict(mat_file)
+
+    return inputs
+
+
+@beartype
+def warm_subject_inputs(folder: str|os.PathLike, chunk_size: int = 64 * 2**20) -> None:
+    """
+    Recieves:
+    * folder: path to a subject folder.
+    * chunk_size: bytes read at a time.
+
+    Function:
+    * Reads the inputs of the subject its stages will read and discards them: the header of the raw BTi recording (the raw info
+      is read and dropped, see create_info.extract_raw_info) and the mat file through a reused buffer. The files are then in the
+      page cache of the system and the worker process of the subject reads them from memory (see scheduler.run_subjects, the
+      worker processes can't share the arrays of load_subject_inputs).
+
+    """
+    from mat_to_epochs_conversion import create_info
+
+    if _needs_raw_info(folder):
+        create_info.extract_raw_info(folder)
+
+    mat_file = _mat_file(folder)
+
+    if not _needs_trials(folder, mat_file):
+        return None
+
+    buffer = bytearray(chunk_size)
+
+    with open(mat_file, "rb", buffering=0) as f:
+        while f.readinto(buffer):
+            pass
+
+    return None
+
+
+class SubjectPrefetcher:
+    """
+    Background thread that reads the inputs of the subjects ahead of their processing, in the order of folders.
+
+    Use as:
+        with SubjectPrefetcher(folders) as prefetcher:
+            for folder in folders:
+                inputs = prefetcher.get(folder)
+                ...
+
+    * load: function of a folder that reads its inputs (load_subject_inputs, or warm_subject_inputs for the page cache).
+    * estimate: function of a folder that estimates the size of its inputs in bytes without reading them.
+    * depth: number of subjects read ahead, 0 disables the read ahead.
+    * memory_budget: bytes, the read ahead subjects that weren't taken yet are at most this size together, a larger subject is skipped.
+
+    get releases the subject from the buffer (the subject in compute isn't counted in the budget), the buffer is bounded by depth
+    and memory_budget. A subject that failed to be read ahead or was skipped is returned as None, its stages read their inputs
+    (and report the errors). get(folder, wait=False) doesn't wait for a subject being read, its read is dropped when it finishes.
+
+    """
+
+    def __init__(self, folders: list, load=load_subject_inputs, estimate=estimate_subject_bytes, depth: int = config.prefetch_depth,
+                 memory_budget: int = config.prefetch_memory_budget):
+        self.folders = list(folders)
+        self.load = load
+        self.estimate = estimate
+        self.depth = depth
+        self.memory_budget = memory_budget
+
+        self._buffer = {} # folder -> (inputs, nbytes)
+        self._buffered_bytes = 0
+        self._loading = None # folder being read
+        self._released = set() # folders taken while they were read, dropped when their read finishes
+        self._next_index = 0 # index of the first folder that wasn't taken yet
+        self._closed = False
+        self._condition = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+        if self.depth > 0:
+            self._thread.start()
+
+    def _run(self):
+        for index, folder in enumerate(self.folders):
+
+            with self._condition:
+                # wait for a free place in the buffer, folders already taken are skipped
+                self._condition.wait_for(lambda: self._closed or index < self._next_index
+                                         or index - self._next_index < self.depth and len(self._buffer) < self.depth)
+
+                if self._closed:
+                    return
+
+                if index < self._next_index:
+                    continue
+
+            try:
+                nbytes = self.estimate(folder)
+
+                if nbytes > self.memory_budget:
+                    print(f"{folder}: {nbytes / 2**20:.0f} MB is over the prefetch memory budget, it is read by its stages")
+                    continue
+
+                with self._condition:
+                    self._condition.wait_for(lambda: self._closed or index < self._next_index
+                                             or self._buffered_bytes + nbytes <= self.memory_budget)
+
+                    if self._closed:
+                        return
+
+                    if index < self._next_index:
+                        continue
+
+                    self._loading = folder
+                    self._buffered_bytes += nbytes
+
+                try:
+                    inputs = self.load(folder)
+
+                except Exception:
+                    with self._condition:
+                        self._buffered_bytes -= 0 if self._closed else nbytes
+                        self._released.discard(folder)
+                    raise
+
+                with self._condition:
+                    # a subject read after close, taken without waiting for it or skipped (a later folder was taken) is dropped
+                    if folder in self._released or index < self._next_index - 1:
+                        self._released.discard(folder)
+                        self._buffered_bytes -= 0 if self._closed else nbytes
+
+                    elif not self._closed:
+                        self._buffer[folder] = (inputs, nbytes)
+
+            except Exception as e:
+                print(f"Reading ahead {folder} failed, it is read by its stages:", e)
+                traceback.print_exc()
+
+            finally:
+                with self._condition:
+                    self._loading = None
+                    self._condition.notify_all()
+
+    def get(self, folder: str|os.PathLike, wait: bool = True):
+        """
+        Recieves:
+        * folder: the subject folder to process next (one of folders).
+        * wait: bool, wait for the subject if it is being read, False returns None at once and the read continues (the inputs
+          are dropped and their memory released when it finishes, e.g. the page cache read ahead of a subject whose worker is free).
+
+        Function:
+        * Takes the read ahead inputs of the subject out of the buffer, waits if the subject is being read. The folders before it
+          aren't read ahead anymore and their read ahead inputs are dropped.
+
+        Returns:
+        * inputs: the inputs returned by load, None if the subject wasn't read ahead.
+
+        """
+        with self._condition:
+            self._next_index = max(self._next_index, self.folders.index(folder) + 1)
+
+            if not wait and self._loading == folder:
+                self._released.add(folder)
+                self._condition.notify_all()
+                return None
+
+            self._condition.wait_for(lambda: self._loading != folder)
+
+            inputs, nbytes = self._buffer.pop(folder, (None, 0))
+            self._buffered_bytes -= nbytes
+
+            # the read ahead subjects before it won't be taken anymore
+            for skipped_folder in self.folders[:self._next_index]:
+                _, skipped_nbytes = self._buffer.pop(skipped_folder, (None, 0))
+                self._buffered_bytes -= skipped_nbytes
+
+            self._condition.notify_all()
+
+        return inputs
+
+    def close(self):
+        """
+        Function:
+        * Stops the read ahead and drops the buffered subjects (a subject being read is dropped when its read finishes).
+
+        """
+        with self._condition:
+            self._closed = True
+            self._buffer.clear()
+            self._released.clear()
+            self._buffered_bytes = 0
+            self._condition.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
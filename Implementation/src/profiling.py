@@ -0,0 +1,274 @@
+"""
+
+Per-stage profiling of the pipeline: every stage of a subject is run inside Profiler.stage, which records its wall time,
+CPU time, peak resident memory, tracemalloc peak and the bytes read and written. The measurements are saved to a profile
+file in the subject's folder (config.profile_path). Hot stages can also dump cProfile statistics (config.cprofile_hot_stages).
+
+"""
+import os, json, time, threading, tracemalloc, cProfile, glob
+from contextlib import contextmanager
+from beartype import beartype
+from src import config
+
+
+def _current_rss() -> int:
+    # resident set size of the process in bytes (linux), 0 if unavailable
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def _cpu_time() -> float:
+    # CPU time of the process (all threads) and of its finished child processes (e.g. the report rendering processes)
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _io_bytes() -> tuple[int, int]:
+    # bytes read and written by the process through read/write calls (linux), including reads served from the page cache
+    try:
+        with open("/proc/self/io") as f:
+            io = dict(line.split(": ") for line in f.read().splitlines())
+        return int(io["rchar"]), int(io["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+class _RssSampler(threading.Thread):
+    # samples the resident set size every interval seconds, the peak is read after stop()
+
+    def __init__(self, interval: float = 0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = _current_rss()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, _current_rss())
+
+    def stop(self) -> int:
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, _current_rss())
+        return self.peak
+
+
+class Profiler:
+    """
+    Records the measurements of the stages of a subject.
+
+    Use as:
+        profiler = Profiler(subject_num)
+        with profiler.stage("compute_csd"):
+            ...
+        profiler.save()
+
+    trace_memory starts tracemalloc for the lifetime of the profiler (python and numpy allocations are traced, which slows
+    down python heavy stages), cprofile_stages are the names of the stages to run under cProfile (config.hot_stages if
+    config.cprofile_hot_stages), their statistics are dumped to profile_<stage>.prof in the current directory.
+    A name also selects the stages of its kind (compute_csd selects compute_csd/food_1, see pipeline.py).
+
+    Stages may run concurrently in threads (see pipeline.run_stages): CPU time, memory and I/O are measured for the whole
+    process, the measurements of overlapping stages include each other.
+
+    cProfile runs need config.n_stage_workers = 1: a cProfile only profiles the thread that enabled it, the other stage threads
+    and the joblib workers of a stage (e.g. the CSD workers) are not profiled, only the report rendering processes are
+    (see enable_worker_cprofile). Python 3.12 and later also refuse a second cProfile enabled at the same time.
+
+    """
+
+    def __init__(self, subject_num: str, trace_memory: bool = config.trace_memory, cprofile_stages: list[str] | None = None):
+        self.subject_num = subject_num
+        self.trace_memory = trace_memory
+        if cprofile_stages is None:
+            cprofile_stages = config.hot_stages if config.cprofile_hot_stages else []
+
+        self.cprofile_stages = cprofile_stages
+        self.stages = []
+        self.resources = None # the resource plan of the subject (see resources.py), saved with the measurements
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Recieves:
+        * name: name of the stage.
+
+        Function:
+        * Context manager that measures the code run inside it and appends the measurements to the stages of the profiler,
+          also when the stage raises (the stage is then recorded with failed=True).
+
+        """
+
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+
+        rss_sampler = _RssSampler()
+        rss_sampler.start()
+
+        profile = cProfile.Profile() if name.split("/")[0] in self.cprofile_stages or name in self.cprofile_stages else None
+
+        start_wall, start_cpu, (start_read, start_written) = time.perf_counter(), _cpu_time(), _io_bytes()
+
+        failed = True
+
+        try:
+            if profile is not None:
+                _active_cprofile.stage = name
+                profile.enable()
+
+            yield
+
+            failed = False
+
+        finally:
+            if profile is not None:
+                profile.disable()
+                _active_cprofile.stage = None
+
+            end_read, end_written = _io_bytes()
+
+            measurements = {"stage": name, "failed": failed,
+                            "wall_time": time.perf_counter() - start_wall, "cpu_time": _cpu_time() - start_cpu,
+                            "peak_rss": rss_sampler.stop(),
+                            "tracemalloc_peak": tracemalloc.get_traced_memory()[1] if self.trace_memory else None,
+                            "bytes_read": end_read - start_read, "bytes_written": end_written - start_written,
+                            "cprofile": None}
+
+            if profile is not None:
+                measurements["cprofile"] = os.path.abspath(get_cprofile_path(name))
+                profile.dump_stats(measurements["cprofile"])
+                merge_worker_cprofiles(name)
+
+            self.stages.append(measurements)
+
+            print(f"{self.subject_num} - {name}: {measurements['wall_time']:.2f}s wall, {measurements['cpu_time']:.2f}s cpu, "
+                  f"{measurements['peak_rss'] / 2**20:.0f} MB peak rss")
+
+    def save(self, profile_path: str|os.PathLike = config.profile_path):
+        """
+        Recieves:
+        * profile_path: path of the json profile file.
+
+        Function:
+        * Writes the measurements of all stages and their totals, with the resource plan of the subject, to the profile file and stops tracemalloc.
+
+        """
+
+        total = {"wall_time": sum(stage["wall_time"] for stage in self.stages), "cpu_time": sum(stage["cpu_time"] for stage in self.stages),
+                 "peak_rss": max((stage["peak_rss"] for stage in self.stages), default=0),
+                 "bytes_read": sum(stage["bytes_read"] for stage in self.stages),
+                 "bytes_written": sum(stage["bytes_written"] for stage in self.stages)}
+
+        with open(profile_path, "w") as f:
+            json.dump({"subject": self.subject_num, "resources": self.resources, "stages": self.stages, "total": total}, f, indent=1)
+
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+@beartype
+def get_cprofile_path(stage: str) -> str:
+    """
+    Recieves:
+    * stage: name of the stage.
+
+    Returns:
+    * the path of the cProfile statistics of the stage (in the current directory), readable with pstats.Stats.
+
+    """
+    return f"profile_{_file_stage(stage)}.prof"
+
+
+def _file_stage(stage: str) -> str:
+    # the name of the stage in file names (e.g. compute_csd/food_1 -> compute_csd-food_1)
+    return stage.replace("/", "-")
+
+
+# name of the stage currently run under cProfile in a thread (the stage attribute), per thread as the stages of a subject run in threads
+_active_cprofile = threading.local()
+
+# cProfile of the current worker process of render_figures (see add_to_report), None if not profiled
+_worker_profile = None
+
+
+def get_active_cprofile_stage() -> str | None:
+    """
+    Returns:
+    * the name of the stage the current thread runs under cProfile (see Profiler.stage), None if it runs no profiled stage.
+      Process pools started by the stage pass it to enable_worker_cprofile, so their workers are profiled too.
+
+    """
+    return getattr(_active_cprofile, "stage", None)
+
+
+@beartype
+def enable_worker_cprofile(stage: str):
+    """
+    Recieves:
+    * stage: name of the stage the worker process runs tasks of.
+
+    Function:
+    * Starts a cProfile for the tasks of the current worker process (used as the initializer of a process pool).
+      Worker processes are not profiled by the cProfile of their parent, their statistics are dumped by worker_cprofile
+      and merged into the statistics of the stage by merge_worker_cprofiles.
+
+    """
+    global _worker_profile
+    _worker_profile = (stage, cProfile.Profile())
+
+
+@contextmanager
+def worker_cprofile():
+    """
+    Function:
+    * Context manager for a task of a worker process: profiles the task if enable_worker_cprofile was called in the process
+      and dumps the accumulated statistics of the process (profile_<stage>_<pid>.prof), a worker may be stopped after any task.
+
+    """
+    if _worker_profile is None:
+        yield
+        return
+
+    stage, profile = _worker_profile
+
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(f"profile_{_file_stage(stage)}_{os.getpid()}.prof")
+
+
+@beartype
+def merge_worker_cprofiles(stage: str):
+    """
+    Recieves:
+    * stage: name of the stage.
+
+    Function:
+    * Merges the statistics of the worker processes of the stage into the statistics of the stage (see get_cprofile_path)
+      and removes the statistics files of the workers.
+
+    """
+    import pstats
+
+    worker_files = glob.glob(f"profile_{_file_stage(stage)}_*.prof")
+
+    if not worker_files:
+        return
+
+    stats = pstats.Stats(*worker_files)
+
+    if os.path.exists(get_cprofile_path(stage)):
+        stats.add(get_cprofile_path(stage))
+
+    stats.dump_stats(get_cprofile_path(stage))
+
+    for worker_file in worker_files:
+        os.remove(worker_file)
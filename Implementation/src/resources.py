@@ -0,0 +1,207 @@
+"""
+
+Resource plan of a run: the core and memory budget (config.cpu_budget, config.memory_budget) is divided between the subject
+processes (scheduler.py), the concurrent stages of a subject (threads, pipeline.run_stages), the joblib / process pool workers
+of a stage (n_jobs of the CSDs and of the cluster permutations) and the BLAS / OpenMP threads (threadpoolctl), so that running
+several subjects at once doesn't oversubscribe the machine:
+* subject processes: at most config.n_workers, the number of subjects, the cores and memory_budget // config.subject_memory.
+* cores of a subject: cores // subject processes, shared by its stage threads (cores of a stage: cores of a subject // stage threads).
+* n_jobs of a stage: the cores of the stage, every worker runs single-threaded BLAS.
+* BLAS threads of a subject process: the cores of a stage, the stages run by the threads of the process share this limit.
+The plan is set in every subject process (set_resource_plan) and read by the analyses (get_resource_plan, get_n_jobs), its decisions
+are printed and saved to the profile of the subject (see profiling.py) to tune the budget.
+
+"""
+import os, threading
+from contextlib import contextmanager
+from beartype import beartype
+from src import config
+
+# the plan of the process and the BLAS limits it applied, set by set_resource_plan
+_active_plan = {}
+_plan_lock = threading.Lock()
+
+
+def _usable_cores() -> int:
+    # cores the process may run on (the affinity of the process on linux)
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
+def _available_memory() -> int:
+    # memory available to new processes in bytes
+    import psutil
+
+    return int(psutil.virtual_memory().available)
+
+
+@beartype
+def create_resource_plan(n_subjects: int = 1, n_workers: int = config.n_workers, n_stage_workers: int = config.n_stage_workers,
+                         cpu_budget: int | None = config.cpu_budget, memory_budget: int | None = config.memory_budget,
+                         subject_memory: int = config.subject_memory) -> dict:
+    """
+    Recieves:
+    * n_subjects: number of subjects of the run.
+    * n_workers: largest number of subjects processed in parallel.
+    * n_stage_workers: number of stages of a subject run concurrently (threads).
+    * cpu_budget: number of cores of the run, all usable cores if None.
+    * memory_budget: bytes of memory of the run, the available memory if None.
+    * subject_memory: estimated peak memory of a subject process in bytes.
+
+    Function:
+    * Divides the cores and memory between the subject processes, the stage threads, the workers of a stage and the BLAS threads
+      (see the module docstring), every decision is recorded with its reason.
+
+    Returns:
+    * plan: dictionary with 'cores', 'memory', 'subject_processes', 'cores_per_subject', 'stage_workers', 'cores_per_stage',
+      'n_jobs', 'blas_threads' (of a subject process), 'worker_blas_threads' (of a worker of a stage) and 'decisions' (list of str).
+
+    """
+    decisions = []
+
+    cores = _usable_cores() if cpu_budget is None else cpu_budget
+    memory = _available_memory() if memory_budget is None else memory_budget
+    decisions.append(f"budget of {cores} cores and {memory / 2**30:.1f} GB"
+                     f" ({'usable cores' if cpu_budget is None else 'cpu_budget'}, {'available memory' if memory_budget is None else 'memory_budget'})")
+
+    subject_processes = max(1, min(n_workers, n_subjects, cores))
+    if subject_processes < n_workers:
+        decisions.append(f"{subject_processes} subject processes instead of n_workers={n_workers} ({n_subjects} subjects, {cores} cores)")
+
+    by_memory = max(1, memory // subject_memory)
+    if subject_processes > by_memory:
+        decisions.append(f"{by_memory} subject processes instead of {subject_processes}: the memory fits {by_memory} subjects "
+                         f"of subject_memory={subject_memory / 2**30:.1f} GB")
+        subject_processes = by_memory
+
+    cores_per_subject = max(1, cores // subject_processes)
+    stage_workers = max(1, n_stage_workers)
+    cores_per_stage = max(1, cores_per_subject // stage_workers)
+
+    decisions.append(f"{subject_processes} subject processes x {stage_workers} stage threads, {cores_per_subject} cores per subject "
+                     f"and {cores_per_stage} per stage: n_jobs={cores_per_stage} single-threaded workers or {cores_per_stage} BLAS threads")
+
+    plan = {"cores": cores, "memory": memory, "subject_processes": subject_processes, "cores_per_subject": cores_per_subject,
+            "stage_workers": stage_workers, "cores_per_stage": cores_per_stage, "n_jobs": cores_per_stage,
+            "blas_threads": cores_per_stage, "worker_blas_threads": 1, "decisions": decisions}
+
+    return plan
+
+
+@beartype
+def log_resource_plan(plan: dict, prefix: str = ""):
+    """
+    Recieves:
+    * plan: a resource plan (see create_resource_plan).
+    * prefix: printed before every decision (e.g. the subject).
+
+    Function:
+    * Prints the decisions of the plan.
+
+    """
+    for decision in plan["decisions"]:
+        print(f"{prefix}resources: {decision}")
+
+
+@beartype
+def set_resource_plan(plan: dict, prefix: str = ""):
+    """
+    Recieves:
+    * plan: the resource plan of the process (see create_resource_plan).
+    * prefix: printed before the decisions (see log_resource_plan).
+
+    Function:
+    * Makes plan the plan of the process, read by the analyses (get_resource_plan, get_n_jobs), and limits the BLAS and OpenMP
+      threads of the process to plan['blas_threads'] (threadpoolctl, for all threads of the process).
+
+    """
+    from threadpoolctl import threadpool_limits
+
+    with _plan_lock:
+        # the limits of a previous plan (the previous subject of a serial run) are restored first
+        if "limits" in _active_plan:
+            _active_plan["limits"].restore_original_limits()
+
+        _active_plan.clear()
+        _active_plan.update(plan=plan, limits=threadpool_limits(limits=plan["blas_threads"]))
+
+    log_resource_plan(plan, prefix)
+
+
+def reset_resource_plan():
+    """
+    Function:
+    * Restores the BLAS and OpenMP threads limited by set_resource_plan and forgets the plan of the process.
+
+    """
+    with _plan_lock:
+        if "limits" in _active_plan:
+            _active_plan["limits"].restore_original_limits()
+        _active_plan.clear()
+
+
+@beartype
+def get_resource_plan() -> dict:
+    """
+    Returns:
+    * plan: the resource plan of the process, the plan of a single subject (create_resource_plan) is set first if the process has none
+      (an analysis called outside of the scheduler).
+
+    """
+    with _plan_lock:
+        plan = _active_plan.get("plan")
+
+    if plan is None:
+        plan = create_resource_plan()
+        set_resource_plan(plan)
+
+    return plan
+
+
+@beartype
+def get_n_jobs(n_jobs: int | None = None, exclusive: bool = False) -> int:
+    """
+    Recieves:
+    * n_jobs: number of workers requested by the caller, None for the plan.
+    * exclusive: bool, the computation runs alone in its process (e.g. the cluster tests after the subjects), its workers
+      take the cores of a subject instead of the cores of a stage.
+
+    Returns:
+    * n_jobs: the requested number of workers (a positive n_jobs), or the workers of the plan (None or -1, reported
+      when the plan lowers -1 from all cores).
+
+    """
+    plan = get_resource_plan()
+
+    if n_jobs is not None and n_jobs > 0:
+        return n_jobs
+
+    planned = plan["cores_per_subject"] if exclusive else plan["n_jobs"]
+
+    if n_jobs == -1 and planned < _usable_cores():
+        print(f"resources: n_jobs=-1 runs {planned} workers of the plan instead of one per core")
+
+    return planned
+
+
+@contextmanager
+def limit_threads(n_threads: int | None):
+    """
+    Recieves:
+    * n_threads: number of BLAS and OpenMP threads, no limit if None.
+
+    Function:
+    * Context manager that limits the threads of the code run inside it, for the workers of a stage (plan['worker_blas_threads']).
+      The limits are global to the process: not for a stage run by a thread of a subject process (see set_resource_plan).
+
+    """
+    if n_threads is None:
+        yield
+        return
+
+    from threadpoolctl import threadpool_limits
+
+    with threadpool_limits(limits=n_threads):
+        yield
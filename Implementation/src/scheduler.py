@@ -0,0 +1,225 @@
+"""
+
+Subject level scheduling of the pipeline: every subject folder is processed (the stages of pipeline.py: conversion, CSD, TFR, 
+PSD and report) in a pool of worker processes, failures are isolated per subject and a run summary is returned.
+The inputs of the next subjects are read ahead while the current subjects are computed (see prefetch.py).
+
+"""
+import os, time, traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from beartype import beartype
+from src import config, profiling, prefetch, resources
+
+
+@beartype
+def process_subject(folder: str|os.PathLike, targets: list[str] | None = None, dry_run: bool = False, prefetched: dict | None = None,
+                    resource_plan: dict | None = None) -> dict:
+    """
+    Recieves:
+    * folder: path to the subject folder that contains the mat file with epoched data and the raw MEG recording.
+    * targets: list of names of stages or kinds of stages to run (see pipeline.select_stages), None for all stages.
+    * dry_run: bool, only print the stages that would run.
+    * prefetched: the inputs of the subject read ahead (see prefetch.load_subject_inputs), None to read them in the stages.
+    * resource_plan: the resource plan of the run (see resources.create_resource_plan), the plan of a single subject if None.
+
+    Function:
+    * Runs the stages of the pipeline (conversion, CSD, TFR, PSD and report generation, see pipeline.py) for a single subject, 
+      in the subject's folder. Stages completed in a previous run with the same inputs are skipped. A failing stage blocks only 
+      the stages that depend on it, any exception is caught and recorded so one failing subject doesn't stop the rest of the run.
+      The resource plan is set for the process (the BLAS threads, the stage threads and the workers of the analyses, see resources.py)
+      and saved to the profile of the subject with its measurements.
+
+    Returns:
+    * subject_summary: dictionary with the subject name, status ('ok' or 'failed'), wall time in seconds, the error (None if ok)
+      and the status of every stage (see pipeline.run_stages).
+
+    """
+    from src import pipeline
+
+    # extract subject number from the name of the folder:
+    subject_num = os.path.basename(os.path.normpath(folder))
+
+    subject_summary = {"subject": subject_num, "status": "ok", "wall_time": 0.0, "error": None, "stages": {}}
+
+    start_time = time.perf_counter()
+
+    # wall time, CPU time, memory and I/O of every stage, saved to the profile file of the subject
+    profiler = None if dry_run else profiling.Profiler(subject_num)
+
+    try:
+
+        if not os.path.exists(folder):
+            raise FileNotFoundError(f"The path {folder} doesn't exist")
+
+        folder = os.path.abspath(folder)
+        os.chdir(folder)
+
+        stages = pipeline.create_stages(subject_num)
+
+        n_stage_workers = config.n_stage_workers
+
+        if not dry_run:
+            resource_plan = resources.create_resource_plan() if resource_plan is None else resource_plan
+            resources.set_resource_plan(resource_plan, prefix=f"{subject_num} - ")
+            profiler.resources = resource_plan
+            n_stage_workers = resource_plan["stage_workers"]
+
+        subject_summary["stages"] = pipeline.run_stages(stages, subject_num, folder, targets=targets, profiler=profiler, dry_run=dry_run,
+                                                        prefetched=prefetched, n_workers=n_stage_workers)
+
+        errors = [f"{name}: {stage_summary['error']}" for name, stage_summary in subject_summary["stages"].items() 
+                  if stage_summary["status"] == "failed"]
+
+        if errors:
+            subject_summary["status"] = "failed"
+            subject_summary["error"] = "; ".join(errors)
+
+    except Exception as e:
+        print(f"An error occured for {subject_num}:", e)
+        traceback.print_exc()
+        subject_summary["status"] = "failed"
+        subject_summary["error"] = f"{type(e).__name__}: {e}"
+
+    # the profile is saved also for a failed subject, up to the failed stage
+    if os.path.isdir(folder) and profiler is not None:
+        profiler.save(os.path.join(folder, config.profile_path))
+
+    subject_summary["wall_time"] = time.perf_counter() - start_time
+
+    return subject_summary
+
+
+@beartype
+def run_subjects(folders: list[str], n_workers: int = config.n_workers, targets: list[str] | None = None, dry_run: bool = False,
+                 prefetch_depth: int = config.prefetch_depth) -> list[dict]:
+    """
+    Recieves:
+    * folders: list of paths to subject folders.
+    * n_workers: int, largest number of worker processes, each worker processes one subject at a time, lowered by the resource
+      plan to the cores and memory of the run (see resources.create_resource_plan). n_workers=1 runs all subjects serially in the current process.
+    * targets: list of names of stages or kinds of stages to run for every subject (see pipeline.select_stages), None for all stages.
+    * dry_run: bool, only print the stages that would run for every subject.
+    * prefetch_depth: int, number of subjects read ahead while the current subjects are computed (see prefetch.py), 0 disables it.
+
+    Function:
+    * Schedules process_subject for every subject folder in a process pool. A subject that fails (including a crashed worker
+      process) is recorded as failed without stopping the other subjects. A dying worker breaks the pool: the pool is replaced
+      and the subjects that ran in it are run again one at a time, the subject whose worker dies again is recorded as failed.
+      The inputs of the next subjects are read ahead in a background thread: run serially, the raw info and trials are passed to
+      the stages in memory, in the pool the mat files are read into the page cache of the system (arrays can't be shared with the
+      worker processes) and a subject is submitted when a worker is free.
+
+    Returns:
+    * run_summary: list of subject summaries (see process_subject) in the order of folders.
+
+    """
+
+    if n_workers < 1:
+        raise ValueError(f"n_workers must be a positive integer, got {n_workers}")
+
+    prefetch_depth = 0 if dry_run else prefetch_depth
+
+    # the cores and memory of the run divided between the subject processes and the work inside them, set by every subject process
+    resource_plan = resources.create_resource_plan(n_subjects=len(folders), n_workers=n_workers)
+
+    if resource_plan["subject_processes"] == 1:
+        with prefetch.SubjectPrefetcher(folders, depth=prefetch_depth) as prefetcher:
+            return [process_subject(folder, targets, dry_run, prefetched=prefetcher.get(folder), resource_plan=resource_plan) for folder in folders]
+
+    resources.log_resource_plan(resource_plan)
+
+    run_summary = {}
+    pending = list(folders)
+    suspects = [] # subjects whose worker pool broke while they ran, retried one at a time
+    futures = {}
+    max_workers = resource_plan["subject_processes"]
+
+    # every worker handles a single subject before it is replaced (max_tasks_per_child=1), memory of large subjects is
+    # released between subjects and state left by one subject (current directory, open figures) doesn't leak to the next.
+    executor = ProcessPoolExecutor(max_workers=max_workers, max_tasks_per_child=1)
+
+    with prefetch.SubjectPrefetcher(folders, load=prefetch.warm_subject_inputs, depth=prefetch_depth) as prefetcher:
+
+        try:
+            while pending or suspects or futures:
+
+                if suspects:
+                    # a subject that broke the pool with others is retried alone, a crash of its worker is then its own
+                    if not futures:
+                        folder = suspects.pop(0)
+                        futures[executor.submit(process_subject, folder, targets, dry_run, resource_plan=resource_plan)] = folder
+
+                # the read ahead files of a subject are released from the budget when it is submitted, its worker reads them from the page cache.
+                # A free worker doesn't wait for the read ahead of its subject, the worker reads the rest of the files itself
+                while not suspects and pending and len(futures) < max_workers:
+                    folder = pending.pop(0)
+                    prefetcher.get(folder, wait=False)
+                    futures[executor.submit(process_subject, folder, targets, dry_run, resource_plan=resource_plan)] = folder
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+                # a worker process that dies (e.g. out of memory) breaks the pool, the subjects running in it fail with it
+                if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                    done, _ = wait(futures)
+
+                crashed = {}
+
+                for future in done:
+                    folder = futures.pop(future)
+
+                    try:
+                        run_summary[folder] = future.result()
+
+                    except BrokenProcessPool as e:
+                        crashed[folder] = e
+
+                    except Exception as e:
+                        # process_subject couldn't record the failure (e.g. it couldn't be sent to the worker)
+                        print(f"An error occured in the worker of {folder}:", e)
+                        run_summary[folder] = _failed_summary(folder, e)
+
+                if crashed:
+                    executor.shutdown()
+                    executor = ProcessPoolExecutor(max_workers=max_workers, max_tasks_per_child=1)
+
+                    if len(crashed) == 1:
+                        (folder, e), = crashed.items()
+                        print(f"An error occured in the worker of {folder}:", e)
+                        run_summary[folder] = _failed_summary(folder, e)
+
+                    else:
+                        print(f"A worker process died while {', '.join(crashed)} ran, they are run again one at a time")
+                        suspects += [folder for folder in folders if folder in crashed]
+
+        finally:
+            executor.shutdown()
+
+    return [run_summary[folder] for folder in folders]
+
+
+def _failed_summary(folder: str, e: Exception) -> dict:
+    # the summary of a subject whose worker process failed, process_subject couldn't record the failure
+    return {"subject": os.path.basename(os.path.normpath(folder)), "status": "failed", "wall_time": None, 
+            "error": f"{type(e).__name__}: {e}", "stages": {}}
+
+
+@beartype
+def print_run_summary(run_summary: list[dict]):
+    """
+    Recieves:
+    * run_summary: list of subject summaries as returned by run_subjects.
+
+    Function:
+    * Prints the status and wall time of every subject and the number of failed subjects.
+
+    """
+
+    for subject_summary in run_summary:
+        wall_time = subject_summary["wall_time"]
+        wall_time = "-" if wall_time is None else f"{wall_time:.1f}s"
+        error = "" if subject_summary["error"] is None else f" ({subject_summary['error']})"
+        print(f"{subject_summary['subject']}: {subject_summary['status']} in {wall_time}{error}")
+
+    n_failed = sum(subject_summary["status"] == "failed" for subject_summary in run_summary)
+    print(f"{len(run_summary) - n_failed}/{len(run_summary)} subjects finished successfully")
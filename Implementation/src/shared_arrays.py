@@ -0,0 +1,82 @@
+"""
+
+Arrays shared with worker processes by name instead of by value: the parent places an array once in a memory-mapped file and passes
+its handle (the path, offset, shape and dtype, a few bytes) to the workers, which map the same pages (attach) instead of receiving a
+pickled copy. An array that is already a mapped file (the trials of the EpochCache, see epoch_cache.py) is shared as it is, without
+a copy. Other arrays are written to a file in config.shared_memory_directory (the shared memory of the system, /dev/shm, by default),
+removed when the SharedArray is closed.
+The memory of the shared array is held once by the page cache of the system, it doesn't grow with the number of workers.
+
+"""
+import os, mmap, tempfile, uuid
+import numpy as np
+from beartype import beartype
+from numpy.typing import NDArray
+from src import config
+
+
+def _shared_directory(directory: str|os.PathLike|None) -> str:
+    # the folder of the shared files, the shared memory of the system if it has one
+    if directory is not None:
+        return str(directory)
+
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class SharedArray:
+    """
+    An array shared with the worker processes (see attach), a context manager: the file written for the array is removed on exit.
+
+    """
+
+    @beartype
+    def __init__(self, array: NDArray, directory: str|os.PathLike|None = config.shared_memory_directory):
+        """
+        Recieves:
+        * array: the array to share. A memory-mapped array of a whole file (np.load(mmap_mode='r'), np.memmap) is shared without a copy,
+          any other array is copied once to a memory-mapped file.
+        * directory: folder of the file of the copy, the shared memory of the system (/dev/shm) or the temporary folder if None.
+
+        """
+        self.path = None
+
+        if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.flags.c_contiguous:
+            # the mapping of a whole file (not a slice of it), the workers map the same file
+            self.array = array
+            self.handle = {"path": os.path.abspath(array.filename), "offset": int(array.offset), "shape": array.shape, "dtype": array.dtype.str}
+
+        else:
+            self.path = os.path.join(_shared_directory(directory), f"shared_array_{os.getpid()}_{uuid.uuid4().hex}.dat")
+            self.array = np.memmap(self.path, dtype=array.dtype, mode="w+", shape=array.shape)
+            self.array[...] = array
+            self.handle = {"path": self.path, "offset": 0, "shape": array.shape, "dtype": array.dtype.str}
+
+    def close(self):
+        """
+        Function:
+        * Removes the file of the copy (the pages are released when the workers that attached to it drop their arrays).
+
+        """
+        if self.path is not None and os.path.exists(self.path):
+            del self.array
+            os.remove(self.path)
+            self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@beartype
+def attach(handle: dict) -> NDArray:
+    """
+    Recieves:
+    * handle: the handle of a SharedArray (SharedArray.handle).
+
+    Returns:
+    * array: read-only array mapping the shared array, no data is copied or read until it is indexed.
+
+    """
+    return np.memmap(handle["path"], dtype=np.dtype(handle["dtype"]), mode="r", offset=handle["offset"], shape=tuple(handle["shape"]))
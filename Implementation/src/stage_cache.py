@@ -0,0 +1,225 @@
+"""
+
+Content-addressed cache of the pipeline stages. Every stage records a fingerprint of its inputs (hash of the input files,
+the config values it depends on and the version of its code) in a json file in the subject's folder. On rerun, a stage whose
+fingerprint matches the recorded one and whose outputs were not changed since, loads its outputs from disk instead of recomputing.
+
+"""
+import os, json, hashlib, threading
+from importlib import metadata, util
+from beartype import beartype
+from src import config
+
+# stages of the same subject may record to the cache file concurrently
+_cache_lock = threading.Lock()
+
+
+def _read_cache(cache_path: str|os.PathLike) -> dict:
+    if not os.path.exists(cache_path):
+        return {"stages": {}, "file_hashes": {}}
+
+    with open(cache_path, "r") as f:
+        return json.load(f)
+
+
+def _write_cache(cache: dict, cache_path: str|os.PathLike):
+    # write to a temporary file and replace, an interrupted run never leaves a half written cache file
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp_path, cache_path)
+
+
+def _file_stat(file_name: str|os.PathLike) -> list[int]:
+    stat = os.stat(file_name)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _to_json(value):
+    # numpy arrays / scalars in config values and function arguments
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return repr(value)
+
+
+@beartype
+def file_hash(file_name: str|os.PathLike, cache_path: str|os.PathLike = config.stage_cache_path) -> str:
+    """
+    Recieves:
+    * file_name: path to the file to hash.
+    * cache_path: path to the json cache file.
+
+    Function:
+    * Computes the sha256 hash of the file content. The hash is memoized in the cache file by the file's size and
+      modification time, so multi-GB files are read only once after every change.
+
+    Returns:
+    * the hex digest of the file content.
+
+    """
+    key = os.path.abspath(file_name)
+    stat = _file_stat(file_name)
+
+    with _cache_lock:
+        memo = _read_cache(cache_path)["file_hashes"].get(key)
+
+    if memo is not None and memo["stat"] == stat:
+        return memo["sha256"]
+
+    with open(file_name, "rb") as f:
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+
+    with _cache_lock:
+        cache = _read_cache(cache_path)
+        cache["file_hashes"][key] = {"stat": stat, "sha256": digest}
+        _write_cache(cache, cache_path)
+
+    return digest
+
+
+@beartype
+def info_hash(info) -> str:
+    """
+    Recieves:
+    * info: mne.Info instance.
+
+    Function:
+    * Hashes the parts of info the analyses depend on: channel names, sampling frequency, sensor locations and the
+      device to head transform. Used instead of hashing the multi-GB raw recording info was read from.
+
+    Returns:
+    * the hex digest.
+
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([info["ch_names"], info["sfreq"]]).encode())
+
+    for ch in info["chs"]:
+        digest.update(ch["loc"].tobytes())
+
+    if info["dev_head_t"] is not None:
+        digest.update(info["dev_head_t"]["trans"].tobytes())
+
+    return digest.hexdigest()
+
+
+@beartype
+def code_version(modules: list) -> str:
+    """
+    Recieves:
+    * modules: list of the modules that implement a stage, modules or module names (names are not imported, see pipeline.py).
+
+    Function:
+    * Hashes the source files of the modules together with the mne version, a change in the code of a stage invalidates its cache.
+
+    Returns:
+    * the hex digest.
+
+    """
+    # the installed version, without importing mne
+    digest = hashlib.sha256(metadata.version("mne").encode())
+
+    for module in modules:
+        with open(util.find_spec(module).origin if isinstance(module, str) else module.__file__, "rb") as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+@beartype
+def fingerprint(input_files: list, params: dict, modules: list, cache_path: str|os.PathLike = config.stage_cache_path) -> str:
+    """
+    Recieves:
+    * input_files: list of paths to the files the stage reads.
+    * params: dictionary of the config values and arguments the stage depends on (e.g. freq_bands, post_stim_time, event_ids).
+    * modules: list of the modules that implement the stage.
+    * cache_path: path to the json cache file.
+
+    Function:
+    * Combines the input files hashes, the parameters and the code version to a single fingerprint of the stage's inputs.
+
+    Returns:
+    * stage_fingerprint: hex digest.
+
+    """
+    stage_inputs = {"files": [file_hash(file_name, cache_path) for file_name in input_files],
+                    "params": params,
+                    "code": code_version(modules)}
+
+    stage_inputs = json.dumps(stage_inputs, sort_keys=True, default=_to_json)
+
+    return hashlib.sha256(stage_inputs.encode()).hexdigest()
+
+
+@beartype
+def is_fresh(stage: str, stage_fingerprint: str, output_files: list, cache_path: str|os.PathLike = config.stage_cache_path) -> bool:
+    """
+    Recieves:
+    * stage: str, name of the stage.
+    * stage_fingerprint: the fingerprint of the stage's current inputs (see fingerprint).
+    * output_files: list of paths to the files the stage writes.
+    * cache_path: path to the json cache file.
+
+    Function:
+    * Checks if the stage was already run with the same inputs and its outputs still exist unchanged.
+
+    Returns:
+    * True if the outputs can be loaded from disk instead of recomputing the stage.
+
+    """
+    with _cache_lock:
+        record = _read_cache(cache_path)["stages"].get(stage)
+
+    if record is None or record["fingerprint"] != stage_fingerprint:
+        return False
+
+    for file_name in output_files:
+        if not os.path.exists(file_name) or record["outputs"].get(file_name) != _file_stat(file_name):
+            return False
+
+    return True
+
+
+@beartype
+def record(stage: str, stage_fingerprint: str, output_files: list, cache_path: str|os.PathLike = config.stage_cache_path):
+    """
+    Recieves:
+    * stage: str, name of the stage.
+    * stage_fingerprint: the fingerprint of the stage's inputs the outputs were computed from.
+    * output_files: list of paths to the files the stage wrote.
+    * cache_path: path to the json cache file.
+
+    Function:
+    * Records the fingerprint and the current state of the outputs of a stage that finished successfully.
+
+    """
+    with _cache_lock:
+        cache = _read_cache(cache_path)
+        cache["stages"][stage] = {"fingerprint": stage_fingerprint,
+                                  "outputs": {file_name: _file_stat(file_name) for file_name in output_files}}
+        _write_cache(cache, cache_path)
+
+
+@beartype
+def fresh_records(prefix: str, output_files: list, cache_path: str|os.PathLike = config.stage_cache_path) -> dict[str, str]:
+    """
+    Recieves:
+    * prefix: str, start of the names of the stages (e.g. 'report_figure/').
+    * output_files: list of paths to the files the stages write.
+    * cache_path: path to the json cache file.
+
+    Function:
+    * Finds the recorded stages whose outputs still exist unchanged, used by stages that share output files (the figures of the
+      report) to record again the stages they didn't rerun after rewriting the shared files.
+
+    Returns:
+    * dictionary of the names of the stages and their recorded fingerprints.
+
+    """
+    with _cache_lock:
+        records = _read_cache(cache_path)["stages"]
+
+    stats = {file_name: _file_stat(file_name) for file_name in output_files if os.path.exists(file_name)}
+
+    return {stage: record["fingerprint"] for stage, record in records.items() 
+            if stage.startswith(prefix) and all(record["outputs"].get(file_name) == stats.get(file_name) for file_name in output_files)}
@@ -35,7 +35,7 @@ def compute_csd_val(freq_bands: list[tuple[int, int]], time_range: tuple[float,
         raise ValueError(f"maximum and minimum of time_range can't extend the timerange of epochs:{config.baseline_time}-{config.post_stim_time}. See config.py and convert_dict_to_epochs function.")
 
 @beartype
-def compute_tfr_contrast(epochs: mne.EpochsArray, freqs: NDArray, con1: tuple[str, list[str]], con2: tuple[str, list[str]]):
+def compute_tfr_contrast(condition_sums: dict, freqs: NDArray, con1: tuple[str, list[str]], con2: tuple[str, list[str]]):
     """
     
     Function: asserts correct values of inputs to ompute_tfr_contrast function
@@ -54,12 +54,16 @@ def compute_tfr_contrast(epochs: mne.EpochsArray, freqs: NDArray, con1: tuple[st
     if len(con1[1])==0 or len(con2[1])==0:
         raise ValueError(f"con1[1] and con2[1] can't be empty lists")
 
-    if not set(con1[1]).issubset(epochs.event_id.keys()) or  not set(con2[1]).issubset(epochs.event_id.keys()):
-        raise ValueError("con1[1] and con2[1] should be lists with names of keys contained in epochs. \n con1[1] or con2[1] strings are not in epochs.event_id.keys()")
+    from analyses.tfr_psd_analyses import get_leaf_conditions
+
+    conditions = list(condition_sums["sums"].keys())
+
+    if not all(get_leaf_conditions([name], conditions) for name in con1[1] + con2[1]):
+        raise ValueError("con1[1] and con2[1] should be lists with names of conditions, combined conditions or tags of conditions contained in epochs. \n con1[1] or con2[1] strings don't match any of epochs.event_id.keys()")
 
 
 @beartype
-def combine_epochs(epochs: mne.EpochsArray, old_event_ids: dict, _new_event_ids: dict):
+def combine_epochs(epochs: mne.EpochsArray | mne.epochs.EpochsFIF, old_event_ids: dict, _new_event_ids: dict):
     """
     
     Function: asserts correct values of inputs to compute_tfr_contrast function
@@ -114,6 +118,20 @@ def remove_oddball_trials(data: NDArray[np.floating], events_code: NDArray[np.in
     if np.where(events_code == oddball_id)[0].size == 0:
         raise ValueError(f"{oddball_id} was not found in events_cpde, no oddball to remove")
 
+@beartype
+def create_keep_mask(events_code: NDArray[np.integer], bad_trials: list[int] | None):
+    """
+    
+    Function: asserts correct values of inputs to create_keep_mask function
+    
+    """
+
+    if events_code.ndim != 1:
+        raise ValueError("events_code should be a 1D numpy array, an incorrect input dimension was given")
+
+    if bad_trials is not None and not all(0 <= trial < len(events_code) for trial in bad_trials):
+        raise ValueError(f"bad_trials should be indices of trials, between 0 and {len(events_code) - 1}")
+
 @beartype            
 def sub_dict(sub_dict: dict):
     """
@@ -146,5 +164,21 @@ def sub_dict(sub_dict: dict):
         raise ValueError(f'Dimension or length of sub_dict["datafinalLow"]["label"] is incorrect, \n should be 1D array in the length of channels_number, see config.py')
 
 
+@beartype
+def mat_h5_reader(reader):
+    """
+    
+    Function: asserts correct shapes of the fields read by read_mat_h5.MatH5Reader
+    
+    """
+
+    #trial number (1st dimension of trial) varies for each participant, that's why we exclude it 
+    if reader.trial.shape[1:3] != (config.channels_number, config.time_points):
+        raise ValueError("Shape of ['datafinalLow']['trial'] is incorrect, should be: \n (trial_number, channels_number, time_points) \n see config.py")
+
+    if len(reader.trial) != len(reader.events_code):
+        raise ValueError('["datafinalLow"]["trial"] and ["datafinalLow"]["trialinfo"] mismatch in first dimension, \n should have matching number of trials')
 
+    if len(reader.ch_names) != config.channels_number:
+        raise ValueError('Length of ["datafinalLow"]["label"] is incorrect, should be channels_number, see config.py')
 
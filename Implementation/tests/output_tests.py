@@ -1,8 +1,16 @@
+import os, sys
 import mne
 from src import config
 from numpy.typing import NDArray
 from beartype import beartype
 
+# the analyses are imported from src (as by the pipeline), the same PairCSD class as the csds of the pipeline
+src_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+if src_path not in sys.path:
+    sys.path.insert(0, src_path)
+
+from analyses.pair_csd import PairCSD
+
 #output validation functions, functions validate correct values for global variables in main.py which contain the outputs of the functions used in the script.
 
 @beartype
@@ -24,7 +32,7 @@ def test_raw_info(raw_info: mne.Info):
     assert len(raw_info['chs'][0]['loc']) != 0
 
 @beartype
-def test_epochs_combined(epochs_combined: mne.EpochsArray):  
+def test_epochs_combined(epochs_combined: mne.EpochsArray | mne.epochs.EpochsFIF):  
     """
     
     Function: validates event id keys in epochs combined equal new_event_ids keys as set in config.py.
@@ -33,13 +41,18 @@ def test_epochs_combined(epochs_combined: mne.EpochsArray):
     assert epochs_combined.event_id.keys() == config.new_event_ids.keys()
 
 @beartype
-def test_csd(csd: mne.time_frequency.CrossSpectralDensity):
+def test_csd(csd: mne.time_frequency.CrossSpectralDensity | PairCSD):
     """
     
-    Function: validates the number of channels that the  cross spectral density calculated for is the number of channels set in config.py.
+    Function: validates the number of channels that the  cross spectral density calculated for is the number of channels set in config.py,
+    a pair-subset csd (see analyses/pair_csd.py) has the channels of its pairs and the auto spectra of all of them.
 
     """
-    assert csd.n_channels == config.channels_number
+    if isinstance(csd, PairCSD):
+        assert 0 < csd.n_channels <= config.channels_number
+        assert set(csd.pairs[csd.pairs[:, 0] == csd.pairs[:, 1], 0]) == set(range(csd.n_channels))
+    else:
+        assert csd.n_channels == config.channels_number
 
 @beartype
 def test_tfr(tfr: mne.time_frequency.AverageTFR, freqs: NDArray):
@@ -51,6 +64,16 @@ def test_tfr(tfr: mne.time_frequency.AverageTFR, freqs: NDArray):
 
     assert tfr.get_data().shape == (config.channels_number, len(freqs), config.time_points)
 
+@beartype
+def test_induced_tfr(tfr: mne.time_frequency.AverageTFR, freqs: NDArray, decim: int):
+    """
+    
+    Function: asserts the shape of an induced power or ITC contrast, as test_tfr with every decim-th time point.
+    
+    """
+
+    assert tfr.get_data().shape == (config.channels_number, len(freqs), len(range(0, config.time_points, decim)))
+
 @beartype   
 def test_psd(psd: mne.time_frequency.Spectrum):
     """
@@ -0,0 +1,180 @@
+# the figures of the report (add_to_report.py) listed from the outputs of a subject, rendered in the order of the serial report and updated incrementally
+
+import os, sys
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+mne = pytest.importorskip("mne")
+
+from src import config, add_to_report
+
+
+def _tfr(times, seed=0):
+    info = mne.create_info(["A1", "A2", "A3"], 1 / (times[1] - times[0]), "mag")
+    freqs = np.arange(3.0, 16.0, 2.0)
+    data = np.random.default_rng(seed).standard_normal((3, len(freqs), len(times)))
+
+    return mne.time_frequency.AverageTFRArray(info, data, times, freqs, nave=1, method="multitaper")
+
+
+def test_induced_contrasts_arent_listed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    times = np.arange(-0.3, 0.8, 0.01)
+    contrasts = config.tfr_contrasts[:2]
+
+    for c, (con1, con2) in enumerate(contrasts):
+        _tfr(times, c).save(config.get_tfr_contrast_path(con1, con2))
+        # the induced power and ITC contrasts are saved next to the evoked contrasts, on decimated time points
+        _tfr(times[::8], c).save(config.get_induced_tfr_contrast_path(con1, con2))
+        _tfr(times[::8], c).save(config.get_itc_contrast_path(con1, con2))
+
+    figure_specs = add_to_report.create_figure_specs("subject_1", sections=["tfr_contrast", "tfr_contrast_topoplots"])
+
+    files = {os.path.basename(figure_spec["file"]) for figure_spec in figure_specs}
+    assert files == {config.get_tfr_contrast_path(con1, con2) for con1, con2 in contrasts}
+
+    titles = [figure_spec["title"] for figure_spec in figure_specs if figure_spec["plot"] == "plot"]
+    assert titles == [config.get_report_titles(contrast=f"{con1[0]}-{con2[0]}")["tfr_contrast"] for con1, con2 in contrasts]
+
+
+def _info(n_channels=8, sfreq=200.0):
+    # magnetometers on a half sphere above the origin (the topo-plots are drawn for the magnetometers, see topomap_engine.py)
+    info = mne.create_info([f"A{channel + 1}" for channel in range(n_channels)], sfreq, "mag")
+    angles = np.linspace(0, 2 * np.pi, n_channels, endpoint=False)
+
+    for channel, ch in enumerate(info["chs"]):
+        elevation = 0.3 + 0.9 * (channel % 2)
+        ch["loc"][:3] = 0.1 * np.array([np.cos(angles[channel]) * np.cos(elevation), np.sin(angles[channel]) * np.cos(elevation), np.sin(elevation)])
+        ch["loc"][3:12] = np.eye(3).ravel()
+
+    return info
+
+
+def _write_outputs(conditions=("food_1", "food_2"), contrast=config.tfr_contrasts[1]):
+    # the outputs of a subject read by the report: combined epochs, evoked response, PSD, CSDs of the conditions and the baseline
+    # and a TFR contrast
+    rng = np.random.default_rng(0)
+    info = _info()
+
+    codes = np.repeat([config.new_event_ids[condition] for condition in conditions], 2)
+    events = np.column_stack([np.arange(len(codes)) * 1000, np.zeros(len(codes), int), codes])
+    epochs = mne.EpochsArray(rng.standard_normal((len(codes), len(info.ch_names), 221)) * 1e-13, info, events, tmin=-0.3,
+                             event_id={condition: config.new_event_ids[condition] for condition in conditions}, verbose=False)
+    epochs.save(config.epochs_combined_path)
+
+    evoked = epochs.average()
+    evoked.save(config.evoked_path)
+    evoked.compute_psd(fmin=1, fmax=40).save(config.psd_path)
+
+    for seed, condition in enumerate(list(conditions) + ["baseline"]):
+        _write_csd(condition, seed)
+
+    times = np.arange(-0.3, 0.8, 0.005)
+    tfr = mne.time_frequency.AverageTFRArray(info, rng.standard_normal((len(info.ch_names), 8, len(times))), times, np.arange(8.0, 24.0, 2.0),
+                                             nave=1, method="multitaper")
+    tfr.save(config.get_tfr_contrast_path(*contrast))
+
+
+def _write_csd(condition, seed):
+    from mne.time_frequency import CrossSpectralDensity
+
+    rng = np.random.default_rng(seed)
+    ch_names = _info().ch_names
+    rows, cols = np.triu_indices(len(ch_names))
+
+    data = rng.standard_normal((len(rows), 3)) + 1j * rng.standard_normal((len(rows), 3))
+    data[rows == cols] = np.abs(data[rows == cols]) + 3 # auto spectra
+
+    csd = CrossSpectralDensity(data, ch_names, frequencies=[8.0, 10.0, 12.0], n_fft=1)
+    csd.save(config.get_csd_path(condition), overwrite=True)
+    csd.mean([8], [12]).save(config.get_csd_mean_path(condition), overwrite=True)
+
+
+def _serial_figures(subject_num, conditions=("food_1", "food_2"), contrast=config.tfr_contrasts[1], freqs=np.arange(8.0, 24.0, 2.0)):
+    # (section, title) of the figures in the order of the add_figure calls of the serial add_to_report the report replaced
+    sections = config.get_report_sections(subject_num=subject_num)
+    figures = [(sections["psd"], config.get_report_titles()["psd"])]
+
+    for condition in list(conditions) + ["baseline"]:
+        titles = config.get_report_titles(condition=condition)
+        figures += [(sections["csd"], titles["csd"]), (sections["csd"], titles["csd_mean"]), (sections["coherence"], titles["coherence"])]
+
+    figures.append((sections["gfp"], config.get_report_titles()["gfp"]))
+
+    name = f"{contrast[0][0]}-{contrast[1][0]}"
+    figures.append((sections["tfr_contrast"], config.get_report_titles(contrast=name)["tfr_contrast"]))
+
+    band_edges = np.arange(freqs[0], freqs[-1] + 1, 4)
+    for tmin, tmax in config.time_frames:
+        for fmin, fmax in zip(band_edges[:-1], band_edges[1:]):
+            figures.append((sections["tfr_contrast_topoplots"],
+                            config.get_report_titles(contrast=name, fmin=fmin, fmax=fmax, tmin=tmin, tmax=tmax)["tfr_contrast_topoplots"]))
+
+    return figures
+
+
+def _report_figures(report):
+    return [(element.section, element.name) for element in report._content]
+
+
+def test_report_matches_serial_order(tmp_path, monkeypatch):
+    import matplotlib
+    matplotlib.use("Agg")
+    monkeypatch.chdir(tmp_path)
+    _write_outputs()
+
+    report = add_to_report.update_report("subject_1", n_jobs=2, incremental=False)
+
+    assert _report_figures(report) == _serial_figures("subject_1")
+    assert _report_figures(mne.open_report(config.h5_report_path)) == _serial_figures("subject_1")
+
+
+def test_incremental_report_update(tmp_path, monkeypatch):
+    import matplotlib
+    matplotlib.use("Agg")
+    monkeypatch.chdir(tmp_path)
+    _write_outputs()
+
+    rendered = []
+    render_figures = add_to_report.render_figures
+
+    def record_render_figures(figure_specs, n_jobs=1):
+        rendered.append([figure_spec["title"] for figure_spec in figure_specs])
+        return render_figures(figure_specs, n_jobs=n_jobs)
+
+    monkeypatch.setattr(add_to_report, "render_figures", record_render_figures)
+
+    first = add_to_report.update_report("subject_1", n_jobs=1, incremental=True)
+    first_html = {element.name: element.html for element in first._content}
+    assert len(rendered[-1]) == len(_serial_figures("subject_1"))
+
+    # a changed CSD re-renders its figure only, the figures of the other sections are kept in their place
+    _write_csd("food_2", seed=10)
+    updated = add_to_report.update_report("subject_1", n_jobs=1, incremental=True, sections=["csd", "coherence"])
+
+    assert rendered[-1] == [config.get_report_titles(condition="food_2")[key] for key in ("csd", "csd_mean", "coherence")]
+    assert _report_figures(updated) == _serial_figures("subject_1")
+    assert all((element.html == first_html[element.name]) != (element.name in rendered[-1]) for element in updated._content)
+
+    # nothing changed since, the figures of the kept sections are up to date as well
+    n_renders = len(rendered)
+    add_to_report.update_report("subject_1", n_jobs=1, incremental=True)
+    assert len(rendered) == n_renders
+
+
+def test_render_workers_of_the_resource_plan(monkeypatch):
+    from src import resources
+
+    # the rendering processes are the workers of the stage in the resource plan unless n_jobs is given
+    requested = []
+    monkeypatch.setattr(resources, "get_n_jobs", lambda n_jobs=None: requested.append(n_jobs) or (2 if n_jobs is None else n_jobs))
+
+    assert add_to_report.render_figures([]) == [] and add_to_report.render_figures([], n_jobs=1) == []
+    assert requested == [config.report_n_jobs, 1] and config.report_n_jobs is None
@@ -0,0 +1,58 @@
+# the cluster permutation tests (analyses/cluster_statistics.py) against mne.stats.permutation_cluster_1samp_test: the same
+# t-values and clusters, and the same null distribution for any number of worker processes
+
+import os, sys
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+mne = pytest.importorskip("mne")
+
+from scipy import sparse
+from analyses import cluster_statistics
+
+
+@pytest.fixture
+def contrast_data():
+    # subjects x channels x freqs x times with an effect on two neighbouring channels, a chain of 4 channels
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((10, 4, 3, 12))
+    data[:, 1:3, :, 4:8] += 1.5
+
+    channel_adjacency = sparse.csr_matrix(np.eye(4, k=1) + np.eye(4, k=-1))
+    adjacency = mne.stats.combine_adjacency(channel_adjacency, 3, 12).tocsr()
+
+    return data, channel_adjacency, adjacency
+
+
+def test_clusters_match_mne(contrast_data):
+    data, channel_adjacency, adjacency = contrast_data
+
+    results = cluster_statistics.cluster_permutation_test(data, adjacency, n_permutations=50, n_jobs=1)
+    t_obs, clusters, _, _ = mne.stats.permutation_cluster_1samp_test(data, threshold=results["threshold"], n_permutations=50,
+                                                                     adjacency=mne.stats.combine_adjacency(channel_adjacency, 3, 12),
+                                                                     out_type="indices", seed=0, verbose=False)
+
+    assert np.allclose(results["t_obs"], t_obs)
+
+    expected = sorted(tuple(np.sort(np.ravel_multi_index(cluster, t_obs.shape))) for cluster in clusters)
+    assert sorted(tuple(np.sort(indices)) for indices in results["clusters"]) == expected
+
+    # the cluster of the effect is significant
+    strongest = np.argmax(results["cluster_masses"])
+    assert results["cluster_p_values"][strongest] < 0.05
+
+
+def test_n_jobs_invariance(contrast_data):
+    data, _, adjacency = contrast_data
+
+    serial = cluster_statistics.cluster_permutation_test(data, adjacency, n_permutations=40, seed=3, n_jobs=1, batch_size=8)
+    parallel = cluster_statistics.cluster_permutation_test(data, adjacency, n_permutations=40, seed=3, n_jobs=2, batch_size=8)
+
+    assert np.array_equal(serial["null_distribution"], parallel["null_distribution"])
+    assert np.array_equal(serial["cluster_p_values"], parallel["cluster_p_values"])
@@ -0,0 +1,44 @@
+# combining the conditions of the epochs (mat_to_epochs_conversion/combine_epochs.py)
+
+import os, sys
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+mne = pytest.importorskip("mne")
+
+from src import config
+from mat_to_epochs_conversion.combine_epochs import combine_epochs, get_combined_conditions
+
+
+def _epochs():
+    codes = np.repeat(list(config.event_ids.values()), 2)
+    events = np.column_stack([np.arange(len(codes)) * 100, np.zeros(len(codes), int), codes])
+    data = np.random.default_rng(0).standard_normal((len(codes), 2, 10))
+
+    return mne.EpochsArray(data, mne.create_info(2, 100.0, "mag"), events, event_id=dict(config.event_ids), verbose=False)
+
+
+def _check(epochs_combined):
+    assert epochs_combined.event_id == config.new_event_ids
+
+    for new_condition, old_conditions in get_combined_conditions(config.event_ids, config.new_event_ids).items():
+        assert len(epochs_combined[new_condition]) == 2 * len(old_conditions)
+
+
+def test_combine_epochs(tmp_path, monkeypatch):
+    # the stages are cached by the pipeline only (see pipeline.py), combine_epochs doesn't record to the stage cache
+    monkeypatch.chdir(tmp_path)
+
+    _check(combine_epochs(_epochs(), config.event_ids, config.new_event_ids))
+    assert os.path.exists(config.epochs_combined_path) and not os.path.exists(config.stage_cache_path)
+
+    # the saved epochs, read without their data as in the pipeline
+    _epochs().save("input_epo.fif")
+    _check(combine_epochs(mne.read_epochs("input_epo.fif", preload=False), config.event_ids, config.new_event_ids))
+    _check(mne.read_epochs(config.epochs_combined_path, preload=False))
@@ -0,0 +1,60 @@
+# the csds of the conditions (compute_csd_condition) and the baseline combined from their baseline csds (compute_baseline_csd)
+# against csd_morlet per condition (compute_csd), for the full transform (equal to rounding) and the multi-rate transform (within 5e-7, see README)
+
+import os, sys
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+mne = pytest.importorskip("mne")
+
+from analyses import compute_csd
+
+freq_bands = [(8, 12), (12, 16)]
+post_stim_time = (0.0, 0.5)
+baseline_time = (-0.3, 0.0)
+
+
+def _epochs(n_channels=4, n_per_condition=3, sfreq=200.0):
+    rng = np.random.default_rng(0)
+    times = np.arange(-1.0, 1.5, 1 / sfreq)
+    n_epochs = 2 * n_per_condition
+
+    # an offset per channel and epoch, removed by the baseline correction of the windows (the DC correction of the single pass)
+    data = rng.standard_normal((n_epochs, n_channels, len(times))) + np.sin(2 * np.pi * 10 * times) + 5 * rng.standard_normal((n_epochs, n_channels, 1))
+    info = mne.create_info([f"A{channel + 1}" for channel in range(n_channels)], sfreq, "mag")
+    codes = np.tile([1, 2], n_per_condition)
+    events = np.column_stack([np.arange(n_epochs) * 1000, np.zeros(n_epochs, int), codes])
+
+    return mne.EpochsArray(data * 1e-13, info, events, tmin=times[0], event_id={"food_1": 1, "food_2": 2}, verbose=False)
+
+
+@pytest.mark.parametrize("multirate, tolerance", [(False, 1e-12), (True, 5e-7)])
+def test_compute_csd_conditions_and_baseline(multirate, tolerance):
+    epochs = _epochs()
+
+    csds, baseline_parts, counts = {}, {}, {}
+    for condition in epochs.event_id:
+        csds[condition], baseline_parts[condition] = compute_csd.compute_csd_condition(epochs, condition, freq_bands, post_stim_time, baseline_time,
+                                                                                        save=False, n_jobs=1, multirate=multirate)
+        counts[condition] = len(epochs[condition])
+
+    csds["baseline"] = compute_csd.compute_baseline_csd(baseline_parts, counts, freq_bands, save=False)
+
+    for condition in csds:
+        time_range = baseline_time if condition == "baseline" else post_stim_time
+        reference = compute_csd.compute_csd(epochs.copy(), freq_bands, time_range, condition=condition, save=False)
+
+        for csd, reference_csd in zip(csds[condition], reference):
+            assert csd.ch_names == reference_csd.ch_names and csd.n_fft == reference_csd.n_fft
+            assert np.isclose(csd.tmin, reference_csd.tmin) and np.isclose(csd.tmax, reference_csd.tmax)
+            assert np.allclose(np.concatenate([np.atleast_1d(f) for f in csd.frequencies]),
+                               np.concatenate([np.atleast_1d(f) for f in reference_csd.frequencies]))
+
+            error = np.abs(csd._data - reference_csd._data).max() / np.abs(reference_csd._data).max()
+            assert error < tolerance, f"{condition}: {error}"
@@ -0,0 +1,100 @@
+# the epoch cache of a subject (epoch_cache.py): the trials read back from a float64 and a float32 cache against the source epochs,
+# the combined events against combine_epochs, and a cache without its meta file
+
+import os, sys
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+mne = pytest.importorskip("mne")
+
+from src import config, epoch_cache
+from mat_to_epochs_conversion.combine_epochs import combine_epochs
+
+
+def _epochs(event_ids=config.event_ids, n_per_condition=2, sfreq=200.0):
+    # epochs of the conditions of event_ids (not combined), as converted from the mat file
+    rng = np.random.default_rng(0)
+    codes = np.repeat(list(event_ids.values()), n_per_condition)
+    rng.shuffle(codes)
+    events = np.column_stack([np.arange(len(codes)) * 1000, np.zeros(len(codes), int), codes])
+    data = rng.standard_normal((len(codes), 4, int(1.5 * sfreq))) * 1e-13
+
+    return mne.EpochsArray(data, mne.create_info(4, sfreq, "mag"), events, tmin=-0.5, event_id=dict(event_ids), verbose=False)
+
+
+@pytest.mark.parametrize("dtype, tolerance", [("float64", 0), ("float32", 2**-24)])
+def test_round_trip(tmp_path, dtype, tolerance):
+    epochs = _epochs()
+    cache_path = tmp_path / "epoch_cache"
+
+    # written block by block, over more than one block
+    epoch_cache.write_epoch_cache(epochs, cache_path=cache_path, dtype=dtype, block_size=5)
+    cache = epoch_cache.EpochCache(cache_path=cache_path)
+
+    expected = epochs.get_data()
+
+    assert len(cache) == len(epochs) and cache.ch_names == epochs.ch_names
+    assert np.array_equal(cache.events, epochs.events) and cache.event_id == epochs.event_id
+    assert cache.tmin == epochs.tmin and np.allclose(cache.times, epochs.times)
+
+    data = cache.get_data()
+    assert data.dtype == np.float64
+    assert np.abs(data - expected).max() <= tolerance * np.abs(expected).max()
+
+    # the mapped trials themselves, and a selection of trials and channels
+    assert cache.get_data(copy=False).dtype == np.dtype(dtype) and not cache.get_data(copy=False).flags.writeable
+    item, picks = np.array([1, 4, 7]), np.array([0, 2])
+    assert np.array_equal(cache.get_data(picks=picks, item=item), data[item][:, picks])
+    assert cache.get_data(item=item, dtype=np.float32).dtype == np.float32
+
+    cached_epochs = cache.to_epochs()
+    assert isinstance(cached_epochs, mne.EpochsArray)
+    assert np.array_equal(cached_epochs.events, epochs.events) and cached_epochs.event_id == epochs.event_id
+    assert np.allclose(cached_epochs.times, epochs.times)
+    assert np.array_equal(cached_epochs.get_data(), data)
+
+
+def test_combined_events_match_combine_epochs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    epochs = _epochs()
+
+    epoch_cache.write_epoch_cache(epochs)
+    cache = epoch_cache.EpochCache(combined=True)
+    epochs_combined = combine_epochs(epochs.copy(), config.event_ids, config.new_event_ids)
+
+    assert np.array_equal(cache.events, epochs_combined.events)
+    assert cache.event_id == epochs_combined.event_id
+    # the trials are the same, only relabeled
+    assert np.array_equal(cache.get_data(), epochs.get_data())
+
+
+def test_combined_events_of_missing_conditions():
+    # the conditions of food only: the other combined conditions aren't listed
+    food_event_ids = {condition: code for condition, code in config.event_ids.items() if condition.startswith("food/")}
+    epochs = _epochs(food_event_ids)
+
+    combined_events, combined_event_id = epoch_cache.combine_events(epochs.events, epochs.event_id)
+
+    assert combined_event_id == {"food_1": config.new_event_ids["food_1"], "food_2": config.new_event_ids["food_2"]}
+    assert set(combined_events[:, 2]) == set(combined_event_id.values())
+    assert np.array_equal(combined_events[:, :2], epochs.events[:, :2])
+
+
+def test_incomplete_cache(tmp_path):
+    cache_path = tmp_path / "epoch_cache"
+    epoch_cache.write_epoch_cache(_epochs(), cache_path=cache_path)
+
+    # the meta file is written last, a cache without it was interrupted
+    os.remove(cache_path / epoch_cache.meta_file)
+
+    with pytest.raises(FileNotFoundError):
+        epoch_cache.EpochCache(cache_path=cache_path)
+
+    with pytest.raises(FileNotFoundError):
+        epoch_cache.EpochCache(cache_path=tmp_path / "missing")
@@ -0,0 +1,70 @@
+# the streaming group averages (analyses/group_average.py) against averages over all subjects held in memory
+
+import os, sys, json
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+mne = pytest.importorskip("mne")
+
+from analyses import group_average
+
+
+@pytest.mark.parametrize("complex_data", [False, True])
+def test_running_moments(complex_data):
+    rng = np.random.default_rng(0)
+    arrays = rng.standard_normal((7, 3, 4)) + (1j * rng.standard_normal((7, 3, 4)) if complex_data else 0) + 100
+
+    running = group_average.RunningMoments()
+    for array in arrays:
+        running.add(array)
+
+    assert np.allclose(running.mean, arrays.mean(axis=0))
+
+    if complex_data:
+        expected = arrays.real.std(axis=0, ddof=1) / np.sqrt(7) + 1j * arrays.imag.std(axis=0, ddof=1) / np.sqrt(7)
+    else:
+        expected = arrays.std(axis=0, ddof=1) / np.sqrt(7)
+
+    assert np.allclose(running.standard_error(), expected)
+
+
+def test_compute_group_averages(tmp_path):
+    from mne.time_frequency import CrossSpectralDensity, read_csd
+
+    rng = np.random.default_rng(1)
+    ch_names = ["A1", "A2", "A3"]
+    n_pairs = len(ch_names) * (len(ch_names) + 1) // 2
+    folders, subject_data = [], []
+
+    for subject in range(3):
+        folder = tmp_path / f"sub_{subject}"
+        folder.mkdir()
+        data = rng.standard_normal((n_pairs, 2)) + 1j * rng.standard_normal((n_pairs, 2))
+        CrossSpectralDensity(data, ch_names, frequencies=[10.0, 12.0], n_fft=1).save(folder / "csd_test.h5")
+        folders.append(str(folder))
+        subject_data.append(data)
+
+    # a subject without the output is left out
+    (tmp_path / "sub_3").mkdir()
+    folders.append(str(tmp_path / "sub_3"))
+
+    group_items = [{"name": "csd_test.h5", "file": "csd_test.h5", "kind": "csd"},
+                   {"name": "coherence_test.h5", "file": "csd_test.h5", "kind": "coherence"}]
+
+    group_summary = group_average.compute_group_averages(folders, tmp_path / "group", group_items=group_items)
+
+    assert group_summary["csd_test.h5"]["subjects"] == ["sub_0", "sub_1", "sub_2"]
+    assert json.loads((tmp_path / "group" / "group_summary.json").read_text()) == group_summary
+
+    mean = read_csd(str(tmp_path / "group" / "group_mean_csd_test.h5"))
+    assert mean.ch_names == ch_names and np.allclose(mean._data, np.mean(subject_data, axis=0))
+
+    coherences = [group_average._coherence(data, len(ch_names)) for data in subject_data]
+    coherence_se = read_csd(str(tmp_path / "group" / "group_se_coherence_test.h5"))
+    assert np.allclose(coherence_se._data, np.std(coherences, axis=0, ddof=1) / np.sqrt(3))
@@ -0,0 +1,47 @@
+# import-time budget of the orchestration modules: the CLI, the scheduler and the stage definitions must start without loading
+# the heavy dependencies (mne, matplotlib, scipy, h5py, pymatreader), they are loaded by the stages that use them (see pipeline.py)
+
+import os, sys, json, subprocess
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+import_time_budget = 1.0 # seconds, in a fresh interpreter
+
+heavy_modules = ["mne", "matplotlib", "scipy", "h5py", "pymatreader"]
+
+# measured in a fresh process, the modules loaded by the test session don't count
+measure_script = """
+import sys, time, json
+sys.path[:0] = [{package_path!r}, {src_path!r}]
+start = time.perf_counter()
+{statement}
+print(json.dumps({{"time": time.perf_counter() - start, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure_import(statement: str) -> dict:
+    script = measure_script.format(package_path=package_path, src_path=os.path.join(package_path, "src"), statement=statement)
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True, cwd=package_path).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+@pytest.mark.parametrize("statement", ["from src import config, scheduler, pipeline, profiling, stage_cache",
+                                       "from src import prefetch, resources, epoch_cache, shared_arrays",
+                                       "import mat_to_epochs_conversion, analyses",
+                                       "from src import pipeline; pipeline.create_stages('sub_0')"])
+def test_orchestration_import_time(statement):
+    measurement = measure_import(statement)
+
+    loaded = [module for module in heavy_modules if module in measurement["modules"]]
+    assert not loaded, f"{statement!r} loads {', '.join(loaded)}"
+
+    assert measurement["time"] < import_time_budget, f"{statement!r} took {measurement['time']:.2f}s"
+
+
+def test_lazy_attributes():
+    # the packages still export their modules and functions, loaded on first access
+    measurement = measure_import("from mat_to_epochs_conversion import get_combined_conditions; import src; src.stage_cache; src.prefetch")
+
+    assert "mat_to_epochs_conversion.combine_epochs" in measurement["modules"]
+    assert "src.stage_cache" in measurement["modules"] and "src.prefetch" in measurement["modules"]
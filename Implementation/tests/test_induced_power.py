@@ -0,0 +1,73 @@
+# the chunked induced power and ITC accumulators (analyses/induced_power.py) against mne.time_frequency.tfr_array_multitaper
+# of all trials at once
+
+import os, sys
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+mne = pytest.importorskip("mne")
+
+from analyses import induced_power
+
+sfreq = 1017.25 # sampling frequency of the recordings
+freqs = np.arange(8, 24, 2)
+tolerances = {"float64": 1e-12, "float32": 1e-5}
+event_id = {"food/short/rep1": 10, "food/medium/rep1": 12, "positive/short/rep1": 110}
+
+
+@pytest.fixture
+def epochs():
+    rng = np.random.default_rng(0)
+    times = np.arange(1119) / sfreq
+
+    # a phase locked 12 Hz response in noise
+    data = rng.standard_normal((23, 4, len(times))) + np.sin(2 * np.pi * 12 * times)
+    events = np.column_stack([np.arange(23), np.zeros(23, dtype=int), rng.choice(list(event_id.values()), 23)])
+
+    return mne.EpochsArray(data, mne.create_info(4, sfreq, "mag"), events, tmin=-0.3, event_id=event_id, verbose=False)
+
+
+@pytest.mark.parametrize("compute_dtype", ["float64", "float32"])
+@pytest.mark.parametrize("subtract_evoked", [False, True])
+def test_induced_from_sums(epochs, compute_dtype, subtract_evoked):
+    induced_sums = induced_power.compute_induced_sums(epochs, freqs, chunk_size=5, decim=3, subtract_evoked=subtract_evoked,
+                                                      compute_dtype=compute_dtype)
+
+    power, itc, n_trials = induced_power.induced_from_sums(induced_sums, ["food/short/rep1", "positive/short/rep1"])
+
+    selection = np.isin(epochs.events[:, 2], [10, 110])
+    data = epochs.get_data()[selection]
+    trials = data.copy()
+
+    if subtract_evoked:
+        for code in (10, 110):
+            condition = epochs.events[selection, 2] == code
+            trials[condition] -= trials[condition].mean(axis=0)
+
+    expected_power = mne.time_frequency.tfr_array_multitaper(trials, sfreq, freqs, output="avg_power", decim=3, verbose=False)
+    expected_itc = mne.time_frequency.tfr_array_multitaper(data, sfreq, freqs, output="itc", decim=3, verbose=False)
+
+    assert n_trials == selection.sum()
+    assert np.abs(power - expected_power).max() / expected_power.max() < tolerances[compute_dtype]
+    assert np.abs(itc - expected_itc).max() < tolerances[compute_dtype]
+
+
+def test_induced_contrast(epochs, tmp_path):
+    induced_sums = induced_power.compute_induced_sums(epochs, freqs, chunk_size=4, decim=3)
+    induced_power.save_induced_sums(induced_sums, tmp_path / "induced_sums.npz")
+    saved_sums = induced_power.read_induced_sums(tmp_path / "induced_sums.npz")
+
+    con1, con2 = ("food", ["food/short/rep1", "food/medium/rep1"]), ("positive", ["positive/short/rep1"])
+    induced_contrast, itc_contrast = induced_power.compute_induced_contrast(saved_sums, epochs.info, con1, con2, save=False)
+
+    power_1, itc_1, _ = induced_power.induced_from_sums(induced_sums, con1[1])
+    power_2, itc_2, _ = induced_power.induced_from_sums(induced_sums, con2[1])
+
+    assert np.allclose(induced_contrast.data, power_1 - power_2)
+    assert np.allclose(itc_contrast.data, itc_1 - itc_2)
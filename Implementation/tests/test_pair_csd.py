@@ -0,0 +1,77 @@
+# the pair-subset csds (analyses/pair_csd.py) against the entries of the full csd of the same epochs
+
+import os, sys
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+mne = pytest.importorskip("mne")
+
+from analyses import compute_csd, group_average, pair_csd
+
+
+def _epochs(n_channels=6, n_epochs=4, sfreq=250.0):
+    rng = np.random.default_rng(0)
+    times = np.arange(-0.5, 1.0, 1 / sfreq)
+    data = rng.standard_normal((n_epochs, n_channels, len(times))) + np.sin(2 * np.pi * 10 * times)
+    info = mne.create_info([f"A{channel + 1}" for channel in range(n_channels)], sfreq, "mag")
+    events = np.column_stack([np.arange(n_epochs) * 1000, np.zeros(n_epochs, int), np.ones(n_epochs, int)])
+
+    return mne.EpochsArray(data * 1e-13, info, events, tmin=times[0], event_id={"test": 1}, verbose=False)
+
+
+def test_get_channel_pairs():
+    ch_names = ["A1", "A2", "A3", "A4"]
+
+    assert pair_csd.get_channel_pairs(ch_names) is None
+
+    pairs = pair_csd.get_channel_pairs(ch_names, channel_groups={"roi": ["A1", "A3"]}, channel_pairs=[("A4", "A2")])
+    assert pairs.tolist() == [[0, 0], [0, 2], [1, 1], [1, 3], [2, 2], [3, 3]]
+
+    with pytest.raises(ValueError):
+        pair_csd.get_channel_pairs(ch_names, channel_pairs=[("A1", "B1")])
+
+
+def test_pair_csd_matches_full_csd(tmp_path):
+    import matplotlib
+    matplotlib.use("Agg")
+
+    epochs = _epochs()
+    freq_bands = [(8, 12), (18, 22)]
+    arguments = dict(freq_bands=freq_bands, post_stim_time=(0.0, 0.5), baseline_time=(-0.3, 0.0), save=False, n_jobs=1)
+
+    (full, full_mean), _ = compute_csd.compute_csd_condition(epochs, "test", **arguments)
+    (pairs, pairs_mean), _ = compute_csd.compute_csd_condition(epochs, "test", channel_pairs=[("A5", "A2"), ("A2", "A3")], **arguments)
+
+    assert isinstance(pairs, pair_csd.PairCSD) and pairs.ch_names == ["A2", "A3", "A5"]
+
+    for csd, full_csd in [(pairs, full), (pairs_mean, full_mean)]:
+        indices = [full_csd.ch_names.index(channel) for channel in csd.ch_names]
+        matrices = np.array([full_csd.get_data(index=index) for index in range(len(full_csd.frequencies))])
+        expected = matrices[:, indices][:, :, indices][:, csd.pairs[:, 0], csd.pairs[:, 1]].T
+        assert np.allclose(csd._data, expected, rtol=1e-10, atol=0)
+
+        # the coherence of the pairs is the coherence of the full csd at the pairs
+        triu = np.triu_indices(full_csd.n_channels)
+        coherence = group_average._coherence(full_csd._data, full_csd.n_channels)
+        rows = [np.flatnonzero((triu[0] == min(i, j)) & (triu[1] == max(i, j)))[0] for i, j in np.array(indices)[csd.pairs]]
+        assert np.allclose(csd.coherence(), coherence[rows])
+
+    pairs_mean.save(tmp_path / "pairs.h5")
+    read = pair_csd.read_csd(tmp_path / "pairs.h5")
+    assert isinstance(read, pair_csd.PairCSD) and np.array_equal(read._data, pairs_mean._data) and read.ch_names == pairs_mean.ch_names
+
+    full_mean.save(tmp_path / "full.h5")
+    assert isinstance(pair_csd.read_csd(tmp_path / "full.h5"), mne.time_frequency.CrossSpectralDensity)
+
+    figures = read.plot(mode="coh", show=False)
+    assert len(figures) == 1
+
+    # A3-A5 wasn't requested, it is left blank
+    matrix = read.get_matrix(0, "coh")
+    assert np.isnan(matrix[1, 2]) and np.isnan(matrix[2, 1]) and np.allclose(np.diag(matrix), 1)
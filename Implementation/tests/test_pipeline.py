@@ -0,0 +1,170 @@
+# the stages of the pipeline of a subject (pipeline.py): selection of the target stages, blocking after a failure, resuming and
+# the dry run on stub stages, and the report sections, which share the report files, stay up to date on an unchanged rerun
+
+import os, sys, shutil
+from functools import partial
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+mne = pytest.importorskip("mne")
+
+from src import config, pipeline, epoch_cache
+from mat_to_epochs_conversion.combine_epochs import get_combined_conditions
+from tests.test_add_to_report import _write_outputs
+
+
+def _statuses(stage_summary):
+    return {name: stage_summary[name]["status"] for name in stage_summary}
+
+
+def _stub_stages(calls, fail=()):
+    # a -> b -> c and an independent d, every stage writes its output from its inputs, the stages named in fail raise
+    def write(context, name, inputs, outputs):
+        calls.append(name)
+        if name in fail:
+            raise RuntimeError(f"{name} failed")
+        text = "".join(open(file_name).read() for file_name in inputs) + name
+        for file_name in outputs:
+            with open(file_name, "w") as f:
+                f.write(text)
+
+    layout = {"convert/a": (["source.txt"], ["a.txt"]), "analysis/b": (["a.txt"], ["b.txt"]),
+              "analysis/c": (["b.txt"], ["c.txt"]), "other/d": (["source.txt"], ["d.txt"])}
+
+    return [pipeline.Stage(name, partial(write, name=name, inputs=inputs, outputs=outputs), inputs=inputs, outputs=outputs, params={"name": name})
+            for name, (inputs, outputs) in layout.items()]
+
+
+def _run(stages, **kwargs):
+    from src import profiling
+    return _statuses(pipeline.run_stages(stages, "subject_1", ".", profiler=profiling.Profiler("subject_1", trace_memory=False, cprofile_stages=[]),
+                                         **kwargs))
+
+
+def test_select_stages():
+    stages = _stub_stages([])
+
+    assert [stage.name for stage in pipeline.select_stages(stages)] == [stage.name for stage in stages]
+    # a target pulls in the stages it depends on, in the order of the stages
+    assert [stage.name for stage in pipeline.select_stages(stages, ["analysis/c"])] == ["convert/a", "analysis/b", "analysis/c"]
+    # a kind of stages selects all stages of the kind
+    assert [stage.name for stage in pipeline.select_stages(stages, ["analysis", "other/d"])] == ["convert/a", "analysis/b", "analysis/c", "other/d"]
+    assert [stage.name for stage in pipeline.select_stages(stages, ["other"])] == ["other/d"]
+
+    with pytest.raises(ValueError):
+        pipeline.select_stages(stages, ["analysis/e"])
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_failed_stage_blocks_its_dependents(tmp_path, monkeypatch, n_workers):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "source.txt").write_text("source")
+    calls = []
+
+    statuses = _run(_stub_stages(calls, fail=("analysis/b",)), n_workers=n_workers)
+
+    assert statuses == {"convert/a": "done", "analysis/b": "failed", "analysis/c": "blocked", "other/d": "done"}
+    assert sorted(calls) == ["analysis/b", "convert/a", "other/d"]
+
+    summary = pipeline.run_stages(_stub_stages([], fail=("analysis/b",)), "subject_1", ".", n_workers=n_workers, resume=False)
+    assert summary["analysis/b"]["error"] == "RuntimeError: analysis/b failed"
+    assert summary["analysis/c"]["error"] == "depends on analysis/b"
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_resume(tmp_path, monkeypatch, n_workers):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "source.txt").write_text("source")
+    names = ["convert/a", "analysis/b", "analysis/c", "other/d"]
+
+    # a failed run resumes after its completed stages
+    calls = []
+    _run(_stub_stages(calls, fail=("analysis/b",)), n_workers=n_workers)
+    calls.clear()
+    assert _run(_stub_stages(calls), n_workers=n_workers) == {"convert/a": "up to date", "analysis/b": "done", "analysis/c": "done", "other/d": "up to date"}
+    assert sorted(calls) == ["analysis/b", "analysis/c"]
+
+    calls.clear()
+    assert _run(_stub_stages(calls), n_workers=n_workers) == {name: "up to date" for name in names}
+    assert calls == []
+
+    # a changed input reruns the stages reading it, and the stages after them only if their inputs changed
+    (tmp_path / "a.txt").write_text("changed")
+    assert _run(_stub_stages(calls), n_workers=n_workers) == {"convert/a": "done", "analysis/b": "up to date", "analysis/c": "up to date",
+                                                              "other/d": "up to date"}
+    (tmp_path / "source.txt").write_text("changed source")
+    calls.clear()
+    assert _run(_stub_stages(calls), n_workers=n_workers) == {name: "done" for name in names}
+
+    # without resume every stage runs
+    calls.clear()
+    assert _run(_stub_stages(calls), n_workers=n_workers, resume=False) == {name: "done" for name in names}
+    assert sorted(calls) == sorted(names)
+
+
+def test_dry_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "source.txt").write_text("source")
+    calls = []
+
+    assert _run(_stub_stages(calls), dry_run=True) == {name: "would run" for name in ["convert/a", "analysis/b", "analysis/c", "other/d"]}
+    assert calls == [] and not os.path.exists("a.txt")
+
+    _run(_stub_stages(calls))
+    calls.clear()
+
+    # a stage after a stage that would run would run as well, whether its inputs are unchanged yet or not
+    (tmp_path / "b.txt").write_text("changed")
+    assert _run(_stub_stages(calls), dry_run=True) == {"convert/a": "up to date", "analysis/b": "would run", "analysis/c": "would run",
+                                                       "other/d": "up to date"}
+    assert _run(_stub_stages(calls), targets=["other"], dry_run=True) == {"other/d": "up to date"}
+    assert calls == []
+
+
+def test_unchanged_report_sections_are_up_to_date(tmp_path, monkeypatch):
+    import matplotlib
+    matplotlib.use("Agg")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config, "time_frames", config.time_frames[:1]) # fewer topo-plots
+
+    # the outputs of the analyses the report sections read, and the epoch cache the csd sections list the conditions from
+    # (the trials of the combined epochs, labeled with the first condition of event_ids combined under their condition)
+    _write_outputs(conditions=tuple(config.new_event_ids))
+    for con1, con2 in config.tfr_contrasts:
+        if not os.path.exists(config.get_tfr_contrast_path(con1, con2)):
+            shutil.copy(config.get_tfr_contrast_path(*config.tfr_contrasts[1]), config.get_tfr_contrast_path(con1, con2))
+    epochs_combined = mne.read_epochs(config.epochs_combined_path)
+
+    leaf_conditions = {config.new_event_ids[condition]: old_conditions[0]
+                       for condition, old_conditions in get_combined_conditions(config.event_ids, config.new_event_ids).items()}
+    events = epochs_combined.events.copy()
+    events[:, 2] = [config.event_ids[leaf_conditions[code]] for code in events[:, 2]]
+
+    epoch_cache.write_epoch_cache(mne.EpochsArray(epochs_combined.get_data(), epochs_combined.info, events, tmin=epochs_combined.tmin,
+                                                  event_id={leaf: config.event_ids[leaf] for leaf in leaf_conditions.values()}, verbose=False))
+
+    stages = [stage for stage in pipeline.create_stages("subject_1") if stage.name.startswith("add_to_report/")]
+    names = [stage.name for stage in stages]
+
+    first = pipeline.run_stages(stages, "subject_1", str(tmp_path))
+    assert _statuses(first) == {name: "done" for name in names}
+
+    # every section saves the report files, the sections saved before stay complete
+    second = pipeline.run_stages(stages, "subject_1", str(tmp_path))
+    assert _statuses(second) == {name: "up to date" for name in names}
+
+    dry_run = pipeline.run_stages(stages, "subject_1", str(tmp_path), dry_run=True)
+    assert _statuses(dry_run) == {name: "up to date" for name in names}
+
+    # a changed input reruns its section only
+    mne.read_evokeds(config.evoked_path)[0].compute_psd(fmin=2, fmax=40).save(config.psd_path, overwrite=True)
+    third = pipeline.run_stages(stages, "subject_1", str(tmp_path))
+    assert _statuses(third) == {name: "done" if name == "add_to_report/psd" else "up to date" for name in names}
+
+    assert _statuses(pipeline.run_stages(stages, "subject_1", str(tmp_path))) == {name: "up to date" for name in names}
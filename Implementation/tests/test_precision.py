@@ -0,0 +1,85 @@
+# the transforms of the compute modes (analyses/precision.py) against the mne transforms: float64 reproduces mne to rounding,
+# float32 (complex64) stays within single precision tolerance (see benchmarks/precision_report.py for the CSDs and TFRs of a subject),
+# and the wavelet spectra are cached in memory and in the cache folder
+
+import os, sys
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+mne = pytest.importorskip("mne")
+
+from analyses import precision
+
+sfreq = 1017.25 # sampling frequency of the recordings
+tolerances = {"float64": 1e-12, "float32": 1e-5}
+
+
+def relative_error(test, reference):
+    return np.abs(test - reference).max() / np.abs(reference).max()
+
+
+@pytest.mark.parametrize("compute_dtype", ["float64", "float32"])
+@pytest.mark.parametrize("n_times", [1119, 1118])
+def test_cwt(compute_dtype, n_times):
+    from mne.time_frequency import morlet
+    from mne.time_frequency.tfr import cwt
+
+    signals = np.random.default_rng(0).standard_normal((4, n_times))
+    # the frequencies of the CSDs, the wavelets are convolved in groups of different FFT lengths
+    wavelets = morlet(sfreq, np.arange(3, 32, 2), n_cycles=7)
+
+    coefs = precision.cwt(signals, precision.fft_wavelets(wavelets, n_times, compute_dtype))
+
+    assert coefs.dtype == precision.get_dtypes(compute_dtype)[1]
+    assert relative_error(coefs, cwt(signals, wavelets, use_fft=True, decim=1)) < tolerances[compute_dtype]
+
+
+@pytest.mark.parametrize("compute_dtype", ["float64", "float32"])
+def test_cwt_at_samples(compute_dtype):
+    # the multi-rate transform of the CSDs at decimated samples against the full transform, within the documented tolerance
+    n_times, freqs = 1119, np.arange(3, 32, 2)
+    signals = np.random.default_rng(1).standard_normal((4, n_times))
+    samples = np.arange(100, 1000, 20)
+
+    spectra = precision.band_spectra(sfreq, n_times, freqs, compute_dtype=compute_dtype, cache_directory=None)
+    coefs = precision.cwt_at_samples(signals, spectra, precision.band_sample_matrices(spectra, samples))
+    reference = precision.cwt(signals, precision.morlet_spectra(sfreq, n_times, freqs, cache_directory=None))[:, :, samples]
+
+    assert coefs.shape == reference.shape and coefs.dtype == precision.get_dtypes(compute_dtype)[1]
+    assert relative_error(coefs, reference) < max(1e-4, tolerances[compute_dtype])
+    assert sum(len(band["bins"]) for band in spectra["bands"]) < len(freqs) * (spectra["nfft"] // 2 + 1) / 4
+
+
+def test_tfr_array_multitaper_float32():
+    data = np.random.default_rng(1).standard_normal((2, 3, 1119))
+    freqs = np.arange(8, 24, 2)
+
+    coefs = precision.tfr_array_multitaper(data, sfreq, freqs, compute_dtype="float32", block_size=4)
+    reference = mne.time_frequency.tfr_array_multitaper(data, sfreq, freqs, output='complex')
+
+    assert coefs.dtype == np.complex64 and coefs.shape == reference.shape
+    assert relative_error(coefs, reference) < tolerances["float32"]
+
+
+def test_wavelet_spectra_cache(tmp_path):
+    freqs = np.arange(3, 32, 2)
+    wavelet_spectra = precision.morlet_spectra(sfreq, 1119, freqs, cache_directory=tmp_path / "wavelet_cache")
+
+    # a new process reads the spectra from the cache folder
+    precision._spectra_cache.clear()
+    saved_spectra = precision.morlet_spectra(sfreq, 1119, freqs, cache_directory=tmp_path / "wavelet_cache")
+
+    assert len(os.listdir(tmp_path / "wavelet_cache")) == 1
+    assert saved_spectra is not wavelet_spectra and np.array_equal(saved_spectra["lengths"], wavelet_spectra["lengths"])
+
+    for group, saved_group in zip(wavelet_spectra["groups"], saved_spectra["groups"], strict=True):
+        assert np.array_equal(group["indices"], saved_group["indices"]) and np.array_equal(group["spectra"], saved_group["spectra"])
+
+    # the same process reuses the spectra in memory
+    assert precision.morlet_spectra(sfreq, 1119, freqs, cache_directory=tmp_path / "wavelet_cache") is saved_spectra
@@ -0,0 +1,179 @@
+# the read ahead of the next subjects (prefetch.py) with stub load and estimate functions: the number of subjects held ahead,
+# the memory budget, skipped folders, a failed read, taking a subject without waiting for its read and close
+
+import os, sys, time, threading
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from src import config, prefetch
+
+
+class _StubLoader:
+    # records the folders read, the folders in blocked wait for release before their read finishes, the folders in fail raise
+    def __init__(self, sizes=None, blocked=(), fail=()):
+        self.sizes = {} if sizes is None else sizes
+        self.fail = fail
+        self.loaded = []
+        self.events = {folder: threading.Event() for folder in blocked}
+
+    def load(self, folder):
+        self.loaded.append(folder)
+        if folder in self.events:
+            self.events[folder].wait(5)
+        if folder in self.fail:
+            raise OSError(f"can't read {folder}")
+        return f"inputs of {folder}"
+
+    def estimate(self, folder):
+        return self.sizes.get(folder, 1)
+
+    def release(self, folder):
+        self.events[folder].set()
+
+
+def _wait_until(predicate, timeout=5):
+    end = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > end:
+            raise TimeoutError
+        time.sleep(0.005)
+
+
+def _settle():
+    # time for the read ahead thread to read a subject it shouldn't read
+    time.sleep(0.1)
+
+
+def test_depth():
+    folders = ["s1", "s2", "s3", "s4"]
+    loader = _StubLoader()
+
+    with prefetch.SubjectPrefetcher(folders, load=loader.load, estimate=loader.estimate, depth=2, memory_budget=100) as prefetcher:
+        _wait_until(lambda: len(loader.loaded) == 2)
+        _settle()
+        assert loader.loaded == ["s1", "s2"]
+
+        # taking a subject frees its place, the subject in compute isn't held
+        assert prefetcher.get("s1") == "inputs of s1"
+        _wait_until(lambda: len(loader.loaded) == 3)
+        _settle()
+        assert loader.loaded == ["s1", "s2", "s3"]
+
+        assert prefetcher.get("s2") == "inputs of s2"
+        _wait_until(lambda: len(loader.loaded) == 4)
+        assert prefetcher.get("s3") == "inputs of s3" and prefetcher.get("s4") == "inputs of s4"
+        assert prefetcher._buffered_bytes == 0
+
+
+def test_no_read_ahead():
+    loader = _StubLoader()
+
+    with prefetch.SubjectPrefetcher(["s1", "s2"], load=loader.load, estimate=loader.estimate, depth=0) as prefetcher:
+        assert prefetcher.get("s1") is None and prefetcher.get("s2") is None
+
+    assert loader.loaded == []
+
+
+def test_memory_budget():
+    folders = ["s1", "s2", "s3", "s4"]
+    loader = _StubLoader(sizes={"s1": 6, "s2": 6, "s3": 20, "s4": 4})
+
+    with prefetch.SubjectPrefetcher(folders, load=loader.load, estimate=loader.estimate, depth=3, memory_budget=10) as prefetcher:
+        # s2 doesn't fit next to s1
+        _wait_until(lambda: len(loader.loaded) == 1)
+        _settle()
+        assert loader.loaded == ["s1"] and prefetcher._buffered_bytes == 6
+
+        assert prefetcher.get("s1") == "inputs of s1"
+        # s3 is over the budget and isn't read ahead, s4 fits next to s2
+        _wait_until(lambda: len(loader.loaded) == 3)
+        assert loader.loaded == ["s1", "s2", "s4"] and prefetcher._buffered_bytes == 10
+
+        assert prefetcher.get("s2") == "inputs of s2"
+        assert prefetcher.get("s3") is None
+        assert prefetcher.get("s4") == "inputs of s4"
+        assert prefetcher._buffered_bytes == 0
+
+
+def test_skipped_folders():
+    folders = ["s1", "s2", "s3", "s4"]
+    loader = _StubLoader(blocked=["s1"])
+
+    with prefetch.SubjectPrefetcher(folders, load=loader.load, estimate=loader.estimate, depth=1, memory_budget=100) as prefetcher:
+        _wait_until(lambda: loader.loaded == ["s1"])
+
+        # the folders before the folder taken aren't read ahead anymore, s1 read ahead is dropped
+        assert prefetcher.get("s3", wait=False) is None
+        loader.release("s1")
+        _wait_until(lambda: len(loader.loaded) == 2)
+        _settle()
+        assert loader.loaded == ["s1", "s4"]
+        assert prefetcher.get("s4") == "inputs of s4"
+        assert prefetcher._buffer == {} and prefetcher._buffered_bytes == 0
+
+
+def test_failed_load():
+    folders = ["s1", "s2", "s3"]
+    loader = _StubLoader(fail=["s2"])
+
+    with prefetch.SubjectPrefetcher(folders, load=loader.load, estimate=loader.estimate, depth=2, memory_budget=100) as prefetcher:
+        _wait_until(lambda: len(loader.loaded) == 2)
+        assert prefetcher.get("s1") == "inputs of s1"
+        _wait_until(lambda: len(loader.loaded) == 3)
+        assert prefetcher.get("s2") is None and prefetcher.get("s3") == "inputs of s3"
+        assert prefetcher._buffered_bytes == 0
+
+
+def test_get_without_waiting():
+    folders = ["s1", "s2"]
+    loader = _StubLoader(blocked=["s1"])
+
+    with prefetch.SubjectPrefetcher(folders, load=loader.load, estimate=loader.estimate, depth=1, memory_budget=100) as prefetcher:
+        _wait_until(lambda: loader.loaded == ["s1"])
+
+        assert prefetcher.get("s1", wait=False) is None
+
+        # the read of s1 is dropped when it finishes, and the next subject is read ahead
+        loader.release("s1")
+        _wait_until(lambda: loader.loaded == ["s1", "s2"])
+        assert prefetcher.get("s2") == "inputs of s2"
+        assert prefetcher._buffer == {} and prefetcher._buffered_bytes == 0
+
+
+def test_close():
+    folders = ["s1", "s2", "s3"]
+    loader = _StubLoader(blocked=["s2"])
+
+    prefetcher = prefetch.SubjectPrefetcher(folders, load=loader.load, estimate=loader.estimate, depth=2, memory_budget=100)
+    _wait_until(lambda: loader.loaded == ["s1", "s2"])
+
+    # the buffered subjects are dropped, the subject being read is dropped when its read finishes and the thread stops
+    prefetcher.close()
+    assert prefetcher._buffer == {}
+
+    loader.release("s2")
+    prefetcher._thread.join(5)
+    assert not prefetcher._thread.is_alive()
+    assert loader.loaded == ["s1", "s2"] and prefetcher._buffer == {} and prefetcher._buffered_bytes == 0
+
+
+def test_warm_subject_inputs(tmp_path, monkeypatch):
+    pytest.importorskip("mne")
+    from mat_to_epochs_conversion import create_info
+
+    # the header of the raw recording is read (the raw info is dropped) as long as the raw info wasn't saved
+    read_headers = []
+    monkeypatch.setattr(create_info, "extract_raw_info", read_headers.append)
+    (tmp_path / "datafinalLow.mat").write_bytes(b"\0" * 1000)
+
+    prefetch.warm_subject_inputs(str(tmp_path), chunk_size=64)
+    assert read_headers == [str(tmp_path)]
+
+    (tmp_path / config.raw_info_path).write_bytes(b"")
+    prefetch.warm_subject_inputs(str(tmp_path), chunk_size=64)
+    assert read_headers == [str(tmp_path)]
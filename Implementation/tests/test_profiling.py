@@ -0,0 +1,97 @@
+# the per-stage profiling of the pipeline (profiling.py): the measurements of a stage and of a failed stage, the profile file,
+# and the cProfile of a hot stage with its active stage seen by its own thread only
+
+import os, sys, json, time, threading
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from src import profiling
+
+
+def test_stage_measurements(tmp_path):
+    profiler = profiling.Profiler("sub_0", trace_memory=True, cprofile_stages=[])
+
+    with profiler.stage("compute_psd"):
+        time.sleep(0.05)
+        data = bytearray(8 * 2**20)
+        (tmp_path / "out.bin").write_bytes(data)
+
+    measurements, = profiler.stages
+    assert measurements["stage"] == "compute_psd" and not measurements["failed"]
+    assert measurements["wall_time"] >= 0.05 and measurements["cpu_time"] >= 0
+    assert measurements["tracemalloc_peak"] >= len(data)
+    assert measurements["cprofile"] is None
+
+    if measurements["peak_rss"]: # linux only, 0 otherwise
+        assert measurements["peak_rss"] >= len(data) and measurements["bytes_written"] >= len(data)
+
+    profiler.save(tmp_path / "profile.json") # stops tracemalloc
+
+
+def test_failed_stage():
+    profiler = profiling.Profiler("sub_0", trace_memory=False, cprofile_stages=[])
+
+    with pytest.raises(RuntimeError):
+        with profiler.stage("compute_csd/food_1"):
+            raise RuntimeError("failed")
+
+    # the failed stage is still recorded
+    measurements, = profiler.stages
+    assert measurements["stage"] == "compute_csd/food_1" and measurements["failed"]
+    assert measurements["tracemalloc_peak"] is None
+
+
+def test_save(tmp_path):
+    profiler = profiling.Profiler("sub_0", trace_memory=False, cprofile_stages=[])
+    profiler.resources = {"n_jobs": 2}
+
+    for name in ["load_epochs", "compute_psd"]:
+        with profiler.stage(name):
+            time.sleep(0.01)
+
+    profiler.save(tmp_path / "profile.json")
+
+    with open(tmp_path / "profile.json") as f:
+        profile = json.load(f)
+
+    assert profile["subject"] == "sub_0" and profile["resources"] == {"n_jobs": 2}
+    assert [stage["stage"] for stage in profile["stages"]] == ["load_epochs", "compute_psd"]
+    assert profile["total"]["wall_time"] == pytest.approx(sum(stage["wall_time"] for stage in profile["stages"]))
+    assert profile["total"]["peak_rss"] == max(stage["peak_rss"] for stage in profile["stages"])
+
+
+def test_cprofile_stage(tmp_path, monkeypatch):
+    import pstats
+
+    monkeypatch.chdir(tmp_path)
+    profiler = profiling.Profiler("sub_0", trace_memory=False, cprofile_stages=["compute_csd"])
+    seen_by_other_thread = []
+
+    def other_stage_thread():
+        seen_by_other_thread.append(profiling.get_active_cprofile_stage())
+
+    assert profiling.get_active_cprofile_stage() is None
+
+    # a stage of the kind of a hot stage is profiled
+    with profiler.stage("compute_csd/food_1"):
+        assert profiling.get_active_cprofile_stage() == "compute_csd/food_1"
+
+        thread = threading.Thread(target=other_stage_thread)
+        thread.start()
+        thread.join()
+
+        sum(i * i for i in range(10000))
+
+    # the active stage is per thread, another stage thread doesn't pass it to its process pools
+    assert seen_by_other_thread == [None]
+    assert profiling.get_active_cprofile_stage() is None
+
+    measurements, = profiler.stages
+    assert measurements["cprofile"] == os.path.abspath(profiling.get_cprofile_path("compute_csd/food_1"))
+    assert os.path.basename(measurements["cprofile"]) == "profile_compute_csd-food_1.prof"
+    assert pstats.Stats(measurements["cprofile"]).total_calls > 0
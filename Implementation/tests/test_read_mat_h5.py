@@ -0,0 +1,73 @@
+# the direct HDF5 reader of v. 7.3 mat files (mat_to_epochs_conversion/read_mat_h5.py) against the dictionary of pymatreader
+# on a synthetic mat file (benchmarks/synthetic_data.py) with oddball trials
+
+import os, sys
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+mne = pytest.importorskip("mne")
+pytest.importorskip("pymatreader")
+
+from src import config
+from benchmarks import synthetic_data
+from mat_to_epochs_conversion import read_mat_h5, convert_main_funcs, extract_from_dict
+
+
+@pytest.fixture(scope="module")
+def mat_file(tmp_path_factory):
+    # 2 trials of every condition and 3 oddball trials, shuffled (the channels and time points of config.py, as validated by the readers)
+    file_name = tmp_path_factory.mktemp("subject") / "datafinalLow.mat"
+    events_code = synthetic_data.write_datafinallow(file_name, n_trials_per_condition=2, n_oddball=3)
+
+    data, dict_events_code, ch_names, sfreq = extract_from_dict.extract(convert_main_funcs.convert_mat_to_dict(file_name))
+    assert np.array_equal(dict_events_code, events_code)
+
+    return file_name, data, events_code, ch_names, sfreq
+
+
+def test_reader_matches_pymatreader(mat_file):
+    file_name, data, events_code, ch_names, sfreq = mat_file
+
+    with read_mat_h5.open_mat_h5(file_name) as reader:
+        assert np.array_equal(reader.events_code, events_code)
+        assert reader.ch_names == list(ch_names) and reader.sfreq == sfreq
+        assert reader.trial.shape == data.shape and len(reader.trial) == len(data)
+
+        assert all(np.array_equal(reader.trial[i], data[i]) for i in range(len(data)))
+
+
+def test_read_into(mat_file):
+    file_name, data, events_code, _, _ = mat_file
+    indices = np.flatnonzero(events_code != config.oddball_id)[::2]
+
+    with read_mat_h5.open_mat_h5(file_name) as reader:
+        out = np.empty(data.shape)
+        reader.trial.read_into(out)
+        assert np.array_equal(out, data)
+
+        out = np.empty((len(indices),) + data.shape[1:], dtype=np.float32)
+        reader.trial.read_into(out, indices)
+        assert np.array_equal(out, data[indices].astype(np.float32))
+
+        with pytest.raises(ValueError):
+            reader.trial.read_into(np.empty(data.shape), indices)
+
+
+@pytest.mark.parametrize("block_size", [1, 4, 100])
+def test_iter_blocks(mat_file, block_size):
+    file_name, data, events_code, _, _ = mat_file
+    indices = np.flatnonzero(events_code != config.oddball_id)
+
+    with read_mat_h5.open_mat_h5(file_name) as reader:
+        blocks = [(start, block.copy()) for start, block in reader.trial.iter_blocks(block_size, indices)]
+
+    # consecutive blocks of at most block_size trials, together the trials of indices in order
+    assert [start for start, _ in blocks] == list(range(0, len(indices), block_size))
+    assert all(len(block) <= block_size for _, block in blocks)
+    assert np.array_equal(np.concatenate([block for _, block in blocks]), data[indices])
@@ -0,0 +1,72 @@
+# the removal of the oddball and bad trials (mat_to_epochs_conversion/remove_oddball_trials.py): the keep mask, the in place
+# compaction of the kept trials, and the epochs of the HDF5 path against the epochs of the pymatreader dictionary path
+
+import os, sys
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+mne = pytest.importorskip("mne")
+pytest.importorskip("pymatreader")
+
+from src import config
+from benchmarks import synthetic_data
+from mat_to_epochs_conversion import remove_oddball_trials, convert_main_funcs, create_info
+
+
+def test_create_keep_mask():
+    events_code = np.array([10, 8, 12, 8, 14, 20])
+
+    keep_mask = remove_oddball_trials.create_keep_mask(events_code, 8)
+    assert keep_mask.tolist() == [True, False, True, False, True, True]
+
+    # bad trials are indices in the mat file, an oddball trial may also be a bad trial
+    keep_mask = remove_oddball_trials.create_keep_mask(events_code, 8, [1, 4])
+    assert keep_mask.tolist() == [True, False, True, False, False, True]
+
+    with pytest.raises(ValueError):
+        remove_oddball_trials.create_keep_mask(events_code, 8, [6])
+
+
+@pytest.mark.parametrize("keep", [[1, 1, 1, 1, 1], [0, 1, 0, 1, 1], [1, 0, 0, 0, 1], [0, 0, 0, 0, 0]])
+def test_keep_trials(keep):
+    data = np.random.default_rng(0).standard_normal((5, 3, 4))
+    keep_mask = np.array(keep, dtype=bool)
+    expected = data[keep_mask]
+
+    data_kept = remove_oddball_trials.keep_trials(data, keep_mask)
+
+    # the kept trials in their order, a view of data
+    assert np.array_equal(data_kept, expected)
+    assert data_kept.base is data
+
+    with pytest.raises(ValueError):
+        remove_oddball_trials.keep_trials(data, keep_mask[:-1])
+
+
+def test_h5_path_matches_dict_path(tmp_path, monkeypatch):
+    # 2 trials of every condition and 3 oddball trials (the channels and time points of config.py, as validated by the readers)
+    file_name = tmp_path / "datafinalLow.mat"
+    events_code = synthetic_data.write_datafinallow(file_name, n_trials_per_condition=2, n_oddball=3)
+    bad_trials = [0, int(np.flatnonzero(events_code == config.oddball_id)[0]), len(events_code) - 1]
+    keep_mask = (events_code != config.oddball_id)
+    keep_mask[bad_trials] = False
+
+    # both paths save the epochs and evoked in the current folder
+    monkeypatch.chdir(tmp_path)
+
+    sub_dict = convert_main_funcs.convert_mat_to_dict(file_name)
+    mne_info = create_info.create_mne_info(sub_dict)
+    dict_epochs, dict_evoked = convert_main_funcs.convert_dict_to_epochs(sub_dict, mne_info, bad_trials)
+    h5_epochs, h5_evoked = convert_main_funcs.convert_mat_h5_to_epochs(file_name, mne_info, bad_trials)
+
+    assert len(h5_epochs) == len(dict_epochs) == keep_mask.sum()
+    assert np.array_equal(h5_epochs.events[:, 2], events_code[keep_mask])
+    assert np.array_equal(dict_epochs.events, h5_epochs.events) and dict_epochs.event_id == h5_epochs.event_id
+    assert np.array_equal(dict_epochs.get_data(), h5_epochs.get_data())
+    assert np.array_equal(dict_evoked.data, h5_evoked.data)
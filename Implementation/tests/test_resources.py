@@ -0,0 +1,52 @@
+# the resource plan (resources.py): the cores and memory of a run are divided between the subject processes, the stages,
+# the workers and the BLAS threads, and the BLAS threads of the process are limited by the plan
+
+import os, sys
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+pytest.importorskip("threadpoolctl")
+
+from src import resources
+
+
+def test_plan_divides_the_cores():
+    plan = resources.create_resource_plan(n_subjects=5, n_workers=2, n_stage_workers=3, cpu_budget=16, memory_budget=64 * 2**30,
+                                          subject_memory=8 * 2**30)
+
+    assert plan["subject_processes"] == 2 and plan["cores_per_subject"] == 8 and plan["cores_per_stage"] == 2
+    assert plan["n_jobs"] * plan["worker_blas_threads"] * plan["stage_workers"] * plan["subject_processes"] <= 16
+    assert plan["blas_threads"] * plan["stage_workers"] * plan["subject_processes"] <= 16
+
+
+def test_plan_is_bounded_by_subjects_and_memory():
+    plan = resources.create_resource_plan(n_subjects=1, n_workers=4, n_stage_workers=1, cpu_budget=8, memory_budget=64 * 2**30)
+    assert plan["subject_processes"] == 1 and plan["n_jobs"] == 8
+
+    plan = resources.create_resource_plan(n_subjects=8, n_workers=4, n_stage_workers=1, cpu_budget=8, memory_budget=20 * 2**30,
+                                          subject_memory=8 * 2**30)
+    assert plan["subject_processes"] == 2 and plan["n_jobs"] == 4
+    assert any("memory" in decision for decision in plan["decisions"])
+
+
+def test_set_resource_plan_limits_blas_threads(capsys):
+    from threadpoolctl import threadpool_info
+
+    plan = resources.create_resource_plan(n_subjects=2, n_workers=2, n_stage_workers=2, cpu_budget=4, memory_budget=64 * 2**30)
+
+    try:
+        resources.set_resource_plan(plan)
+        assert resources.get_resource_plan() is plan
+        assert all(pool["num_threads"] <= plan["blas_threads"] for pool in threadpool_info())
+        assert resources.get_n_jobs() == plan["n_jobs"] and resources.get_n_jobs(3) == 3
+        assert resources.get_n_jobs(exclusive=True) == plan["cores_per_subject"]
+
+    finally:
+        resources.reset_resource_plan()
+
+    assert "resources: " in capsys.readouterr().out
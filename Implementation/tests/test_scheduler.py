@@ -0,0 +1,92 @@
+# the subject level scheduling (scheduler.py) with a stub subject function: the serial path, the pool, a subject that raises and
+# a worker process that dies, the other subjects finish and the run summary is in the order of the folders
+
+import os, sys
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+pytest.importorskip("psutil")
+
+from src import scheduler, resources
+
+
+def _stub_subject(folder, targets=None, dry_run=False, prefetched=None, resource_plan=None):
+    # the summary of process_subject, the folder name decides the outcome
+    subject_num = os.path.basename(os.path.normpath(folder))
+
+    if subject_num.startswith("raises"):
+        raise RuntimeError(f"{subject_num} failed")
+
+    if subject_num.startswith("dies"):
+        os._exit(1)
+
+    return {"subject": subject_num, "status": "ok", "wall_time": 0.0, "error": None, "stages": {}, "pid": os.getpid()}
+
+
+_create_resource_plan = resources.create_resource_plan
+
+
+def _plan(n_subjects=1, n_workers=1, **kwargs):
+    # the plan of a machine with 4 cores and enough memory for every subject process
+    return _create_resource_plan(n_subjects=n_subjects, n_workers=n_workers, cpu_budget=4, memory_budget=64 * 2**30, subject_memory=2**30)
+
+
+@pytest.fixture
+def stub_run(monkeypatch):
+    monkeypatch.setattr(scheduler, "process_subject", _stub_subject)
+    monkeypatch.setattr(resources, "create_resource_plan", _plan)
+
+
+def _folders(tmp_path, names):
+    folders = []
+    for name in names:
+        (tmp_path / name).mkdir()
+        folders.append(str(tmp_path / name))
+    return folders
+
+
+def test_serial(tmp_path, stub_run):
+    folders = _folders(tmp_path, ["s1", "s2", "s3"])
+
+    run_summary = scheduler.run_subjects(folders, n_workers=1, prefetch_depth=0)
+
+    assert [subject_summary["subject"] for subject_summary in run_summary] == ["s1", "s2", "s3"]
+    assert all(subject_summary["status"] == "ok" for subject_summary in run_summary)
+    # all subjects in the current process
+    assert {subject_summary["pid"] for subject_summary in run_summary} == {os.getpid()}
+
+
+def test_pool(tmp_path, stub_run):
+    folders = _folders(tmp_path, ["s1", "s2", "s3"])
+
+    run_summary = scheduler.run_subjects(folders, n_workers=2, prefetch_depth=0)
+
+    assert [subject_summary["subject"] for subject_summary in run_summary] == ["s1", "s2", "s3"]
+    assert all(subject_summary["status"] == "ok" for subject_summary in run_summary)
+    # every subject in its own worker process
+    assert len({subject_summary["pid"] for subject_summary in run_summary} | {os.getpid()}) == len(folders) + 1
+
+
+def test_subject_that_raises(tmp_path, stub_run):
+    folders = _folders(tmp_path, ["s1", "raises", "s3"])
+
+    run_summary = scheduler.run_subjects(folders, n_workers=2, prefetch_depth=0)
+
+    assert [subject_summary["status"] for subject_summary in run_summary] == ["ok", "failed", "ok"]
+    assert run_summary[1]["subject"] == "raises" and run_summary[1]["error"] == "RuntimeError: raises failed"
+
+
+def test_worker_that_dies(tmp_path, stub_run):
+    folders = _folders(tmp_path, ["dies", "s2", "s3"])
+
+    run_summary = scheduler.run_subjects(folders, n_workers=2, prefetch_depth=0)
+
+    # the subject running next to the dying worker is run again, the subjects after it run in a new pool
+    assert [subject_summary["subject"] for subject_summary in run_summary] == ["dies", "s2", "s3"]
+    assert run_summary[0]["status"] == "failed" and run_summary[0]["error"].startswith("BrokenProcessPool")
+    assert [subject_summary["status"] for subject_summary in run_summary[1:]] == ["ok", "ok"]
@@ -0,0 +1,52 @@
+# the arrays shared with worker processes by name (shared_arrays.py): the workers see the data of the parent without a pickled copy,
+# mapped files are shared as they are and the copies are removed on close
+
+import os, sys
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from src import shared_arrays
+
+
+def _worker_sum(handle, rows):
+    return shared_arrays.attach(handle)[rows].sum(axis=0)
+
+
+def test_shared_copy(tmp_path):
+    from concurrent.futures import ProcessPoolExecutor
+
+    array = np.random.default_rng(0).standard_normal((6, 3, 5)).astype(np.float32)
+
+    with shared_arrays.SharedArray(array, directory=tmp_path) as shared:
+        assert os.path.exists(shared.handle["path"])
+
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            sums = list(executor.map(_worker_sum, [shared.handle] * 2, [[0, 1, 2], [3, 4, 5]]))
+
+        path = shared.handle["path"]
+
+    assert np.allclose(sums[0] + sums[1], array.sum(axis=0))
+    assert not os.path.exists(path)
+
+
+def test_mapped_file_is_not_copied(tmp_path):
+    array = np.arange(24.0).reshape(4, 6)
+    np.save(tmp_path / "data.npy", array)
+    mapped = np.load(tmp_path / "data.npy", mmap_mode="r")
+
+    with shared_arrays.SharedArray(mapped, directory=tmp_path) as shared:
+        assert shared.handle["path"] == os.path.abspath(tmp_path / "data.npy")
+        assert np.array_equal(shared_arrays.attach(shared.handle), array)
+
+    # the file of the caller is kept, a slice of it is copied
+    assert os.path.exists(tmp_path / "data.npy")
+
+    with shared_arrays.SharedArray(mapped[1:], directory=tmp_path) as shared:
+        assert shared.handle["path"] != os.path.abspath(tmp_path / "data.npy")
+        assert np.array_equal(shared_arrays.attach(shared.handle), array[1:])
@@ -0,0 +1,99 @@
+# the averages of the TFR contrasts derived from the sums and counts of the conditions and the TFR contrasts derived from the cached
+# spectra of the combined conditions (analyses/tfr_psd_analyses.py) against the averages of the epochs and compute_tfr of their difference
+
+import os, sys
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+mne = pytest.importorskip("mne")
+
+from src import config
+from analyses import tfr_psd_analyses
+from mat_to_epochs_conversion.combine_epochs import get_combined_conditions
+
+
+def _epochs(n_per_condition=2, sfreq=200.0):
+    # epochs of the conditions of event_ids (not combined), as the epoch cache of a subject
+    rng = np.random.default_rng(0)
+    codes = np.repeat(list(config.event_ids.values()), n_per_condition)
+    rng.shuffle(codes)
+    events = np.column_stack([np.arange(len(codes)) * 1000, np.zeros(len(codes), int), codes])
+    data = rng.standard_normal((len(codes), 3, int(1.5 * sfreq)))
+
+    return mne.EpochsArray(data, mne.create_info(3, sfreq, "mag"), events, tmin=-0.5, event_id=dict(config.event_ids), verbose=False)
+
+
+def _combined(epochs):
+    epochs_combined = epochs.copy()
+
+    for new_condition, old_conditions in get_combined_conditions(config.event_ids, config.new_event_ids).items():
+        epochs_combined = mne.epochs.combine_event_ids(epochs_combined, old_conditions, {new_condition: config.new_event_ids[new_condition]})
+
+    return epochs_combined
+
+
+def _average(epochs, epochs_combined, names):
+    # the combined conditions are averaged from the combined epochs, the tags of the lags from the epochs of event_ids
+    return (epochs_combined if set(names).issubset(config.new_event_ids) else epochs)[names].average()
+
+
+def test_evoked_from_condition_sums():
+    epochs = _epochs()
+    epochs_combined = _combined(epochs)
+    condition_sums = tfr_psd_analyses.compute_condition_sums(epochs)
+
+    assert sum(condition_sums["counts"].values()) == len(epochs)
+
+    for con1, con2 in config.tfr_contrasts:
+        for _, names in (con1, con2):
+            evoked = tfr_psd_analyses.evoked_from_condition_sums(condition_sums, names)
+            expected = _average(epochs, epochs_combined, names)
+
+            assert evoked.nave == expected.nave
+            assert np.isclose(evoked.tmin, expected.tmin)
+            assert np.abs(evoked.data - expected.data).max() <= 1e-12 * np.abs(expected.data).max()
+
+
+def test_get_leaf_conditions():
+    conditions = list(config.event_ids.keys())
+
+    assert tfr_psd_analyses.get_leaf_conditions(["food_2", "positive_1"], conditions) == \
+        ["food/short/rep2", "food/medium/rep2", "food/long/rep2", "positive/short/rep1", "positive/medium/rep1", "positive/long/rep1"]
+    assert tfr_psd_analyses.get_leaf_conditions(["short/rep1"], conditions) == ["food/short/rep1", "positive/short/rep1", "neutral/short/rep1"]
+    assert tfr_psd_analyses.get_leaf_conditions(["food/long/rep2"], conditions) == ["food/long/rep2"]
+
+
+@pytest.mark.parametrize("contrast, shared_cache", [(0, True), (3, True), (3, False)])
+def test_compute_tfr_contrast(tmp_path, monkeypatch, contrast, shared_cache):
+    # pres_1-pres_2 (a union of the combined conditions) and short_rep1-short_rep2 (tags of the lags) are both derived from the
+    # cached spectra of the leaf conditions, without a cache the spectra are computed for the contrast
+    monkeypatch.chdir(tmp_path)
+
+    epochs = _epochs()
+    epochs_combined = _combined(epochs)
+    freqs = np.arange(8, 24, 2)
+    con1, con2 = config.tfr_contrasts[contrast]
+
+    condition_sums = tfr_psd_analyses.compute_condition_sums(epochs)
+    tfr_coefs_cache = None
+
+    if shared_cache:
+        tfr_coefs_cache = tfr_psd_analyses.create_tfr_coefs_cache(condition_sums, freqs, compute_dtype="float64")
+        assert tfr_coefs_cache["conditions"] == list(config.event_ids.keys())
+        assert tfr_psd_analyses.contrast_coefs_from_cache(tfr_coefs_cache, freqs, con1[1], con2[1]) is not None
+
+    tfr_contrast = tfr_psd_analyses.compute_tfr_contrast(None, freqs, con1, con2, condition_sums=condition_sums, tfr_coefs_cache=tfr_coefs_cache)
+
+    evoked_1, evoked_2 = _average(epochs, epochs_combined, con1[1]), _average(epochs, epochs_combined, con2[1])
+    evo_contrast = mne.EvokedArray(evoked_1.data - evoked_2.data, evoked_1.info, tmin=evoked_1.tmin)
+    expected = evo_contrast.compute_tfr(method="multitaper", tmin=config.baseline_time[0], tmax=config.post_stim_time[1], freqs=freqs)
+
+    assert np.allclose(tfr_contrast.times, expected.times) and np.array_equal(tfr_contrast.freqs, expected.freqs)
+    assert np.abs(tfr_contrast.data - expected.data).max() <= 1e-12 * np.abs(expected.data).max()
+    assert os.path.exists(config.get_tfr_contrast_path(con1, con2))
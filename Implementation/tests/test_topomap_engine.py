@@ -0,0 +1,67 @@
+# the topo-plots of the TFR contrasts (topomap_engine.py): the values of every panel against the baseline corrected and cropped
+# TFR of mne, and the interpolated image against the image of mne.viz.plot_topomap (the engine uses private helpers of mne.viz.topomap,
+# these tests fail if they change)
+
+import os, sys
+import numpy as np
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.join(package_path, "src"), package_path]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+mne = pytest.importorskip("mne")
+
+from src import topomap_engine
+from tests.test_add_to_report import _info
+
+
+def test_compute_topomap_tensor():
+    rng = np.random.default_rng(0)
+    info = _info()
+    times = np.arange(-0.3, 0.8, 0.005)
+    freqs = np.arange(8.0, 24.0, 2.0)
+    tfrs = [mne.time_frequency.AverageTFRArray(info, rng.standard_normal((len(info.ch_names), len(freqs), len(times))) * 1e-26, times, freqs,
+                                               nave=1, method="multitaper") for _ in range(2)]
+
+    time_frames = [(0.0, 0.2), (0.1, 0.35), (0.5, 0.75)]
+    freq_bands = topomap_engine.get_topomap_bands(freqs)
+    baseline = (-0.3, 0.0)
+
+    topomap_tensor = topomap_engine.compute_topomap_tensor(tfrs, time_frames, freq_bands, baseline=baseline)
+    assert topomap_tensor.shape == (len(tfrs), len(time_frames), len(freq_bands), len(info.ch_names))
+
+    for c, tfr in enumerate(tfrs):
+        for k, (tmin, tmax) in enumerate(time_frames):
+            for b, (fmin, fmax) in enumerate(freq_bands):
+                # a panel of AverageTFR.plot_topomap(mode='mean', baseline=baseline)
+                expected = tfr.copy().apply_baseline(baseline, mode="mean", verbose=False).crop(tmin, tmax, fmin, fmax).data.mean(axis=(1, 2))
+
+                assert np.abs(topomap_tensor[c, k, b] - expected).max() <= 1e-12 * np.abs(expected).max()
+
+
+def test_interpolator_matches_mne_image():
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    info = _info()
+    interpolator = topomap_engine.TopomapInterpolator(info)
+
+    # values scaled to ~1, mne stops the gradient estimation of the cubic interpolation early for TFR power (see topomap_engine.py)
+    for seed in range(3):
+        values = np.random.default_rng(seed).standard_normal(len(info.ch_names))
+
+        fig, axes = plt.subplots()
+        im, _ = mne.viz.plot_topomap(values, info, ch_type="mag", extrapolate="local", res=topomap_engine.topomap_res, axes=axes, show=False)
+        expected = np.ma.filled(im.get_array(), np.nan)
+        plt.close(fig)
+
+        image = interpolator.interpolate(values)
+        assert image.shape == expected.shape == (topomap_engine.topomap_res, topomap_engine.topomap_res)
+
+        inside = np.isfinite(expected)
+        assert inside.mean() > 0.5 and np.array_equal(inside, np.isfinite(image))
+        assert np.abs(image[inside] - expected[inside]).max() <= 1e-6 * np.abs(expected[inside]).max()
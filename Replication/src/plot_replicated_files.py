@@ -10,18 +10,24 @@
 
 # Import necessary modules
 try:
-    import mne
-    import conpy
-    import matplotlib.pyplot as plt
-    from mne.time_frequency import read_csd, pick_channels_csd 
-    from mne.bem import _fit_sphere
+    import os
+    import sys
+    import lazy_loader as lazy
+
+    # Set the logging level to show only error logs (read by mne when it is loaded)
+    if "mne" in sys.modules:
+        sys.modules["mne"].set_log_level('ERROR')
+    else:
+        os.environ["MNE_LOGGING_LEVEL"] = 'ERROR'
+
+    # mne and conpy are loaded on first use by a plotting function (matplotlib inside plot_forward_model), importing this file stays fast
+    # (conpy first: if it is missing, the delayed error inspects the loaded modules, which would load mne)
+    conpy = lazy.load("conpy")
+    mne = lazy.load("mne")
 
     # Dedicated python scripts
     from replication_config import *
 
-    # Set the logging level to show only error logs
-    mne.set_log_level('ERROR')
-
 except ImportError as e:
     print(f"There is an error importing a module. {e}. Please install it first.")
 
@@ -77,7 +83,7 @@ def plot_csd_matrices(cond, sub_idx=0, mode_val='csd', meg_val="grad"):
 
     try:
         # Read a CrossSpectralDensity object from an HDF5 file
-        csd = read_csd(csd_path.format(subject=subjects[sub_idx], condition=cond))
+        csd = mne.time_frequency.read_csd(csd_path.format(subject=subjects[sub_idx], condition=cond))
     except AttributeError as e:
         raise RuntimeError(f"Error reading CSD: {e}")
     except OSError as e:
@@ -85,7 +91,7 @@ def plot_csd_matrices(cond, sub_idx=0, mode_val='csd', meg_val="grad"):
 
     try:
         # Pick channels from the CSD matrix
-        csd = pick_channels_csd(csd, grads)
+        csd = mne.time_frequency.pick_channels_csd(csd, grads)
     except UnboundLocalError:
         raise RuntimeError("The variable 'grads' was not defined properly.")
 
@@ -162,6 +168,7 @@ def plot_forward_model(sub_idx=0):
     
     Returns: A Matplotlib object showing the 3D forward model of a subject.
     """
+    import matplotlib.pyplot as plt
     
     # Read the forward solution for the subject using MNE
     try:
@@ -172,7 +179,7 @@ def plot_forward_model(sub_idx=0):
         raise IndexError("Error running 'mne.read_forward_solution()' because the subject index exceeds 16.")
     else:
         # Fit a sphere to the source points and get the center
-        _, center = _fit_sphere(fwd_r['source_rr'])
+        _, center = mne.bem._fit_sphere(fwd_r['source_rr'])
         
         # Calculate the radial coordinate system components (tan1, tan2)
         _, tan1, tan2 = conpy.forward._make_radial_coord_system(fwd_r['source_rr'], center)
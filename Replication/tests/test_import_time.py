@@ -0,0 +1,27 @@
+# Import necessary libraries
+import os
+import sys
+import json
+import subprocess
+
+# Importing plot_replicated_files should not load mne, conpy or matplotlib, they are loaded by the plotting functions
+src_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+import_time_budget = 1.0  # Seconds, in a fresh interpreter
+
+measure_script = f"""
+import sys, time, json
+sys.path.insert(0, {src_dir!r})
+start = time.perf_counter()
+import plot_replicated_files
+print(json.dumps({{"time": time.perf_counter() - start, "modules": sorted(sys.modules)}}))
+"""
+
+### ===== Test Import Time ===== ###
+def test_import_time():
+    # Measured in a fresh process, the modules loaded by conftest don't count
+    output = subprocess.run([sys.executable, "-c", measure_script], capture_output=True, text=True, check=True).stdout
+    measurement = json.loads(output.splitlines()[-1])
+
+    loaded = [module for module in ["mne.utils", "conpy.forward", "matplotlib"] if module in measurement["modules"]]
+    assert not loaded, f"Importing plot_replicated_files loads {', '.join(loaded)}"
+    assert measurement["time"] < import_time_budget, f"Importing plot_replicated_files took {measurement['time']:.2f}s"